@@ -1,6 +1,7 @@
-from typing import Dict, List, Optional
+from typing import Dict, Optional
 
 from app.rag_pipeline import build_context
+from app.context_packer import pack_context, packed_sources
 from app.qwen_api import qwen_chat
 from app.eval_utils import verify_and_revise
 
@@ -33,12 +34,9 @@ def generate_reading_card(
     返回 { card: str, sources: List[Dict] }
     """
     sources = build_context(query, n_results=max(8, k_ctx), use_rerank=use_rerank, use_bm25=use_bm25)
-    # 组装带编号的上下文（标题优先）
-    context_lines: List[str] = []
-    for idx, s in enumerate(sources[:k_ctx], start=1):
-        display_name = s.get("title") or s.get("source")
-        context_lines.append(f"[{idx}] {display_name}\n{s.get('text','')}")
-    context_text = "\n\n".join(context_lines)
+    # 组装带编号的上下文（标题优先）：相邻 chunk 合并、近重复去除、按 token 预算填充，同一来源共用一个 [i]
+    context_text, packed = pack_context(sources[:k_ctx])
+    cited = packed_sources(packed)
 
     user_prompt = (
         f"论文主题或问题：{query}\n\n"
@@ -103,7 +101,7 @@ def generate_reading_card(
                 "snippet": make_snippet(s.get("text", "")),
                 "url": pick_url(s.get("text", "")),
             }
-            for s in sources[:k_ctx]
+            for s in cited
         ],
     }
 
@@ -1,6 +1,7 @@
 from typing import Dict, List, Optional
 
 from app.rag_pipeline import build_context
+from app.context_packer import pack_context, packed_sources
 from app.qwen_api import qwen_chat
 from app.eval_utils import verify_and_revise
 
@@ -50,12 +51,9 @@ def generate_comparison(
         # 回退前2条
         chosen = sources[:2]
 
-    # 组装上下文
-    ctx_lines: List[str] = []
-    for idx, s in enumerate(chosen, start=1):
-        display = s.get("title") or s.get("source")
-        ctx_lines.append(f"[{idx}] {display}\n{s.get('text','')}")
-    context_text = "\n\n".join(ctx_lines)
+    # 组装上下文（按 token 预算填充，编号与返回的来源列表一致）
+    context_text, packed = pack_context(chosen)
+    cited = packed_sources(packed)
 
     user_prompt = (
         f"对比主题或需求：{topic}\n\n"
@@ -116,7 +114,7 @@ def generate_comparison(
                 "snippet": make_snippet(s.get("text", "")),
                 "url": pick_url(s.get("text", "")),
             }
-            for s in chosen
+            for s in cited
         ],
     }
 
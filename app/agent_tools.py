@@ -5,9 +5,8 @@ from app.agent_card import generate_reading_card
 from app.agent_compare import generate_comparison
 
 
-def tool_rag_answer(query: str, *, use_rerank: bool = True, use_bm25: bool = True, temperature: float = 0.2) -> Dict:
-    # 温度在 rag_pipeline 内部 qwen_chat 使用默认值；若需要，也可扩展传参
-    res = rag_pipeline(query, use_rerank=use_rerank, use_bm25=use_bm25)
+def tool_rag_answer(query: str, *, use_rerank: bool = True, use_bm25: bool = True, temperature: Optional[float] = None) -> Dict:
+    res = rag_pipeline(query, use_rerank=use_rerank, use_bm25=use_bm25, temperature=temperature)
     return {"type": "rag_answer", "data": res}
 
 
@@ -2,7 +2,8 @@ from typing import List, Optional, Dict, Any
 
 from fastapi import FastAPI
 from fastapi import UploadFile, File, Form
-from fastapi.responses import RedirectResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
@@ -12,10 +13,17 @@ from app.agent_tools import tool_rag_answer, tool_reading_card, tool_compare_pap
 from app.rag_pipeline import rag_pipeline
 from app.agent_card import generate_reading_card
 from app.agent_compare import generate_comparison
-from app.rag_pipeline import DEFAULT_COLLECTION
-from app.chroma_utils import init_chroma, add_documents
+from app.rag_pipeline import context_cache_stats, rerank_cache_stats
+from app.chroma_utils import bm25_index_stats
+from app.sharding import shard_stats
+from app.doc_cache import doc_cache_stats
+from app.ingest_jobs import get_job, ingest_job_stats, pending_count, recover_jobs, submit_ingest
+from app.embeddings import warmup_embedder, embed_cache_stats, query_embedding_cache_stats
+from app.settings import get_bool, get_int
+from app.qwen_api import llm_cache_stats
 import os
 import json
+import threading
 
 
 app = FastAPI(title="RAG+Agent API", version="0.1.0")
@@ -74,6 +82,36 @@ class CompareRequest(BaseModel):
     self_check: Optional[bool] = False
 
 
+@app.on_event("startup")
+def _warmup() -> None:
+    # 后台预热 embedder，避免首个查询承担模型构建/加载时间；EMBED_WARMUP=0 可关闭
+    if not get_bool("EMBED_WARMUP", True):
+        return
+
+    def _run():
+        try:
+            warmup_embedder()
+        except Exception:
+            pass
+
+    threading.Thread(target=_run, name="embed-warmup", daemon=True).start()
+
+
+@app.on_event("startup")
+def _resume_ingest_jobs() -> None:
+    # 上次进程退出时未完成的入库任务重新排队
+    try:
+        recover_jobs()
+    except Exception:
+        pass
+
+
+@app.post("/admin/warmup")
+def admin_warmup() -> Dict[str, Any]:
+    """显式预热：构建当前配置的 embedder 并执行一次编码。"""
+    return {"embedder": warmup_embedder()}
+
+
 @app.get("/health")
 def health() -> Dict[str, Any]:
     return {"status": "ok"}
@@ -92,6 +130,22 @@ def runtime_config() -> Dict[str, Any]:
     }
 
 
+@app.get("/stats/cache")
+def cache_stats() -> Dict[str, Any]:
+    """进程内各级缓存的命中统计。"""
+    return {
+        "embedding_cache": embed_cache_stats(),
+        "query_embedding_cache": query_embedding_cache_stats(),
+        "context_cache": context_cache_stats(),
+        "rerank_cache": rerank_cache_stats(),
+        "llm_cache": llm_cache_stats(),
+        "document_cache": doc_cache_stats(),
+        "bm25_index": bm25_index_stats(),
+        "sharding": shard_stats(),
+        "ingest_jobs": ingest_job_stats(),
+    }
+
+
 @app.get("/")
 def root():
     # 访问根路径时跳转到接口文档
@@ -192,6 +246,7 @@ def chat_stream(
                     args["query"],
                     use_rerank=bool(rerank) if rerank is not None else False,
                     use_bm25=bool(bm25) if bm25 is not None else True,
+                    temperature=float(temp) if temp is not None else None,
                 )
                 data = (_res or {}).get("data") or {}
                 preview = [ s for s in data.get("sources", []) ][:3]
@@ -211,8 +266,8 @@ def chat_stream(
                 final_sources = data.get("sources", [])
             else:
                 # 闲聊走非流式
-                from app.qwen_api import qwen_chat
-                content = qwen_chat(system_prompt="你是一个友好且克制的助理。", user_prompt=user_msg)
+                from app.qwen_api import chat_temperature, qwen_chat
+                content = qwen_chat(system_prompt="你是一个友好且克制的助理。", user_prompt=user_msg, temperature=chat_temperature())
                 final_sources = []
         except Exception as e:
             # 输出错误事件，避免前端无响应
@@ -259,7 +314,7 @@ def chat_stream(
 
 @app.post("/tools/rag")
 def rag(req: RagRequest) -> Dict[str, Any]:
-    res = rag_pipeline(req.query, use_rerank=bool(req.use_rerank), use_bm25=bool(req.use_bm25))
+    res = rag_pipeline(req.query, use_rerank=bool(req.use_rerank), use_bm25=bool(req.use_bm25), temperature=req.temperature)
     return res
 
 
@@ -297,297 +352,36 @@ async def ingest(
     file: UploadFile | None = File(None),
     url: Optional[str] = Form(None),
     ocr: Optional[bool] = Form(False),
-) -> Dict[str, Any]:
-    """Ingest a PDF/MD/TXT file or a URL into Chroma. Returns count and sources."""
-    import os
-    import tempfile
-    from typing import List, Tuple
-    import httpx
-    try:
-        from pypdf import PdfReader
-    except Exception:
-        PdfReader = None  # type: ignore
-    try:
-        from pdfminer.high_level import extract_text as pdfminer_extract_text  # type: ignore
-    except Exception:
-        pdfminer_extract_text = None  # type: ignore
-    try:
-        import fitz  # PyMuPDF
-    except Exception:
-        fitz = None  # type: ignore
-
-    docs: List[Tuple[str, str]] = []
-    debug: Dict[str, Any] = {}
-
-    # Handle file upload
+):
+    """
+    Queue a PDF/MD/TXT file or a URL for ingestion into Chroma and return the job immediately.
+    Extraction, chunking, embedding and upserts run on the background ingest pool; poll GET /ingest/{job_id}.
+    """
+    if file is None and not (url or "").strip():
+        return JSONResponse(status_code=400, content={"reason": "请上传文件或提供URL"})
+    # 有界队列：积压的任务过多时拒绝新任务，而不是无限堆积上传内容
+    max_pending = get_int("INGEST_MAX_PENDING", 100)
+    if max_pending > 0 and await run_in_threadpool(pending_count) >= max_pending:
+        return JSONResponse(status_code=429, content={"reason": "入库任务排队已满，请稍后重试"})
+    content: Optional[bytes] = None
+    fname: Optional[str] = None
     if file is not None:
         fname = file.filename or "upload"
-        ext = os.path.splitext(fname)[1].lower()
         try:
-            content_bytes = await file.read()
+            content = await file.read()
         except Exception:
-            content_bytes = b""
-        debug.update({
-            "file_name": fname,
-            "ext": ext,
-            "bytes_len": len(content_bytes),
-            "has_pypdf": bool(PdfReader is not None),
-            "has_pdfminer": bool(pdfminer_extract_text is not None),
-            "has_pymupdf": bool(fitz is not None),
-        })
-        is_pdf_guess = ext == ".pdf" or (len(content_bytes) >= 4 and content_bytes[:4] == b"%PDF")
-        if ext in {".md", ".txt"}:
-            try:
-                text = content_bytes.decode("utf-8", errors="ignore").strip()
-            except Exception:
-                text = ""
-            if text:
-                docs.append((f"upload://{fname}", text))
-        elif is_pdf_guess and (PdfReader is not None or pdfminer_extract_text is not None or fitz is not None):
-            # Save to temp and extract
-            with tempfile.NamedTemporaryFile(suffix=ext, delete=True) as tmp:
-                tmp.write(content_bytes)
-                tmp.flush()
-                text = ""
-                tried: list[str] = []
-                # pypdf 优先（若运行时尚未可用，尝试动态导入一次）
-                if PdfReader is None:
-                    try:
-                        from pypdf import PdfReader as _PdfReader  # type: ignore
-                        PdfReader = _PdfReader  # type: ignore
-                        debug["has_pypdf"] = True
-                    except Exception:
-                        pass
-                if PdfReader is not None:
-                    try:
-                        reader = PdfReader(tmp.name)
-                        pages = []
-                        for p in reader.pages:
-                            t = p.extract_text() or ""
-                            if t.strip():
-                                pages.append(t)
-                        text = "\n".join(pages).strip()
-                        tried.append("pypdf")
-                    except Exception:
-                        tried.append("pypdf_err")
-                        text = ""
-                # 若为空尝试 pdfminer 提取
-                if pdfminer_extract_text is None:
-                    try:
-                        from pdfminer.high_level import extract_text as _pdfminer_extract_text  # type: ignore
-                        pdfminer_extract_text = _pdfminer_extract_text  # type: ignore
-                        debug["has_pdfminer"] = True
-                    except Exception:
-                        pass
-                if (not text) and pdfminer_extract_text is not None:
-                    try:
-                        text = (pdfminer_extract_text(tmp.name) or "").strip()
-                        tried.append("pdfminer")
-                    except Exception:
-                        tried.append("pdfminer_err")
-                        text = ""
-                # 若仍为空尝试 PyMuPDF
-                if fitz is None:
-                    try:
-                        import fitz as _fitz  # type: ignore
-                        fitz = _fitz  # type: ignore
-                        debug["has_pymupdf"] = True
-                    except Exception:
-                        pass
-                if (not text) and fitz is not None:
-                    try:
-                        with fitz.open(tmp.name) as doc:
-                            parts = []
-                            for page in doc:
-                                t = page.get_text("text") or ""
-                                if t.strip():
-                                    parts.append(t)
-                            text = "\n".join(parts).strip()
-                            tried.append("pymupdf")
-                    except Exception:
-                        tried.append("pymupdf_err")
-                        text = ""
-                # 如果 PDF 仍为空，默认尝试 OCR（即便未勾选），以提升兼容性
-                if (not text):
-                    try:
-                        import ocrmypdf  # type: ignore
-                        with tempfile.NamedTemporaryFile(suffix=ext, delete=True) as tmp_ocr:
-                            # 执行 OCR 到新文件
-                            ocrmypdf.ocr(tmp.name, tmp_ocr.name, force_ocr=True, skip_text=True, output_type="pdf")
-                            # 尝试再走一次提取
-                            t2 = ""
-                            if PdfReader is not None:
-                                try:
-                                    reader = PdfReader(tmp_ocr.name)
-                                    pages = []
-                                    for p in reader.pages:
-                                        tt = p.extract_text() or ""
-                                        if tt.strip():
-                                            pages.append(tt)
-                                    t2 = "\n".join(pages).strip()
-                                except Exception:
-                                    t2 = ""
-                            if (not t2) and pdfminer_extract_text is not None:
-                                try:
-                                    t2 = (pdfminer_extract_text(tmp_ocr.name) or "").strip()
-                                except Exception:
-                                    t2 = ""
-                            if (not t2) and fitz is not None:
-                                try:
-                                    with fitz.open(tmp_ocr.name) as doc:
-                                        parts = []
-                                        for page in doc:
-                                            tt = page.get_text("text") or ""
-                                            if tt.strip():
-                                                parts.append(tt)
-                                        t2 = "\n".join(parts).strip()
-                                except Exception:
-                                    t2 = ""
-                            if t2:
-                                text = t2
-                                tried.append("ocrmypdf")
-                    except Exception as e:
-                        tried.append("ocr_failed")
-                debug["pdf_extractors_tried"] = tried
-            if text:
-                docs.append((f"upload://{fname}", text))
-        else:
-            # Fallback treat as text
-            try:
-                text = content_bytes.decode("utf-8", errors="ignore").strip()
-                if text:
-                    docs.append((f"upload://{fname}", text))
-            except Exception:
-                pass
-
-    # Handle URL ingestion
-    if (not docs) and url:
-        u = url.strip()
-        try:
-            with httpx.Client(timeout=20.0, follow_redirects=True) as client:
-                resp = client.get(u)
-                ctype = resp.headers.get("content-type", "").lower()
-                # arXiv abs 页面仅抽取摘要块
-                if "arxiv.org/abs/" in u:
-                    try:
-                        html = resp.text or ""
-                        import re
-                        # 兼容 arXiv 经典页面摘要块
-                        m = re.search(r"<blockquote[^>]*class=\"abstract\"[^>]*>([\s\S]*?)</blockquote>", html, re.I)
-                        if m:
-                            block = m.group(1)
-                            # 去掉标签与前缀“Abstract:”等
-                            block = re.sub(r"<[^>]+>", " ", block)
-                            block = re.sub(r"\b(Abstract|ABSTRACT)\s*:\s*", "", block)
-                            text = " ".join(block.split()).strip()
-                            if text:
-                                docs.append((u, text))
-                                raise RuntimeError("__INGEST_DONE__")  # 直接跳出外层 try，走后续写库
-                    except RuntimeError as _e:
-                        if str(_e) != "__INGEST_DONE__":
-                            raise
-                    except Exception:
-                        pass
-                is_pdf_guess = ("pdf" in ctype) or (resp.content[:4] == b"%PDF")
-                if is_pdf_guess and (PdfReader is not None or pdfminer_extract_text is not None or fitz is not None):
-                    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=True) as tmp:
-                        tmp.write(resp.content)
-                        tmp.flush()
-                        text = ""
-                        if PdfReader is not None:
-                            try:
-                                reader = PdfReader(tmp.name)
-                                pages = []
-                                for p in reader.pages:
-                                    t = p.extract_text() or ""
-                                    if t.strip():
-                                        pages.append(t)
-                                text = "\n".join(pages).strip()
-                            except Exception:
-                                text = ""
-                        if (not text) and pdfminer_extract_text is not None:
-                            try:
-                                text = (pdfminer_extract_text(tmp.name) or "").strip()
-                            except Exception:
-                                text = ""
-                        if (not text) and fitz is not None:
-                            try:
-                                with fitz.open(tmp.name) as doc:
-                                    parts = []
-                                    for page in doc:
-                                        t = page.get_text("text") or ""
-                                        if t.strip():
-                                            parts.append(t)
-                                    text = "\n".join(parts).strip()
-                            except Exception:
-                                text = ""
-                        if (not text):
-                            try:
-                                import ocrmypdf  # type: ignore
-                                with tempfile.NamedTemporaryFile(suffix=".pdf", delete=True) as tmp_ocr:
-                                    ocrmypdf.ocr(tmp.name, tmp_ocr.name, force_ocr=True, skip_text=True, output_type="pdf")
-                                    # 再试一次提取
-                                    t2 = ""
-                                    if PdfReader is not None:
-                                        try:
-                                            reader = PdfReader(tmp_ocr.name)
-                                            pages = []
-                                            for p in reader.pages:
-                                                tt = p.extract_text() or ""
-                                                if tt.strip():
-                                                    pages.append(tt)
-                                            t2 = "\n".join(pages).strip()
-                                        except Exception:
-                                            t2 = ""
-                                    if (not t2) and pdfminer_extract_text is not None:
-                                        try:
-                                            t2 = (pdfminer_extract_text(tmp_ocr.name) or "").strip()
-                                        except Exception:
-                                            t2 = ""
-                                    if (not t2) and fitz is not None:
-                                        try:
-                                            with fitz.open(tmp_ocr.name) as doc:
-                                                parts = []
-                                                for page in doc:
-                                                    tt = page.get_text("text") or ""
-                                                    if tt.strip():
-                                                        parts.append(tt)
-                                                t2 = "\n".join(parts).strip()
-                                        except Exception:
-                                            t2 = ""
-                                    if t2:
-                                        text = t2
-                            except Exception:
-                                # OCR 失败忽略，继续文本兜底
-                                pass
-                if not text:
-                    try:
-                        resp.encoding = resp.encoding or "utf-8"
-                    except Exception:
-                        pass
-                    text = (resp.text or "").strip()
-        except Exception:
-            text = ""
-        if text:
-            docs.append((u, text))
-
-    if not docs:
-        reason = ""
-        if file is not None:
-            if (debug.get("ext") == ".pdf"):
-                if debug.get("pdf_extractors_tried") == []:
-                    reason = "无法从PDF提取文本（可能为图片型PDF，建议启用OCR）"
-                else:
-                    reason = "PDF提取失败（内容可能为扫描图），可尝试启用OCR"
-            else:
-                reason = "无法读取文件内容或不支持的格式"
-        elif url:
-            reason = "无法从URL获取文本/PDF内容"
-        return {"added": 0, "sources": [], "reason": reason, "debug": debug}
-
-    client = init_chroma()
-    add_documents(client, DEFAULT_COLLECTION, docs)
-    return {"added": len(docs), "sources": [src for src, _ in docs], "debug": debug}
+            content = b""
+    job = await run_in_threadpool(submit_ingest, content, fname, (url or "").strip() or None, bool(ocr))
+    return JSONResponse(status_code=202, content=job)
+
+
+@app.get("/ingest/{job_id}")
+def ingest_status(job_id: str):
+    """Stage, per-stage timings and (once done) the result of an ingest job."""
+    job = get_job(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"job_id": job_id, "reason": "job not found"})
+    return job
 
 
 # ---------------- Eval Summary ---------------- #
@@ -0,0 +1,474 @@
+import itertools
+import json
+import math
+import os
+import shutil
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+    from scipy import sparse
+except Exception:
+    np = None  # type: ignore
+    sparse = None  # type: ignore
+
+
+SEGMENT_FORMAT = 1
+
+
+def available() -> bool:
+    return np is not None and sparse is not None
+
+
+class BM25Segment:
+    """
+    一个不可变的倒排段：按词项组织的 CSR（term-major），行 = 词项，列 = 文档，值 = 词频。
+
+    - terms 为按字典序排列的词表，词项 id 即其下标；
+    - indptr[t]:indptr[t+1] 为词项 t 的 postings 区间；
+    - doc_ids 为 postings 中的文档下标（升序），tfs 为对应词频；
+    - doc_len 为每个文档的词数，keys 为文档 key。
+    打分所需的全局统计量（N、avgdl、df）由 BM25Index 汇总，因此多个段可以共用同一套统计。
+    所有数组都可以是 np.load(mmap_mode="r") 得到的内存映射，打开段的开销与语料规模无关。
+
+    删除通过 alive 掩码（墓碑）实现：被删除的文档不再出现在结果里，但仍计入 N/df 等统计，
+    直到段合并时被真正清除（与 Lucene 的删除语义一致）。
+    """
+
+    _uids = itertools.count(1)
+
+    def __init__(self, terms, indptr, doc_ids, tfs, doc_len, keys, vocab: Optional[Dict[str, int]] = None, alive=None, uid: Optional[int] = None):
+        self.terms = terms
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.keys = keys
+        # 可选的 term -> id dict；默认在有序的 terms 上二分查找
+        self._vocab = vocab
+        # None 表示全部存活；否则为 bool 数组，段本身不可变，更新时整体替换（copy-on-write）
+        self.alive = alive
+        # 同一份数据打上不同墓碑后 uid 不变，合并时据此识别“同一个段”
+        self.uid = uid if uid is not None else next(BM25Segment._uids)
+
+    @property
+    def n_docs(self) -> int:
+        return int(self.doc_len.shape[0])
+
+    @property
+    def total_len(self) -> float:
+        return float(self.doc_len.sum())
+
+    def term_id(self, term: str) -> int:
+        if self._vocab is not None:
+            return self._vocab.get(term, -1)
+        i = int(np.searchsorted(self.terms, term))
+        if i < self.terms.shape[0] and self.terms[i] == term:
+            return i
+        return -1
+
+    def df(self, term_id: int) -> int:
+        return int(self.indptr[term_id + 1] - self.indptr[term_id])
+
+    def key(self, doc: int) -> str:
+        return str(self.keys[doc])
+
+    @property
+    def n_alive(self) -> int:
+        return self.n_docs if self.alive is None else int(self.alive.sum())
+
+    def sources(self):
+        """每个文档对应的 source：chunk key 形如 "{source}::{idx}"，文件级 key 即 source。"""
+        keys = np.asarray(self.keys, dtype=str)
+        if keys.size == 0:
+            return keys
+        head, sep, tail = np.char.rpartition(keys, "::").T
+        return np.where(sep == "::", head, tail)
+
+    def with_alive(self, alive) -> "BM25Segment":
+        """共享全部数组、只替换墓碑掩码的新段。"""
+        if alive is not None and bool(alive.all()):
+            alive = None
+        return BM25Segment(self.terms, self.indptr, self.doc_ids, self.tfs, self.doc_len, self.keys, vocab=self._vocab, alive=alive, uid=self.uid)
+
+    @classmethod
+    def build(cls, keys: Sequence[str], token_lists: Iterable[List[str]]) -> "BM25Segment":
+        vocab: Dict[str, int] = {}
+        flat: List[int] = []
+        lens: List[int] = []
+        for tokens in token_lists:
+            for tok in tokens:
+                tid = vocab.get(tok)
+                if tid is None:
+                    tid = len(vocab)
+                    vocab[tok] = tid
+                flat.append(tid)
+            lens.append(len(tokens))
+        return cls.build_from_ids(keys, np.asarray(flat, dtype=np.int32), lens, vocab)
+
+    @classmethod
+    def build_from_ids(cls, keys: Sequence[str], flat_ids, doc_lens, vocab: Dict[str, int]) -> "BM25Segment":
+        """由扁平的词项 id 数组与每篇文档长度构建；词项 id 会被重排为字典序。"""
+        doc_lens = np.asarray(doc_lens, dtype=np.int64)
+        terms = sorted(vocab)
+        remap = np.empty(len(terms), dtype=np.int32)
+        remap[np.fromiter((vocab[t] for t in terms), dtype=np.int64, count=len(terms))] = np.arange(len(terms), dtype=np.int32)
+        flat_ids = remap[np.asarray(flat_ids, dtype=np.int64)] if len(terms) else np.asarray(flat_ids, dtype=np.int32)
+        indptr, doc_ids, tfs = _postings_from_ids(flat_ids, doc_lens, len(terms))
+        # 不再额外保留 term -> id 的 dict：按字典序排列的 terms 数组上二分查找即可，大词表时省下可观的内存
+        return cls(
+            np.array(terms, dtype=str) if terms else np.zeros(0, dtype="<U1"),
+            indptr, doc_ids, tfs, doc_lens.astype(np.float32), list(keys),
+        )
+
+    # ---------------- 持久化 ---------------- #
+    _ARRAYS = ("terms", "indptr", "doc_ids", "tfs", "doc_len", "keys")
+
+    def save(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        for name in self._ARRAYS:
+            arr = getattr(self, name)
+            if name == "keys":
+                arr = np.array(list(arr), dtype=str) if len(arr) else np.zeros(0, dtype="<U1")
+            np.save(os.path.join(directory, f"{name}.npy"), np.asarray(arr), allow_pickle=False)
+        if self.alive is not None:
+            np.save(os.path.join(directory, "alive.npy"), np.asarray(self.alive, dtype=bool), allow_pickle=False)
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "format": SEGMENT_FORMAT,
+                "n_docs": self.n_docs,
+                "n_terms": int(self.terms.shape[0]),
+                "tombstones": self.alive is not None,
+            }, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "BM25Segment":
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != SEGMENT_FORMAT:
+            raise ValueError(f"unsupported BM25 segment format in {directory}")
+        mode = "r" if mmap else None
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mode, allow_pickle=False)
+            for name in cls._ARRAYS
+        }
+        if meta.get("tombstones"):
+            arrays["alive"] = np.load(os.path.join(directory, "alive.npy"), allow_pickle=False)
+        return cls(**arrays)
+
+
+def _postings_from_ids(flat_ids, doc_lens, n_terms: int):
+    """(词项 id 序列, 文档长度) -> term-major CSR 的 (indptr, doc_ids, tfs)。"""
+    n_docs = int(doc_lens.shape[0])
+    if flat_ids.size == 0:
+        return np.zeros(n_terms + 1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    doc_of_token = np.repeat(np.arange(n_docs, dtype=np.int64), doc_lens)
+    # (term, doc) 组合键排序后计数，即得按词项分组、组内按文档升序的 postings
+    pair = flat_ids.astype(np.int64) * max(1, n_docs) + doc_of_token
+    uniq, counts = np.unique(pair, return_counts=True)
+    terms = uniq // max(1, n_docs)
+    doc_ids = (uniq % max(1, n_docs)).astype(np.int32)
+    indptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(terms, minlength=n_terms), out=indptr[1:])
+    return indptr, doc_ids, counts.astype(np.float32)
+
+
+def _gather_ranges(starts, ends):
+    """把若干 [start, end) 区间展开为一个下标数组（向量化，无 Python 循环）。"""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64), lengths
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return offsets + np.arange(total, dtype=np.int64), lengths
+
+
+class BM25Index:
+    """
+    稀疏矩阵 BM25：查询时只展开查询词项的 postings，构造 (查询 × 词项) 与 (词项 × 文档) 两个稀疏矩阵，
+    一次稀疏乘法得到整批查询的得分，再用 argpartition 取 top-k，避免对全量得分排序。
+
+    idf 使用非负形式 log(1 + (N - df + 0.5) / (df + 0.5))，不需要 rank_bm25 的 epsilon 下限修正。
+    """
+
+    def __init__(self, segments: List[BM25Segment], k1: float = 1.5, b: float = 0.75):
+        self.segments = [s for s in segments if s.n_docs > 0]
+        self.k1 = k1
+        self.b = b
+        self._refresh_stats()
+
+    def _refresh_stats(self) -> None:
+        self.n_docs = sum(s.n_docs for s in self.segments)
+        total = sum(s.total_len for s in self.segments)
+        self.avgdl = (total / self.n_docs) if self.n_docs else 0.0
+        self._offsets = []
+        off = 0
+        for s in self.segments:
+            self._offsets.append(off)
+            off += s.n_docs
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    @property
+    def n_alive(self) -> int:
+        return sum(s.n_alive for s in self.segments)
+
+    def with_segments(self, segments: List[BM25Segment]) -> "BM25Index":
+        return BM25Index(segments, k1=self.k1, b=self.b)
+
+    def tombstone(self, predicate, only_uids: Optional[Iterable[int]] = None) -> "BM25Index":
+        """
+        返回新快照：predicate(sources 数组) -> bool 掩码，命中的文档被打上墓碑。
+        only_uids 非空时只处理这些段。原快照不受影响，正在进行的查询可以继续使用。
+        """
+        only = None if only_uids is None else set(only_uids)
+        out = []
+        for seg in self.segments:
+            if only is not None and seg.uid not in only:
+                out.append(seg)
+                continue
+            hit = predicate(seg.sources())
+            if not hit.any():
+                out.append(seg)
+                continue
+            alive = np.ones(seg.n_docs, dtype=bool) if seg.alive is None else np.array(seg.alive, dtype=bool)
+            alive &= ~hit
+            out.append(seg.with_alive(alive))
+        return self.with_segments(out)
+
+    def without_sources(self, sources: Iterable[str], only_uids: Optional[Iterable[int]] = None) -> "BM25Index":
+        wanted = np.array(sorted(set(sources)), dtype=str)
+        if wanted.size == 0:
+            return self
+        return self.tombstone(lambda src: np.isin(src, wanted), only_uids=only_uids)
+
+    def without_source_prefix(self, prefix: str) -> "BM25Index":
+        return self.tombstone(lambda src: np.char.startswith(src, prefix))
+
+    def _idf(self, terms: List[str]) -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        n = self.n_docs
+        for t in terms:
+            df = 0
+            for s in self.segments:
+                tid = s.term_id(t)
+                if tid >= 0:
+                    df += s.df(tid)
+            out[t] = math.log(1.0 + (n - df + 0.5) / (df + 0.5)) if df else 0.0
+        return out
+
+    def _score_segments(self, queries: List[List[str]]):
+        """逐段计算 (查询 × 文档) 的稀疏得分矩阵，返回 [(段偏移, csr_matrix)]。"""
+        n_q = len(queries)
+        if not n_q or not self.n_docs:
+            return []
+        terms = sorted({t for q in queries for t in q})
+        idf = self._idf(terms)
+        terms = [t for t in terms if idf[t] > 0]
+        if not terms:
+            return []
+        col = {t: i for i, t in enumerate(terms)}
+        # 查询矩阵：重复出现的查询词按次数计（与 rank_bm25 的 get_scores 一致）
+        rows, cols = [], []
+        for qi, q in enumerate(queries):
+            for t in q:
+                j = col.get(t)
+                if j is not None:
+                    rows.append(qi)
+                    cols.append(j)
+        qmat = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n_q, len(terms))
+        )
+        idf_arr = np.array([idf[t] for t in terms], dtype=np.float32)
+        k1, b, avgdl = self.k1, self.b, (self.avgdl or 1.0)
+        out = []
+        for seg, off in zip(self.segments, self._offsets):
+            tids = np.array([seg.term_id(t) for t in terms], dtype=np.int64)
+            present = tids >= 0
+            starts = np.zeros(len(terms), dtype=np.int64)
+            ends = np.zeros(len(terms), dtype=np.int64)
+            starts[present] = seg.indptr[tids[present]]
+            ends[present] = seg.indptr[tids[present] + 1]
+            idx, lengths = _gather_ranges(starts, ends)
+            if idx.size == 0:
+                continue
+            docs = np.asarray(seg.doc_ids[idx])
+            if seg.alive is not None:
+                live = seg.alive[docs]
+                idx, docs = idx[live], docs[live]
+                lengths = np.bincount(np.repeat(np.arange(len(terms)), lengths)[live], minlength=len(terms))
+                if idx.size == 0:
+                    continue
+            tf = np.asarray(seg.tfs[idx], dtype=np.float32)
+            dl = np.asarray(seg.doc_len[docs], dtype=np.float32)
+            idf_vec = np.repeat(idf_arr, lengths)
+            weights = idf_vec * tf * (k1 + 1.0) / (tf + k1 * (1.0 - b + b * dl / avgdl))
+            indptr = np.concatenate(([0], np.cumsum(lengths)))
+            wmat = sparse.csr_matrix((weights, docs, indptr), shape=(len(terms), seg.n_docs))
+            out.append((off, (qmat @ wmat).tocsr()))
+        return out
+
+    def score_batch(self, queries: List[List[str]]):
+        """返回 (len(queries), n_docs) 的稠密得分矩阵。"""
+        scores = np.zeros((len(queries), self.n_docs), dtype=np.float32)
+        for off, mat in self._score_segments(queries):
+            scores[:, off:off + mat.shape[1]] = mat.toarray()
+        return scores
+
+    def key_at(self, doc: int) -> str:
+        for seg, off in zip(reversed(self.segments), reversed(self._offsets)):
+            if doc >= off:
+                return seg.key(doc - off)
+        raise IndexError(doc)
+
+    def search_batch(self, queries: List[List[str]], top_k: int = 100) -> List[List[Tuple[str, float]]]:
+        """批量检索：每个查询返回按得分降序的 [(key, score)]，只包含得分 > 0 的文档。"""
+        per_segment = self._score_segments(queries)
+        results: List[List[Tuple[str, float]]] = []
+        for qi in range(len(queries)):
+            # 只在非零得分的候选上做 top-k，不物化 n_docs 长度的稠密向量
+            docs_parts, score_parts = [], []
+            for off, mat in per_segment:
+                lo, hi = mat.indptr[qi], mat.indptr[qi + 1]
+                docs_parts.append(mat.indices[lo:hi].astype(np.int64) + off)
+                score_parts.append(mat.data[lo:hi])
+            if not docs_parts:
+                results.append([])
+                continue
+            docs = np.concatenate(docs_parts)
+            vals = np.concatenate(score_parts)
+            keep = vals > 0
+            docs, vals = docs[keep], vals[keep]
+            top = topk_indices(vals, top_k, tiebreak=docs)
+            results.append([(self.key_at(int(docs[i])), float(vals[i])) for i in top])
+        return results
+
+    def search(self, query_tokens: List[str], top_k: int = 100) -> List[Tuple[str, float]]:
+        return self.search_batch([query_tokens], top_k=top_k)[0]
+
+
+def merge_segments(segments: Sequence[BM25Segment]) -> BM25Segment:
+    """
+    把若干段合并为一个：词表取并集（仍按字典序），丢弃墓碑文档，文档顺序按段顺序保持不变。
+    全部向量化：postings 按 (词项, 新文档号) 排序后重建 CSR。
+    """
+    terms = np.unique(np.concatenate([np.asarray(s.terms) for s in segments])) if segments else np.zeros(0, dtype="<U1")
+    term_parts, doc_parts, tf_parts, len_parts, keys = [], [], [], [], []
+    base = 0
+    for seg in segments:
+        alive = np.ones(seg.n_docs, dtype=bool) if seg.alive is None else np.asarray(seg.alive, dtype=bool)
+        new_id = np.cumsum(alive, dtype=np.int64) - 1 + base
+        gmap = np.searchsorted(terms, np.asarray(seg.terms))
+        term_of = np.repeat(gmap, np.diff(np.asarray(seg.indptr)))
+        docs = np.asarray(seg.doc_ids)
+        keep = alive[docs]
+        term_parts.append(term_of[keep])
+        doc_parts.append(new_id[docs[keep]])
+        tf_parts.append(np.asarray(seg.tfs)[keep])
+        len_parts.append(np.asarray(seg.doc_len)[alive])
+        keys.extend(str(k) for k in np.asarray(seg.keys)[alive])
+        base += int(alive.sum())
+    if base == 0:
+        return BM25Segment.build([], [])
+    term_of = np.concatenate(term_parts)
+    doc_ids = np.concatenate(doc_parts)
+    tfs = np.concatenate(tf_parts).astype(np.float32)
+    order = np.lexsort((doc_ids, term_of))
+    term_of, doc_ids, tfs = term_of[order], doc_ids[order].astype(np.int32), tfs[order]
+    counts = np.bincount(term_of, minlength=terms.shape[0])
+    # 只剩墓碑文档引用的词项直接丢掉
+    used = counts > 0
+    terms, counts = terms[used], counts[used]
+    indptr = np.zeros(terms.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return BM25Segment(terms, indptr, doc_ids, tfs, np.concatenate(len_parts).astype(np.float32), keys)
+
+
+def plan_merge(segments: Sequence[BM25Segment], max_dead_ratio: float = 0.1) -> List[BM25Segment]:
+    """
+    分层合并策略：最大段以外的所有小段合并成一个；最大段只有在墓碑比例超过 max_dead_ratio，
+    或其它段合计已达到它的一半时才参与合并，避免每次小批量写入都重写整个大段。
+    返回需要合并的段（少于 2 个且无墓碑时返回空列表）。
+    """
+    if not segments:
+        return []
+    largest = max(segments, key=lambda s: s.n_docs)
+    rest = [s for s in segments if s is not largest]
+    rest_docs = sum(s.n_docs for s in rest)
+    dead = 1.0 - largest.n_alive / max(1, largest.n_docs)
+    chosen = list(segments) if (dead > max_dead_ratio or rest_docs * 2 >= largest.n_docs) else rest
+    if len(chosen) < 2 and not any(s.alive is not None for s in chosen):
+        return []
+    return chosen
+
+
+def topk_indices(row, k: int, tiebreak=None):
+    """argpartition 取前 k 个下标并按得分降序排列：O(n + k log k)。"""
+    n = row.shape[0]
+    if n == 0 or k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < n:
+        part = np.argpartition(-row, k - 1)[:k]
+    else:
+        part = np.arange(n)
+    # 得分相同按文档下标升序，结果可复现
+    secondary = part if tiebreak is None else tiebreak[part]
+    return part[np.lexsort((secondary, -row[part]))]
+
+
+# ---------------- 索引目录：多代快照 + CURRENT 指针 ---------------- #
+def save_indexes(root: str, indexes: Dict[str, BM25Index], meta: Optional[dict] = None) -> str:
+    """
+    把若干命名索引（如 files / chunks）写入 root 下新的一代目录，再原子地更新 CURRENT 指针。
+    正在映射旧代文件的进程不受影响；旧代目录尽力删除（Windows 上被映射的文件会删除失败，下次再清理）。
+    meta（如分词器版本）写入 index.json，加载时用于判断兼容性。返回新一代的名称。
+    """
+    os.makedirs(root, exist_ok=True)
+    gen = f"gen-{time.time_ns()}"
+    gen_dir = os.path.join(root, gen)
+    for name, index in indexes.items():
+        for i, seg in enumerate(index.segments):
+            seg.save(os.path.join(gen_dir, name, f"seg-{i:04d}"))
+        os.makedirs(os.path.join(gen_dir, name), exist_ok=True)
+    with open(os.path.join(gen_dir, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(meta or {}, f)
+    tmp = os.path.join(root, f"CURRENT.{os.getpid()}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(gen)
+    os.replace(tmp, os.path.join(root, "CURRENT"))
+    for entry in os.listdir(root):
+        if entry.startswith("gen-") and entry != gen:
+            shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+    return gen
+
+
+def current_generation(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, "CURRENT"), "r", encoding="utf-8") as f:
+            gen = f.read().strip()
+        return gen or None
+    except OSError:
+        return None
+
+
+def load_indexes(root: str, names: Sequence[str], mmap: bool = True, meta: Optional[dict] = None) -> Optional[Dict[str, BM25Index]]:
+    """按 CURRENT 指针以内存映射方式打开各命名索引；任何一个缺失，或与期望的 meta 不一致时返回 None。"""
+    gen = current_generation(root)
+    if not gen:
+        return None
+    out: Dict[str, BM25Index] = {}
+    try:
+        if meta is not None:
+            with open(os.path.join(root, gen, "index.json"), "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            if any(stored.get(k) != v for k, v in meta.items()):
+                return None
+        for name in names:
+            base = os.path.join(root, gen, name)
+            seg_dirs = sorted(d for d in os.listdir(base) if d.startswith("seg-"))
+            out[name] = BM25Index([BM25Segment.load(os.path.join(base, d), mmap=mmap) for d in seg_dirs])
+    except (OSError, ValueError):
+        return None
+    return out
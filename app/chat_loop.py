@@ -2,7 +2,7 @@ from typing import Dict, List
 
 from app.agent_router import detect_intent
 from app.agent_tools import tool_rag_answer, tool_reading_card, tool_compare_papers
-from app.qwen_api import qwen_chat
+from app.qwen_api import chat_temperature, qwen_chat
 
 
 def run_chat_round(messages: List[Dict]) -> Dict:
@@ -47,7 +47,7 @@ def run_chat_round(messages: List[Dict]) -> Dict:
         "默认身份是‘论文与项目知识库助手’，可以调用速读卡/论文对比/知识库问答等工作流。"
         "回答要简洁；涉及事实时建议说明依据或提示用户去‘速读卡/对比’模式获取引用。"
     )
-    reply = qwen_chat(system_prompt=system, user_prompt=user_msg)
+    reply = qwen_chat(system_prompt=system, user_prompt=user_msg, temperature=chat_temperature())
     return {"role": "assistant", "content": reply}
 
 
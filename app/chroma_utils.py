@@ -1,198 +1,529 @@
 import os
 import hashlib
-import re
-from typing import List, Tuple, Callable, Optional
+import logging
+import threading
+import time
+from typing import Iterable, Iterator, List, Set, Tuple, Callable, Optional, Union
 
 import chromadb
-from chromadb.utils import embedding_functions
+import numpy as np
 from pypdf import PdfReader
-try:
-    from rank_bm25 import BM25Okapi
-except Exception:
-    BM25Okapi = None
-try:
-    from openai import OpenAI as _OpenAIClient
-except Exception:
-    _OpenAIClient = None
 
-
-# 初始化 Chroma 数据库（使用新架构 PersistentClient）
+from app import bm25_index, sharding, vector_store
+from app.tokenizer import TokenIdBuffer, Vocabulary, TOKENIZER_VERSION, tokenize
+from app.settings import get_setting, get_bool, get_float, get_int
+from app.chunking import (
+    LEGACY_SIGNATURE,
+    chunk_params,
+    chunker_signature,
+    configured_signature,
+    iter_chunks,
+    iter_paragraphs,
+    pin_signature,
+    pinned_signature,
+    split_text,
+)
+from app.extractors import PDF_CHAIN_EXTRACTOR, extract_pdf
+from app.doc_cache import file_sha256, get_parsed, parse_cached
+from app.embeddings import (
+    get_embedder,
+    embed_query,
+    embedding_space,
+    embed_cache_stats,
+    _embed_texts_cached,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# 默认集合：检索、/ingest 与建库脚本共用；其元数据中的 chunker 决定本进程的切分配置
+DEFAULT_COLLECTION = "resume_mvp"
+
+# 进程级 Chroma 句柄池：client 按目录只打开一次，集合句柄按 (client, 集合名, 向量空间) 缓存，
+# 集合是否为空由写入事件维护，查询热路径上不再有 get_or_create / count 的 SQLite 往返
+_chroma_clients = {}
+_collection_handles = {}
+_collection_empty = {}
+_chroma_lock = threading.Lock()
+# 本进程内索引写入（/ingest、BM25 增量、重建）的计数；与磁盘上的 BM25 代一起组成检索结果缓存的版本号
+_index_version = {"local": 0, "disk": None, "checked_at": 0.0}
+
+
+# 初始化向量库：默认 Chroma PersistentClient；VECTOR_BACKEND=numpy 时使用进程内的内存映射精确检索（app/vector_store.py）
 def init_chroma(persist_directory: str = "./data/chroma_db"):
-    os.makedirs(persist_directory, exist_ok=True)
-    client = chromadb.PersistentClient(path=persist_directory)
+    backend = get_setting("VECTOR_BACKEND", "chroma").lower()
+    if backend == "numpy" and vector_store.available():
+        persist_directory = get_setting("VECTOR_STORE_PATH", "./data/vector_store")
+    key = (backend, os.path.abspath(persist_directory))
+    client = _chroma_clients.get(key)
+    if client is not None:
+        return client
+    with _chroma_lock:
+        client = _chroma_clients.get(key)
+        if client is None:
+            os.makedirs(persist_directory, exist_ok=True)
+            if backend == "numpy" and vector_store.available():
+                client = vector_store.NumpyVectorClient(persist_directory, fp16=get_bool("VECTOR_STORE_FP16", False))
+            else:
+                client = chromadb.PersistentClient(path=persist_directory)
+            _chroma_clients[key] = client
     return client
 
 
-def _get_embedding_function():
-    """
-    返回一个可调用的 embedding 函数（本地或远程）。
+def reset_collection_handles() -> None:
+    """丢弃缓存的集合句柄与空集合标记（例如在外部删除 data/chroma_db 之后）。"""
+    with _chroma_lock:
+        _collection_handles.clear()
+        _collection_empty.clear()
+
 
-    优先读取环境变量 USE_REMOTE_EMBEDDINGS=1 时使用 DashScope 的 OpenAI 兼容 Embedding 接口：
-      - QWEN_EMBED_MODEL (默认 text-embedding-v4)
-      - DASHSCOPE_API_KEY
-    否则回退为本地 SentenceTransformers（all-MiniLM-L6-v2）。
+def _get_or_create(client: chromadb.Client, collection_name: str):
+    """
+    取物理集合；配置了 SHARD_STRATEGY / SHARD_COUNT 时返回分片包装（app/sharding.py），
+    对调用方接口不变。分片包装按 (client, 集合名) 复用，避免重复扫描分片列表。
+    """
+    cfg = sharding.shard_config()
+    if cfg is None:
+        return client.get_or_create_collection(name=collection_name)
+    key = (id(client), collection_name, "shards", cfg["strategy"], cfg["count"])
+    coll = _collection_handles.get(key)
+    if coll is None:
+        with _chroma_lock:
+            coll = _collection_handles.get(key)
+            if coll is None:
+                coll = sharding.ShardedCollection(client, collection_name, cfg["strategy"], cfg["count"])
+                _collection_handles[key] = coll
+    return coll
+
+
+def collection_is_empty(client: chromadb.Client, collection_name: str) -> bool:
     """
-    use_remote = os.getenv("USE_REMOTE_EMBEDDINGS", "").strip() in {"1", "true", "True"}
-    # 尝试从本地配置读取开关与Key/模型
-    cfg = None
+    集合是否为空。非空是单调的（本项目不删除集合），一旦观察到非空或本进程写入过就不再 count；
+    为空时每次都复核一次，以便看到其它进程（如索引脚本）的写入。
+    """
+    key = (id(client), collection_name)
+    if _collection_empty.get(key) is False:
+        return False
     try:
-        from . import config_local as _cfg1  # python -m 运行
-        cfg = _cfg1
+        empty = _get_or_create(client, collection_name).count() == 0
     except Exception:
-        try:
-            import config_local as _cfg2  # 直接运行
-            cfg = _cfg2
-        except Exception:
-            cfg = None
-    if not use_remote and cfg is not None:
-        use_remote = str(getattr(cfg, "USE_REMOTE_EMBEDDINGS", "")).strip() in {"1", "true", "True"}
-
-    if use_remote and _OpenAIClient is not None:
-        api_key = os.getenv("DASHSCOPE_API_KEY", "").strip()
-        model = os.getenv("QWEN_EMBED_MODEL", "").strip()
-        dim_env = os.getenv("QWEN_EMBED_DIM", "").strip()
-        if not api_key and cfg is not None:
-            api_key = str(getattr(cfg, "DASHSCOPE_API_KEY", "")).strip()
-        if not model and cfg is not None:
-            model = str(getattr(cfg, "QWEN_EMBED_MODEL", "qwen-v4")).strip() or "qwen-v4"
-        if not dim_env and cfg is not None:
-            dim_env = str(getattr(cfg, "QWEN_EMBED_DIM", "")).strip()
-        if not model:
-            model = "qwen-v4"
-        base_url = "https://dashscope.aliyuncs.com/compatible-mode/v1"
-        if api_key and model:
-            dim = int(dim_env) if dim_env.isdigit() else None
-            return _DashscopeEmbeddingFunction(api_key=api_key, model=model, base_url=base_url, dimensions=dim)
-    # 本地 ST 嵌入
-    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name="all-MiniLM-L6-v2")
-
-
-class _DashscopeEmbeddingFunction:
-    """OpenAI 兼容模式的 DashScope Embedding 封装，适配 Chroma 的 embedding_function 接口。"""
-
-    def __init__(self, api_key: str, model: str, base_url: str, dimensions: Optional[int] = None):
-        self._client = _OpenAIClient(api_key=api_key, base_url=base_url) if _OpenAIClient else None
-        self._model = model
-        self._dim = dimensions
-
-    # Chroma 会调用 .name() 来判断冲突
-    def name(self) -> str:
-        return f"dashscope-embedding::{self._model}"
-
-    def __call__(self, input):  # Chroma expects signature (self, input)
-        if not self._client:
-            raise RuntimeError("OpenAI client not available for DashScope embedding")
-        # 兼容传入单条或批量
-        texts = input if isinstance(input, list) else [input]
-        # DashScope 限制 batch <= 10
-        batch_size = 10
-        all_embeddings: list[list[float]] = []
-        for i in range(0, len(texts), batch_size):
-            chunk = texts[i:i+batch_size]
-            kwargs = {"model": self._model, "input": chunk, "encoding_format": "float"}
-            if self._dim is not None:
-                kwargs["dimensions"] = self._dim
-            resp = self._client.embeddings.create(**kwargs)
-            all_embeddings.extend([item.embedding for item in resp.data])
-        return all_embeddings
-
-    # 兼容可能的接口期望
-    def embed_documents(self, texts: list[str]) -> list[list[float]]:
-        return self.__call__(texts)
-
-    def embed_query(self, text: str) -> list[float]:
-        return self.__call__([text])[0]
+        return True
+    if not empty:
+        _collection_empty[key] = False
+    return empty
+
+
+def _mark_collection_written(client: chromadb.Client, collection_name: str) -> None:
+    _collection_empty[(id(client), collection_name)] = False
+    bump_index_version()
+
+
+def bump_index_version() -> None:
+    with _chroma_lock:
+        _index_version["local"] += 1
+
+
+def index_version(data_dir: str = "data") -> tuple:
+    """
+    检索结果缓存的失效键：(本进程写入计数, 磁盘上 CURRENT 指向的 BM25 索引代)。
+    只读 CURRENT 指针（按 BM25_RELOAD_CHECK_SECONDS 节流），不加载也不构建 BM25，纯向量检索的请求不受影响；
+    索引脚本重建后切换 CURRENT，其它进程在节流间隔内感知到新一代。
+    """
+    now = time.monotonic()
+    if now - _index_version["checked_at"] >= BM25_RELOAD_CHECK_SECONDS:
+        _index_version["disk"] = bm25_index.current_generation(_bm25_index_root(data_dir))
+        _index_version["checked_at"] = now
+    return _index_version["local"], _index_version["disk"]
+
+
+def _open_collection(client: chromadb.Client, collection_name: str, embedder, stamp: bool = False):
+    """
+    打开集合并校验向量空间：集合元数据 embed_space 记录建库时的 embedder，
+    与当前 embedder 不一致时直接报错，避免把不同模型的向量混在一起。
+    向量总是由我们计算后传入，因此不再把 embedding_function 交给 Chroma。
+    校验通过的句柄按 (client, 集合名, 向量空间) 缓存，之后直接复用。
+    """
+    space = embedding_space(embedder)
+    handle_key = (id(client), collection_name, space)
+    collection = _collection_handles.get(handle_key)
+    if collection is not None and (not stamp or (collection.metadata or {}).get("embed_space")):
+        return collection
+    collection = _get_or_create(client, collection_name)
+    meta = dict(collection.metadata or {})
+    recorded = meta.get("embed_space")
+    if recorded and recorded != space:
+        raise RuntimeError(
+            f"collection '{collection_name}' was built with embedding space '{recorded}', "
+            f"but the current embedder produces '{space}'. Switch the embedding config back, "
+            "or delete data/chroma_db and reindex."
+        )
+    if not recorded and stamp:
+        meta["embed_space"] = space
+        collection.modify(metadata=meta)
+    _collection_handles[handle_key] = collection
+    return collection
+
+
+def _check_or_record_dim(collection, collection_name: str, dim: int, record: bool = False) -> None:
+    """集合元数据 embed_dim 记录向量维度；维度不一致时在查询/写入前快速失败。"""
+    meta = dict(collection.metadata or {})
+    recorded = meta.get("embed_dim")
+    if recorded is None:
+        if record:
+            meta["embed_dim"] = int(dim)
+            collection.modify(metadata=meta)
+        return
+    if int(recorded) != int(dim):
+        raise ValueError(
+            f"collection '{collection_name}' stores {recorded}-dim vectors, got a {dim}-dim vector; "
+            "check EMBED_TRUNCATE_DIM / QWEN_EMBED_DIM or reindex."
+        )
+
+
+def chunk_id(source_path: str, chunk_index: int) -> str:
+    """chunk 的稳定 id：与 BM25 chunk key f"{source}::{idx}" 一一对应。"""
+    return hashlib.sha1(f"{source_path}::{chunk_index}".encode("utf-8")).hexdigest()
 
 
 # 导入文档并向量化
-def add_documents(client: chromadb.Client, collection_name: str, documents: List[Tuple[str, str]]):
+def add_documents(client: chromadb.Client, collection_name: str, documents: Iterable[Tuple[str, Union[str, Iterable[str]]]]):
     """
     将文档加入到 `collection_name` 中。
 
-    documents: List of (source_path, content)
+    documents: (source_path, content) 的可迭代对象（可以是生成器，逐篇读取）；content 可以是整段文本，
+    也可以是页 / 段落文本的迭代器，后者边读边切分。chunk 按 ADD_DOCUMENTS_BATCH 个一批向量化并写入，
+    内存中只保留一批，而不是整个语料的 chunk、向量与元数据。
     """
-    collection = client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=_get_embedding_function()
-    )
+    embedding_fn = get_embedder()
+    collection = _open_collection(client, collection_name, embedding_fn, stamp=True)
 
     if not documents:
         return collection
 
+    batch_size = get_int("ADD_DOCUMENTS_BATCH", 256) or 256
+    _pin_collection_chunker(collection, collection_name, record=True)
+    token_window, max_chars, overlap = chunk_params()
     ids: List[str] = []
     texts: List[str] = []
     metadatas = []
-    for source_path, content in documents:
-        title = _extract_title_from_content_or_file(source_path, content)
-        chunks = _split_text_into_chunks(content)
-        for idx, chunk in enumerate(chunks):
-            raw_id = f"{source_path}::{idx}"
-            stable_id = hashlib.sha1(raw_id.encode("utf-8")).hexdigest()
-            ids.append(stable_id)
-            texts.append(chunk)
-            metadatas.append({"source": source_path, "chunk_index": idx, "title": title})
 
-    if texts:
+    def flush() -> None:
+        if not texts:
+            return
+        # 先经由内容寻址缓存获得向量，未变化的 chunk 不再调用 embedding
+        embeddings = _embed_texts_cached(embedding_fn, texts)
+        _check_or_record_dim(collection, collection_name, len(embeddings[0]), record=True)
         # 使用 upsert 防止重复写入
-        collection.upsert(documents=texts, metadatas=metadatas, ids=ids)
+        collection.upsert(documents=texts, embeddings=embeddings, metadatas=metadatas, ids=ids)
+        _mark_collection_written(client, collection_name)
+        ids.clear()
+        texts.clear()
+        metadatas.clear()
+
+    for source_path, content in documents:
+        if isinstance(content, str):
+            title = _extract_title_from_content_or_file(source_path, content)
+            parts = iter_paragraphs(content)
+        else:
+            title = _extract_title_from_content_or_file(source_path, "")
+            parts = content
+        for idx, chunk, start, end in iter_chunks(parts, max_chars, overlap, token_window):
+            ids.append(chunk_id(source_path, idx))
+            texts.append(chunk)
+            metadatas.append({"source": source_path, "chunk_index": idx, "title": title, "char_start": start, "char_end": end})
+            if len(texts) >= batch_size:
+                flush()
+    flush()
     return collection
 
 
+def _pin_collection_chunker(collection, collection_name: str, record: bool = False) -> None:
+    """
+    集合元数据 chunker 记录建库时的切分配置，之后本进程的切分（向量写入与 BM25）一律按记录进行，
+    保证同一 chunk id 在两边是同一段文本。没有记录的非空集合来自 user-023 之前，按旧的字符切分处理。
+    只有写入路径（record=True，即 add_documents）把推断出的配置写回集合元数据；检索与 BM25 只读。
+    """
+    meta = dict(collection.metadata or {})
+    recorded = meta.get("chunker")
+    if recorded is None:
+        try:
+            has_data = collection.count() > 0
+        except Exception:
+            has_data = False
+        recorded = LEGACY_SIGNATURE if has_data else configured_signature()
+        if record:
+            meta["chunker"] = recorded
+            collection.modify(metadata=meta)
+    if pinned_signature() == recorded:
+        return
+    pin_signature(recorded)
+    configured = configured_signature()
+    if recorded != configured:
+        logger.warning(
+            "collection '%s' was chunked with '%s'; keeping it instead of the configured '%s'. "
+            "Delete the collection and reindex to switch.",
+            collection_name, recorded, configured,
+        )
+
+
+def ensure_chunker_pinned() -> None:
+    """切分前（如构建 BM25 索引）先按默认集合记录的配置固定切分方式；只读集合元数据，不写回。"""
+    if pinned_signature() is not None:
+        return
+    try:
+        _pin_collection_chunker(_get_or_create(init_chroma(), DEFAULT_COLLECTION), DEFAULT_COLLECTION)
+    except Exception:
+        pass
+
+
 # 查询向量数据库
 def query_documents(client: chromadb.Client, collection_name: str, query: str, n_results: int = 3):
-    collection = client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=_get_embedding_function(),
-    )
+    collection = _open_collection(client, collection_name, get_embedder())
+    # 查询向量经 LRU 缓存后直接交给 Chroma，重复查询不再触发 embedding
+    query_vec = embed_query(query)
+    _check_or_record_dim(collection, collection_name, len(query_vec))
     results = collection.query(
-        query_texts=[query],
+        query_embeddings=[query_vec],
         n_results=n_results,
         include=["documents", "metadatas", "distances"],
     )
     return results
 
 
-def load_text_documents_from_dir(directory: str) -> List[Tuple[str, str]]:
+def _normalize_source(path: str) -> str:
+    path = path.replace("\\", "/")
+    while path.startswith("./"):
+        path = path[2:]
+    return path
+
+
+def source_where_clause(allowed_sources, max_terms: Optional[int] = None) -> Optional[dict]:
     """
-    加载目录中的 .txt / .md / .pdf 文本。
-    返回 [(source_path, content), ...]
+    把来源集合转成 Chroma 的 where={"source": {"$in": [...]}}，让 ANN 只在预过滤后的子集上搜索。
+    元数据里的 source 可能是 / 或 \\ 分隔（取决于建库平台），两种写法都放进 $in。
+    集合超过 CHROMA_WHERE_IN_MAX 时返回 None，由调用方退回后过滤。
     """
-    if not os.path.isdir(directory):
+    if not allowed_sources:
+        return None
+    if max_terms is None:
+        max_terms = get_int("CHROMA_WHERE_IN_MAX", 1000)
+    variants = set()
+    for p in allowed_sources:
+        norm = _normalize_source(p)
+        variants.update((p, norm, norm.replace("/", "\\")))
+    if len(variants) > max_terms:
+        return None
+    return {"source": {"$in": sorted(variants)}}
+
+
+def _vector_candidates(collection, query_vec, depth: int, where: Optional[dict] = None):
+    if depth <= 0:
         return []
+    res = collection.query(
+        query_embeddings=[query_vec],
+        n_results=depth,
+        where=where,
+        include=["documents", "metadatas", "distances"],
+    )
+    ids = (res.get("ids") or [[]])[0]
+    docs = (res.get("documents") or [[]])[0]
+    metas = (res.get("metadatas") or [[]])[0]
+    dists = (res.get("distances") or [[]])[0]
+    return [
+        (cid, docs[i], metas[i] or {}, dists[i] if i < len(dists) else None)
+        for i, cid in enumerate(ids)
+    ]
+
+
+def _distance_space(collection) -> str:
+    """集合的距离空间：Chroma 记录在 configuration（旧版为 metadata 的 hnsw:space），默认 l2；numpy 后端与分片集合同为 l2。"""
+    try:
+        space = (collection.configuration or {}).get("hnsw", {}).get("space")
+        if space:
+            return str(space)
+    except Exception:
+        pass
+    return str((collection.metadata or {}).get("hnsw:space") or "l2")
+
+
+def distance_space(client: chromadb.Client, collection_name: str) -> str:
+    return _distance_space(_open_collection(client, collection_name, get_embedder()))
+
+
+def distance_to_similarity(dist, space: str = "l2") -> Optional[float]:
+    """
+    向量距离 -> 余弦相似度，不截断，跨后端可比。
+    l2 为平方 L2 距离（Chroma 默认，numpy 后端相同），对单位向量 d = 2 - 2cos，即 cos = 1 - d/2；
+    cosine / ip 空间的距离为 1 - cos（ip 对单位向量同理）。
+    """
+    if dist is None:
+        return None
+    d = float(dist)
+    return 1.0 - d / 2.0 if space == "l2" else 1.0 - d
+
+
+def _vector_item(cid, text, meta, dist, space: str = "l2") -> dict:
+    return {
+        "id": cid,
+        "text": text,
+        "source": meta.get("source", "unknown"),
+        "title": meta.get("title"),
+        "chunk_index": meta.get("chunk_index"),
+        "score": distance_to_similarity(dist, space),
+        "rrf": 0.0,
+    }
+
+
+def hybrid_query(
+    client: chromadb.Client,
+    collection_name: str,
+    query: str,
+    n_results: int = 6,
+    vector_depth: int = 30,
+    bm25_depth: int = 30,
+    rrf_k: int = 60,
+    allowed_sources: Optional[set] = None,
+    data_dir: str = "data",
+) -> List[dict]:
+    """
+    chunk 级混合检索：向量 top-N 与 chunk BM25 top-N 各自独立取候选，
+    按真实名次做 RRF（score = Σ 1/(rrf_k + rank)），经稳定 chunk id 对齐后返回 n_results 条。
+    只出现在 BM25 侧的 chunk 通过 collection.get(ids=...) 补齐正文；Chroma 中不存在的（尚未向量化）跳过。
+    allowed_sources 非空时只在这些来源上做向量检索（文件级 BM25 预过滤）：优先下推为 Chroma 的 where 子句，
+    集合过大时才退回为多取候选 + 按规范化路径后过滤。结果不足 n_results 时用不带过滤的向量检索补齐。
+    """
+    collection = _open_collection(client, collection_name, get_embedder())
+    query_vec = embed_query(query)
+    _check_or_record_dim(collection, collection_name, len(query_vec))
+    space = _distance_space(collection)
+    where = source_where_clause(allowed_sources)
+    if allowed_sources and where is None:
+        allowed_norm = {_normalize_source(p) for p in allowed_sources}
+        hits = _vector_candidates(collection, query_vec, vector_depth * 4)
+        hits = [h for h in hits if _normalize_source(h[2].get("source", "")) in allowed_norm][:vector_depth]
+    else:
+        hits = _vector_candidates(collection, query_vec, vector_depth, where=where)
+    candidates: dict = {}
+    for vec_rank, (cid, text, meta, dist) in enumerate(hits, start=1):
+        item = candidates[cid] = _vector_item(cid, text, meta, dist, space)
+        item["vec_rank"] = vec_rank
+        item["rrf"] = 1.0 / (rrf_k + vec_rank)
+
+    hits = bm25_chunk_search_batch([query], data_dir=data_dir, top_k=bm25_depth)[0]
+    for rank, (key, bm25_score) in enumerate(hits, start=1):
+        source, _, idx = key.rpartition("::")
+        cid = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        item = candidates.get(cid)
+        if item is None:
+            item = candidates[cid] = {
+                "id": cid,
+                "text": None,
+                "source": source,
+                "title": None,
+                "chunk_index": int(idx) if idx.isdigit() else None,
+                "score": None,
+                "rrf": 0.0,
+            }
+        item["bm25_rank"] = rank
+        item["bm25_score"] = float(bm25_score)
+        item["rrf"] += 1.0 / (rrf_k + rank)
+
+    fused = sorted(candidates.values(), key=lambda x: (-x["rrf"], x["id"]))
+    out: List[dict] = []
+    pos = 0
+    while len(out) < n_results and pos < len(fused):
+        window = fused[pos:pos + (n_results - len(out))]
+        pos += len(window)
+        missing = [c["id"] for c in window if c["text"] is None]
+        if missing:
+            got = collection.get(ids=missing, include=["documents", "metadatas"])
+            by_id = {i: (d, m or {}) for i, d, m in zip(got.get("ids") or [], got.get("documents") or [], got.get("metadatas") or [])}
+            for c in window:
+                if c["text"] is None and c["id"] in by_id:
+                    c["text"], meta = by_id[c["id"]]
+                    c["title"] = meta.get("title")
+        out.extend(c for c in window if c["text"] is not None)
+
+    if len(out) < n_results and allowed_sources:
+        # 预过滤子集太小：用全库向量检索补齐，保证返回 k 条
+        seen = {c["id"] for c in out}
+        for cid, text, meta, dist in _vector_candidates(collection, query_vec, n_results + len(seen)):
+            if len(out) >= n_results:
+                break
+            if cid in seen:
+                continue
+            item = _vector_item(cid, text, meta, dist, space)
+            item["fallback"] = True
+            out.append(item)
+    return out
 
+
+def iter_text_documents_from_dir(
+    directory: str,
+    exclude: Optional[Set[str]] = None,
+    read_pdf: Optional[Callable[[str], Optional[str]]] = None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    逐个产出目录中 .txt / .md / .pdf 的 (source_path, content)；exclude 中的路径跳过。
+    read_pdf(path) 返回调用方已解析好的 PDF 正文（None 表示没有，照常经解析缓存读取）。
+    add_documents 与 BM25 构建边读边处理，同一时刻只有一篇文档的全文在内存中。
+    """
+    if not os.path.isdir(directory):
+        return
     supported_exts = {".txt", ".md", ".pdf"}
-    loaded: List[Tuple[str, str]] = []
     for root, _, files in os.walk(directory):
         for fname in files:
             ext = os.path.splitext(fname)[1].lower()
             if ext not in supported_exts:
                 continue
             fpath = os.path.join(root, fname)
+            if exclude and fpath in exclude:
+                continue
             try:
                 if ext == ".pdf":
-                    text = _extract_text_from_pdf(fpath)
+                    # PDF 解析结果按文件 sha256 缓存，未变化的文件不再走提取链
+                    text = read_pdf(fpath) if read_pdf else None
+                    if text is None:
+                        text, _ = load_pdf_cached(fpath)
                 else:
                     with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
                         text = f.read().strip()
-                if text:
-                    loaded.append((fpath, text))
             except Exception:
                 # 忽略坏文件
                 continue
-    return loaded
+            if text:
+                yield fpath, text
 
 
-def _extract_text_from_pdf(path: str) -> str:
+def load_text_documents_from_dir(directory: str, exclude: Optional[Set[str]] = None) -> List[Tuple[str, str]]:
+    """
+    加载目录中的 .txt / .md / .pdf 文本。
+    返回 [(source_path, content), ...]
+    """
+    return list(iter_text_documents_from_dir(directory, exclude))
+
+
+# PDF 解析统一走 app/extractors.py 的 pypdf → pdfminer → PyMuPDF → OCR 链，与 /ingest 共用解析缓存条目
+PDF_EXTRACTOR = PDF_CHAIN_EXTRACTOR
+
+
+def _extract_pdf_text_and_title(path: str) -> Tuple[str, Optional[str]]:
+    """一次打开 PDF，同时取正文与元数据标题。"""
+    text, title, _ = extract_pdf(path)
+    return text, title
+
+
+def load_pdf_cached(path: str, sha: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """PDF 的 (text, title)，经由按文件 sha256 + 提取器版本寻址的磁盘缓存。"""
     try:
-        reader = PdfReader(path)
-        texts: List[str] = []
-        for page in reader.pages:
-            t = page.extract_text() or ""
-            if t.strip():
-                texts.append(t)
-        return "\n".join(texts).strip()
-    except Exception:
-        return ""
+        sha = sha or file_sha256(path)
+    except OSError:
+        return _extract_pdf_text_and_title(path)
+    return parse_cached(sha, PDF_EXTRACTOR, lambda: _extract_pdf_text_and_title(path))
+
+
+def _extract_text_from_pdf(path: str) -> str:
+    return load_pdf_cached(path)[0]
 
 
 def _extract_title_from_content_or_file(path: str, content: str) -> str:
@@ -221,6 +552,10 @@ def _extract_title_from_content_or_file(path: str, content: str) -> str:
                     return (s[:120] + ("…" if len(s) > 120 else ""))
             return name
         if ext == ".pdf":
+            # 解析缓存里已有该文件时直接用其中的元数据标题，不再为标题单独打开 PDF
+            hit = get_parsed(file_sha256(path), PDF_EXTRACTOR) if os.path.isfile(path) else None
+            if hit is not None:
+                return hit[1] or name
             try:
                 reader = PdfReader(path)
                 meta = getattr(reader, "metadata", None)
@@ -246,134 +581,293 @@ def _normalize_ws(text: str) -> str:
 
 
 # ---------------- Hybrid Retrieval (BM25 pre-filter) ---------------- #
+# 文件级与 chunk 级 BM25 索引（稀疏矩阵实现，见 app/bm25_index.py）。
+# 索引在建库时持久化到 BM25_INDEX_DIR，进程启动后以内存映射方式打开；磁盘上没有索引时才回退为现场构建。
+# /ingest 写入的新文档进入内存中的小段，立即可检索；小段与墓碑由后台线程合并并落盘。
 _bm25_state = {
-    "paths": None,  # type: ignore
-    "tokens": None,
-    "bm25": None,
+    "index": None,  # type: ignore
+    "generation": None,  # 当前加载 / 写出的索引代，None 表示尚未落盘
+    "checked_at": 0.0,
+    # 上次落盘之后的增量操作 [(sources, file_seg, chunk_seg)]：其它进程更新了 CURRENT 时重放到新索引上
+    "pending": [],
+    # 合并进行期间发生的删除，合并完成后补打到合并结果上
+    "deleted_during_merge": [],
+}
+_bm25_chunk_state = {
+    "index": None,  # type: ignore  keys: f"{path}::{idx}"
+}
+_bm25_build_lock = threading.Lock()
+_bm25_merge_lock = threading.Lock()
+_bm25_merge_state = {
+    "timer": None,
+    "merges": 0,
+    "last_merge_seconds": 0.0,
 }
 
+# rank map 只返回前若干名；更靠后的排名在 RRF 中的贡献可以忽略
+BM25_RANK_DEPTH = 1000
+# 检查 CURRENT 指针是否被索引脚本更新的最小间隔（秒）
+BM25_RELOAD_CHECK_SECONDS = 1.0
+
 
 def _simple_tokenize(text: str) -> List[str]:
-    text = text.lower()
-    # keep words and numbers, split on non-alphanum
-    return [t for t in re.split(r"[^a-z0-9_]+", text) if t]
+    # ASCII 词 + CJK 二元组，见 app/tokenizer.py
+    return tokenize(text)
 
 
-def bm25_select_sources(query: str, data_dir: str = "data", top_n_files: int = 50) -> List[str]:
-    if BM25Okapi is None:
-        return []
-    # Build or reuse BM25 over file-level documents
-    if not _bm25_state["bm25"]:
-        docs = load_text_documents_from_dir(data_dir)
-        paths = [p for p, _ in docs]
-        tokens = [_simple_tokenize(txt) for _, txt in docs]
-        if not tokens:
-            return []
-        try:
-            bm25 = BM25Okapi(tokens)
-        except Exception:
-            return []
-        _bm25_state["paths"] = paths
-        _bm25_state["tokens"] = tokens
-        _bm25_state["bm25"] = bm25
-
-    bm25 = _bm25_state["bm25"]
-    paths = _bm25_state["paths"] or []
-    if not bm25 or not paths:
-        return []
-    scores = bm25.get_scores(_simple_tokenize(query))
-    ranked = sorted(zip(paths, scores), key=lambda x: x[1], reverse=True)
-    selected = [p for p, s in ranked[: top_n_files] if s > 0]
-    return selected
-def bm25_rank_map(query: str, data_dir: str = "data") -> dict:
-    """Return {path: 1-based-rank} for current BM25 index; empty if BM25 unavailable."""
-    if BM25Okapi is None:
-        return {}
-    if not _bm25_state["bm25"]:
-        # build once
-        _ = bm25_select_sources("__warm__", data_dir=data_dir)
-    bm25 = _bm25_state["bm25"]
-    paths = _bm25_state["paths"] or []
-    if not bm25 or not paths:
-        return {}
-    scores = bm25.get_scores(_simple_tokenize(query))
-    ranked = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
-    rank_map = {}
-    rank = 1
-    for idx, sc in ranked:
-        if sc <= 0:
-            break
-        rank_map[paths[idx]] = rank
-        rank += 1
-    return rank_map
+def _bm25_meta() -> dict:
+    # 写入每一代索引的元信息；分词规则或 chunk 切分配置变化后旧索引不再被加载，而是重建
+    ensure_chunker_pinned()
+    return {"tokenizer": TOKENIZER_VERSION, "chunker": chunker_signature()}
 
 
-# ---------------- BM25 over chunks + helpers ---------------- #
-_bm25_chunk_state = {
-    "keys": None,   # [f"{path}::{idx}", ...]
-    "tokens": None, # tokenized chunk texts
-    "bm25": None,
-}
+def _bm25_index_root(data_dir: str = "data") -> str:
+    return get_setting("BM25_INDEX_DIR") or os.path.join(data_dir, "bm25_index")
 
 
-def _build_bm25_chunks(data_dir: str = "data") -> bool:
-    docs = load_text_documents_from_dir(data_dir)
-    if not docs:
-        return False
-    keys: List[str] = []
-    tokens: List[List[str]] = []
+def _build_bm25_segments(docs: Iterable[Tuple[str, str]]):
+    """(source, text) 的可迭代对象 -> (文件级段, chunk 级段)；词项直接编码为共享词表下的整数 id，不保留字符串列表。"""
+    vocab = Vocabulary()
+    file_buf = TokenIdBuffer(vocab)
+    chunk_buf = TokenIdBuffer(vocab)
+    file_keys: List[str] = []
+    chunk_keys: List[str] = []
     for path, text in docs:
+        file_keys.append(path)
+        file_buf.add(text)
         for idx, chunk in enumerate(_split_text_into_chunks(text)):
-            keys.append(f"{path}::{idx}")
-            tokens.append(_simple_tokenize(chunk))
-    if not tokens:
+            chunk_keys.append(f"{path}::{idx}")
+            chunk_buf.add(chunk)
+    return (
+        bm25_index.BM25Segment.build_from_ids(file_keys, np.frombuffer(file_buf.ids, dtype=np.int32), file_buf.lengths, vocab.ids),
+        bm25_index.BM25Segment.build_from_ids(chunk_keys, np.frombuffer(chunk_buf.ids, dtype=np.int32), chunk_buf.lengths, vocab.ids),
+    )
+
+
+def _install_bm25_indexes(files_index, chunks_index, generation: Optional[str]) -> None:
+    _bm25_state["index"] = files_index
+    _bm25_chunk_state["index"] = chunks_index
+    _bm25_state["generation"] = generation
+    _bm25_state["checked_at"] = time.monotonic()
+
+
+def _apply_bm25_ops(files_index, chunks_index, ops):
+    for sources, file_seg, chunk_seg in ops:
+        files_index = files_index.without_sources(sources)
+        chunks_index = chunks_index.without_sources(sources)
+        if file_seg is not None:
+            files_index = files_index.with_segments(files_index.segments + [file_seg])
+            chunks_index = chunks_index.with_segments(chunks_index.segments + [chunk_seg])
+    return files_index, chunks_index
+
+
+def rebuild_bm25_indexes(
+    data_dir: str = "data",
+    exclude: Optional[Set[str]] = None,
+    read_pdf: Optional[Callable[[str], Optional[str]]] = None,
+) -> bool:
+    """
+    重新解析 data_dir 并写出新一代 BM25 索引（供 scripts/index_incremental.py 在建库时调用）。
+    exclude 为本次解析失败、需要跳过的文件路径；read_pdf 见 iter_text_documents_from_dir。
+    已有索引中不在 data_dir 下的 source（/ingest 上传的 upload:// 与 URL）原样保留。
+    写入完成后原子地切换 CURRENT 指针，其它进程会在下一次查询时映射新索引。
+    """
+    if not bm25_index.available():
         return False
-    try:
-        bm25 = BM25Okapi(tokens) if BM25Okapi else None
-    except Exception:
-        bm25 = None
-    _bm25_chunk_state["keys"] = keys
-    _bm25_chunk_state["tokens"] = tokens
-    _bm25_chunk_state["bm25"] = bm25
-    return bm25 is not None
+    root = _bm25_index_root(data_dir)
+    with _bm25_build_lock:
+        file_seg, chunk_seg = _build_bm25_segments(iter_text_documents_from_dir(data_dir, exclude=exclude, read_pdf=read_pdf))
+        files_segs, chunks_segs = [file_seg], [chunk_seg]
+        existing = None
+        if _bm25_state["index"] is not None:
+            existing = {"files": _bm25_state["index"], "chunks": _bm25_chunk_state["index"]}
+        else:
+            existing = bm25_index.load_indexes(root, ("files", "chunks"), meta=_bm25_meta())
+        if existing is not None:
+            prefix = os.path.join(data_dir, "")
+            for name, segs in (("files", files_segs), ("chunks", chunks_segs)):
+                kept = existing[name].without_source_prefix(prefix)
+                if kept.n_alive:
+                    segs.append(bm25_index.merge_segments(kept.segments))
+        files_index = bm25_index.BM25Index(files_segs)
+        chunks_index = bm25_index.BM25Index(chunks_segs)
+        if not files_index.n_docs:
+            return False
+        gen = bm25_index.save_indexes(root, {"files": files_index, "chunks": chunks_index}, meta=_bm25_meta())
+        _install_bm25_indexes(files_index, chunks_index, gen)
+        _bm25_state["pending"] = []
+    bump_index_version()
+    return True
+
+
+def _ensure_bm25_indexes(data_dir: str = "data") -> bool:
+    if not bm25_index.available():
+        return False
+    now = time.monotonic()
+    if _bm25_state["index"] is not None and now - _bm25_state["checked_at"] < BM25_RELOAD_CHECK_SECONDS:
+        return True
+    with _bm25_build_lock:
+        root = _bm25_index_root(data_dir)
+        gen = bm25_index.current_generation(root)
+        if _bm25_state["index"] is not None and (gen is None or gen == _bm25_state["generation"]):
+            _bm25_state["checked_at"] = now
+            return True
+        if gen is not None:
+            loaded = bm25_index.load_indexes(root, ("files", "chunks"), meta=_bm25_meta())
+            if loaded is not None:
+                # 其它进程写出了新一代：映射它，再重放本进程尚未落盘的增量
+                files_index, chunks_index = _apply_bm25_ops(loaded["files"], loaded["chunks"], _bm25_state["pending"])
+                _install_bm25_indexes(files_index, chunks_index, gen)
+                return True
+        if _bm25_state["index"] is not None:
+            _bm25_state["checked_at"] = now
+            return True
+        # 磁盘上还没有索引：现场构建一次并落盘，之后的进程直接映射
+        file_seg, chunk_seg = _build_bm25_segments(iter_text_documents_from_dir(data_dir))
+        files_index = bm25_index.BM25Index([file_seg])
+        chunks_index = bm25_index.BM25Index([chunk_seg])
+        if not files_index.n_docs:
+            return False
+        try:
+            gen = bm25_index.save_indexes(root, {"files": files_index, "chunks": chunks_index}, meta=_bm25_meta())
+        except OSError:
+            gen = None
+        _install_bm25_indexes(files_index, chunks_index, gen)
+    return True
+
+
+def bm25_add_documents(docs: List[Tuple[str, str]], data_dir: str = "data") -> bool:
+    """
+    把新文档写入内存中的增量段，立即可检索；同名 source 的旧文档先打墓碑（即覆盖）。
+    段合并与落盘在后台按 BM25_MERGE_DELAY_SECONDS 去抖执行。
+    """
+    if not bm25_index.available() or not docs:
+        return False
+    _ensure_bm25_indexes(data_dir)
+    file_seg, chunk_seg = _build_bm25_segments(docs)
+    _bm25_apply(data_dir, [src for src, _ in docs], file_seg, chunk_seg)
+    return True
 
 
-def bm25_chunk_rank_map(query: str, data_dir: str = "data") -> dict:
-    if BM25Okapi is None:
+def bm25_delete_sources(sources: List[str], data_dir: str = "data") -> bool:
+    """按 source 删除（墓碑），合并时真正清除。"""
+    if not bm25_index.available() or not sources:
+        return False
+    _ensure_bm25_indexes(data_dir)
+    _bm25_apply(data_dir, list(sources), None, None)
+    return True
+
+
+def _bm25_apply(data_dir: str, sources: List[str], file_seg, chunk_seg) -> None:
+    with _bm25_build_lock:
+        files_index = _bm25_state["index"] or bm25_index.BM25Index([])
+        chunks_index = _bm25_chunk_state["index"] or bm25_index.BM25Index([])
+        op = (sources, file_seg, chunk_seg)
+        files_index, chunks_index = _apply_bm25_ops(files_index, chunks_index, [op])
+        _bm25_state["index"] = files_index
+        _bm25_chunk_state["index"] = chunks_index
+        _bm25_state["pending"].append(op)
+        if _bm25_merge_lock.locked():
+            _bm25_state["deleted_during_merge"].extend(sources)
+    bump_index_version()
+    _schedule_bm25_merge(data_dir)
+
+
+def _schedule_bm25_merge(data_dir: str) -> None:
+    delay = get_float("BM25_MERGE_DELAY_SECONDS", 2.0)
+    with _bm25_build_lock:
+        timer = _bm25_merge_state["timer"]
+        if timer is not None:
+            timer.cancel()
+        timer = threading.Timer(delay, _merge_bm25_indexes, args=(data_dir,))
+        timer.daemon = True
+        _bm25_merge_state["timer"] = timer
+        timer.start()
+
+
+def _merge_bm25_indexes(data_dir: str = "data") -> None:
+    """后台合并：在快照上合并选中的段，换入时补打合并期间的删除，并保留期间新增的段，最后落盘。"""
+    with _bm25_merge_lock:
+        try:
+            t0 = time.perf_counter()
+            with _bm25_build_lock:
+                snapshot = {"files": _bm25_state["index"], "chunks": _bm25_chunk_state["index"]}
+                n_pending = len(_bm25_state["pending"])
+                _bm25_state["deleted_during_merge"] = []
+            if snapshot["files"] is None:
+                return
+            merged = {}
+            for name, index in snapshot.items():
+                chosen = bm25_index.plan_merge(index.segments)
+                if chosen:
+                    merged[name] = ({s.uid for s in chosen}, bm25_index.merge_segments(chosen))
+            with _bm25_build_lock:
+                current = {"files": _bm25_state["index"], "chunks": _bm25_chunk_state["index"]}
+                late_deletes = _bm25_state["deleted_during_merge"]
+                for name, (uids, seg) in merged.items():
+                    index = current[name]
+                    rest = [s for s in index.segments if s.uid not in uids]
+                    index = index.with_segments([seg] + rest)
+                    current[name] = index.without_sources(late_deletes, only_uids={seg.uid})
+                _bm25_state["index"] = current["files"]
+                _bm25_chunk_state["index"] = current["chunks"]
+                _bm25_state["deleted_during_merge"] = []
+            gen = bm25_index.save_indexes(_bm25_index_root(data_dir), current, meta=_bm25_meta())
+            with _bm25_build_lock:
+                _bm25_state["generation"] = gen
+                del _bm25_state["pending"][:n_pending]
+            _bm25_merge_state["merges"] += 1
+            _bm25_merge_state["last_merge_seconds"] = time.perf_counter() - t0
+        except Exception as e:
+            logger.warning("BM25 background merge failed: %s", e)
+
+
+def bm25_index_stats() -> dict:
+    files_index = _bm25_state["index"]
+    chunks_index = _bm25_chunk_state["index"]
+    return {
+        "generation": _bm25_state["generation"],
+        "file_segments": len(files_index.segments) if files_index is not None else 0,
+        "chunk_segments": len(chunks_index.segments) if chunks_index is not None else 0,
+        "chunks": chunks_index.n_alive if chunks_index is not None else 0,
+        "unpersisted_ops": len(_bm25_state["pending"]),
+        "merges": _bm25_merge_state["merges"],
+        "last_merge_seconds": round(_bm25_merge_state["last_merge_seconds"], 4),
+    }
+
+
+def _rank_map(hits: List[Tuple[str, float]]) -> dict:
+    return {key: rank for rank, (key, _) in enumerate(hits, start=1)}
+
+
+def bm25_select_sources(query: str, data_dir: str = "data", top_n_files: int = 50) -> List[str]:
+    if not _ensure_bm25_indexes(data_dir):
+        return []
+    hits = _bm25_state["index"].search(_simple_tokenize(query), top_k=top_n_files)
+    return [p for p, _ in hits]
+
+
+def bm25_rank_map(query: str, data_dir: str = "data", top_k: int = BM25_RANK_DEPTH) -> dict:
+    """Return {path: 1-based-rank} for current BM25 index; empty if BM25 unavailable."""
+    if not _ensure_bm25_indexes(data_dir):
         return {}
-    if not _bm25_chunk_state["bm25"]:
-        ok = _build_bm25_chunks(data_dir)
-        if not ok:
-            return {}
-    bm25 = _bm25_chunk_state["bm25"]
-    keys: List[str] = _bm25_chunk_state["keys"] or []
-    if not bm25 or not keys:
+    return _rank_map(_bm25_state["index"].search(_simple_tokenize(query), top_k=top_k))
+
+
+# ---------------- BM25 over chunks + helpers ---------------- #
+def bm25_chunk_rank_map(query: str, data_dir: str = "data", top_k: int = BM25_RANK_DEPTH) -> dict:
+    if not _ensure_bm25_indexes(data_dir):
         return {}
-    scores = bm25.get_scores(_simple_tokenize(query))
-    # rank chunks by score
-    ranked = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
-    rank_map = {}
-    rank = 1
-    for idx, sc in ranked:
-        if sc <= 0:
-            break
-        rank_map[keys[idx]] = rank
-        rank += 1
-    return rank_map
-
-
-def _split_text_into_chunks(text: str, max_chars: int = 1200, overlap: int = 200) -> List[str]:
-    text = text.strip()
-    if not text:
-        return []
-    chunks: List[str] = []
-    start = 0
-    n = len(text)
-    while start < n:
-        end = min(start + max_chars, n)
-        chunk = text[start:end]
-        chunks.append(chunk)
-        if end >= n:
-            break
-        start = max(0, end - overlap)
-    return chunks
\ No newline at end of file
+    return _rank_map(_bm25_chunk_state["index"].search(_simple_tokenize(query), top_k=top_k))
+
+
+def bm25_chunk_search_batch(queries: List[str], data_dir: str = "data", top_k: int = 100) -> List[List[Tuple[str, float]]]:
+    """一次稀疏矩阵乘法为多个查询打分，返回每个查询的 [(chunk_key, score)]。"""
+    if not _ensure_bm25_indexes(data_dir):
+        return [[] for _ in queries]
+    return _bm25_chunk_state["index"].search_batch([_simple_tokenize(q) for q in queries], top_k=top_k)
+
+
+def _split_text_into_chunks(text: str) -> List[str]:
+    # 切分规则见 app/chunking.py（字符滑窗或按 embedder 分词器计 token）
+    return split_text(text)
@@ -0,0 +1,245 @@
+import re
+import threading
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from app.settings import get_int, get_setting
+
+
+# 流式切分：输入为页 / 段落文本的迭代器（原样拼接即为全文），惰性产出 (chunk_index, text, start, end)，
+# start/end 为 chunk 在拼接全文中的字符偏移。chunk id 仍为 sha1(source::chunk_index)，同一输入与配置下确定。
+#
+# - 字符模式（CHUNK_TOKENS=0）：max_chars=1200 / overlap=200 的滑窗，与旧版 _split_text_into_chunks 输出逐字一致；
+# - token 模式（CHUNK_TOKENS=auto 或正整数）：按当前 embedder 的分词器限制每个 chunk 的 token 数，
+#   auto 取模型窗口（all-MiniLM-L6-v2 为 256，减去 [CLS]/[SEP]），保证 chunk 不会在 embedding 时被静默截断。
+#   embedder 没有本地分词器（如 DashScope 远程模型）时 auto 退回字符模式。
+# 集合元数据 chunker 记录建库时的切分配置，打开集合后按记录的配置切分（pin_signature），
+# 升级或修改 CHUNK_* 不会让新写入的 chunk、BM25 索引与已有向量在同一 chunk id 下错位；换配置需删除集合后重建。
+
+MAX_CHARS = 1200
+OVERLAP = 200
+# token 模式下一个窗口最多取多少字符交给分词器（每个 wordpiece 平均远少于 8 个字符）
+_CHARS_PER_TOKEN_CAP = 8
+
+# token_end(text, max_tokens) -> 前 max_tokens 个 token 结束处的字符偏移；不足 max_tokens 时返回 len(text)
+TokenEnd = Callable[[str, int], int]
+
+# user-023 之前的切分配置：没有 chunker 记录、但已有数据的集合按它处理
+LEGACY_SIGNATURE = f"chars:{MAX_CHARS}/{OVERLAP}"
+
+_window_lock = threading.Lock()
+_window_state = {
+    "key": None,
+    "window": None,  # type: ignore
+    # 集合元数据中记录的切分配置；设置后切分一律按它进行，向量库与 BM25 的 chunk 边界保持一致
+    "pinned": None,
+}
+
+
+def _hf_fast_token_end(tokenizer) -> TokenEnd:
+    # transformers 的 fast tokenizer（SentenceTransformer.tokenizer）
+    def token_end(text: str, max_tokens: int) -> int:
+        offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, truncation=False)["offset_mapping"]
+        return len(text) if len(offsets) <= max_tokens else int(offsets[max_tokens - 1][1])
+
+    return token_end
+
+
+def _tokenizers_token_end(tokenizer) -> TokenEnd:
+    # tokenizers.Tokenizer（ONNX 后端）；复制一份并关闭截断 / 补齐，避免影响 embedding 用的实例
+    from tokenizers import Tokenizer
+
+    tok = Tokenizer.from_str(tokenizer.to_str())
+    tok.no_truncation()
+    tok.no_padding()
+
+    def token_end(text: str, max_tokens: int) -> int:
+        offsets = tok.encode(text, add_special_tokens=False).offsets
+        return len(text) if len(offsets) <= max_tokens else int(offsets[max_tokens - 1][1])
+
+    return token_end
+
+
+def embedder_token_window(embedder) -> Optional[Tuple[TokenEnd, int]]:
+    """当前 embedder 的 (token_end, 模型窗口内可用的 token 数)；没有本地分词器时返回 None。"""
+    inner = getattr(embedder, "_inner", None)
+    if inner is not None:  # Matryoshka 截断包装
+        return embedder_token_window(inner)
+    model = getattr(embedder, "_model", None)
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is not None and getattr(tokenizer, "is_fast", False):
+        limit = int(getattr(model, "max_seq_length", 0) or 256)
+        return _hf_fast_token_end(tokenizer), max(8, limit - 2)
+    tokenizer = getattr(embedder, "tokenizer", None)
+    if tokenizer is not None and hasattr(tokenizer, "to_str"):
+        trunc = getattr(tokenizer, "truncation", None) or {}
+        limit = int(trunc.get("max_length") or 256)
+        return _tokenizers_token_end(tokenizer), max(8, limit - 2)
+    return None
+
+
+def active_token_window() -> Optional[Tuple[TokenEnd, int]]:
+    """按 CHUNK_TOKENS 配置解析 token 模式；字符模式返回 None。结果按 (配置, embedder) 缓存。"""
+    setting = get_setting("CHUNK_TOKENS", "auto").lower()
+    if setting in ("", "0", "off", "chars"):
+        return None
+    from app.embeddings import embedder_name, get_embedder
+
+    try:
+        embedder = get_embedder()
+    except Exception:
+        return None
+    key = (setting, embedder_name(embedder))
+    with _window_lock:
+        if _window_state["key"] != key:
+            try:
+                window = embedder_token_window(embedder)
+            except Exception:
+                window = None
+            if window is not None and setting != "auto" and setting.isdigit():
+                window = (window[0], min(int(setting), window[1]))
+            _window_state["key"], _window_state["window"] = key, window
+        return _window_state["window"]
+
+
+def configured_signature() -> str:
+    """按当前 CHUNK_* 配置得到的切分标识（不考虑集合中记录的配置）。"""
+    window = active_token_window()
+    overlap = get_int("CHUNK_OVERLAP", OVERLAP)
+    if window is None:
+        return f"chars:{get_int('CHUNK_MAX_CHARS', MAX_CHARS)}/{overlap}"
+    from app.embeddings import embedder_name, get_embedder
+
+    return f"tokens:{embedder_name(get_embedder())}:{window[1]}/{overlap}"
+
+
+def pin_signature(signature: Optional[str]) -> None:
+    """固定本进程使用的切分配置（取自集合元数据 chunker）；None 表示按当前配置。"""
+    with _window_lock:
+        _window_state["pinned"] = signature or None
+
+
+def pinned_signature() -> Optional[str]:
+    with _window_lock:
+        return _window_state["pinned"]
+
+
+def chunker_signature() -> str:
+    """实际生效的切分标识，写入 BM25 索引元信息与集合元数据；变化后旧索引需要重建。"""
+    return pinned_signature() or configured_signature()
+
+
+def chunk_params() -> Tuple[Optional[Tuple[TokenEnd, int]], int, int]:
+    """
+    实际生效的 (token_window, max_chars, overlap)。已固定切分配置时按记录的标识还原：
+    chars:<max_chars>/<overlap> 或 tokens:<embedder>:<max_tokens>/<overlap>。
+    """
+    signature = pinned_signature()
+    if signature is None:
+        return active_token_window(), get_int("CHUNK_MAX_CHARS", MAX_CHARS) or MAX_CHARS, get_int("CHUNK_OVERLAP", OVERLAP)
+    kind, _, rest = signature.partition(":")
+    size, _, overlap = rest.rpartition(":")[2].partition("/")
+    overlap_n = int(overlap) if overlap.isdigit() else OVERLAP
+    if kind == "tokens":
+        window = active_token_window()
+        if window is None:
+            from app.embeddings import get_embedder
+
+            try:
+                window = embedder_token_window(get_embedder())
+            except Exception:
+                window = None
+        if window is not None and size.isdigit():
+            return (window[0], int(size)), MAX_CHARS, overlap_n
+        # 当前 embedder 没有本地分词器，无法还原 token 切分：退回字符模式（写入时会提示重建）
+        return None, MAX_CHARS, overlap_n
+    return None, int(size) if size.isdigit() else MAX_CHARS, overlap_n
+
+
+def iter_paragraphs(text: str) -> Iterator[str]:
+    """把整段文本按段落（空行）切成流，段落连同分隔符一起产出，拼接后与原文一致。"""
+    pos = 0
+    for m in re.finditer(r"\n\s*\n", text):
+        yield text[pos:m.end()]
+        pos = m.end()
+    if pos < len(text):
+        yield text[pos:]
+
+
+def iter_chunks(
+    parts: Iterable[str],
+    max_chars: Optional[int] = None,
+    overlap: Optional[int] = None,
+    token_window: Optional[Tuple[TokenEnd, int]] = None,
+) -> Iterator[Tuple[int, str, int, int]]:
+    """
+    惰性切分：缓冲区只保留当前 chunk 起点之后的文本，不需要整篇文档常驻。
+    首尾空白不计入（与旧版先 strip 再切分一致）。
+    """
+    max_chars = max_chars or get_int("CHUNK_MAX_CHARS", MAX_CHARS) or MAX_CHARS
+    overlap = get_int("CHUNK_OVERLAP", OVERLAP) if overlap is None else overlap
+
+    def chunk_end(buf: str, rel: int) -> int:
+        if token_window is None:
+            return rel + max_chars
+        token_end, max_tokens = token_window
+        window = buf[rel: rel + max_tokens * _CHARS_PER_TOKEN_CAP]
+        end = token_end(window, max_tokens)
+        if end < len(window):
+            # 退到词边界，避免把一个词的 wordpiece 拆到两个 chunk
+            space = window.rfind(" ", int(end * 0.8), end)
+            if space > 0:
+                end = space
+        return rel + max(1, end)
+
+    def next_start(buf: str, base: int, start: int, end: int) -> int:
+        if token_window is None:
+            return max(start + 1, end - overlap)
+        nxt = max(start + 1, end - min(overlap, (end - start) // 2))
+        # 重叠区从词首开始
+        space = buf.find(" ", nxt - base, end - base)
+        return base + space + 1 if space >= 0 else nxt
+
+    buf = ""
+    base = 0  # buf[0] 在全文中的偏移
+    start: Optional[int] = None
+    idx = 0
+    for part in parts:
+        if not part:
+            continue
+        buf += part
+        if start is None:
+            stripped = buf.lstrip()
+            if not stripped:
+                base += len(buf)
+                buf = ""
+                continue
+            start = base + len(buf) - len(stripped)
+        while True:
+            rel = start - base
+            end_rel = chunk_end(buf, rel)
+            tail = buf[end_rel:]
+            # 后面只剩空白（或还没读到）时无法确定这是不是最后一个 chunk，等待更多输入
+            if not tail or tail.isspace():
+                break
+            yield idx, buf[rel:end_rel], start, base + end_rel
+            idx += 1
+            start = next_start(buf, base, start, base + end_rel)
+            buf = buf[start - base:]
+            base = start
+    if start is None:
+        return
+    buf = buf.rstrip()
+    while start - base < len(buf):
+        rel = start - base
+        end_rel = min(chunk_end(buf, rel), len(buf))
+        yield idx, buf[rel:end_rel], start, base + end_rel
+        idx += 1
+        if end_rel >= len(buf):
+            break
+        start = next_start(buf, base, start, base + end_rel)
+
+
+def split_text(text: str) -> list:
+    """整段文本 -> chunk 文本列表（按实际生效的切分配置）。"""
+    token_window, max_chars, overlap = chunk_params()
+    return [t for _, t, _, _ in iter_chunks(iter_paragraphs(text or ""), max_chars, overlap, token_window)]
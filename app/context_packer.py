@@ -0,0 +1,163 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+from app.settings import get_float, get_int
+from app.tokenizer import tokenize
+
+
+# 把检索到的 chunk 组装成提示词上下文：
+# 1) 同一来源中相邻（chunk_index 连续、带 200 字符重叠）的 chunk 合并成一个片段，重叠部分只保留一次；
+# 2) 与已选片段近似重复的片段丢弃；
+# 3) 按相关性顺序填充 token 预算，放不下的片段在句子 / 空白边界截断；
+# 4) 引用编号按来源分配：同一来源的片段共用一个 [i]，编号顺序即来源首次出现的顺序。
+
+_CJK_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+_SENT_END_RE = re.compile(r"[。！？!?.;；]\s")
+_MAX_OVERLAP = 400
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计 LLM token 数：CJK 字符按 1 个计，其余按 4 个字符 1 个计。"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _overlap_len(a: str, b: str) -> int:
+    """a 的后缀与 b 的前缀的最长重合长度（不超过 _MAX_OVERLAP）。"""
+    limit = min(len(a), len(b), _MAX_OVERLAP)
+    for n in range(limit, 0, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+
+def _shingles(text: str) -> set:
+    toks = tokenize(text)
+    if len(toks) < 3:
+        return set(toks)
+    return {(toks[i], toks[i + 1], toks[i + 2]) for i in range(len(toks) - 2)}
+
+
+def _truncate(text: str, budget: int) -> str:
+    """截断到大约 budget 个 token，优先在句末，其次在空白处。"""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text[:lo]
+    ends = list(_SENT_END_RE.finditer(cut))
+    if ends and ends[-1].end() > lo // 2:
+        return cut[:ends[-1].end()].rstrip()
+    space = cut.rfind(" ", lo // 2)
+    return (cut[:space] if space > 0 else cut).rstrip() + " …"
+
+
+def _merge_spans(sources: List[Dict]) -> List[Dict]:
+    """同一来源中 chunk_index 连续的 chunk 合并；片段的相关性取成员中最靠前的名次。"""
+    groups: Dict[str, List[Tuple[int, Dict]]] = {}
+    spans: List[Tuple[int, Dict]] = []
+    for rank, s in enumerate(sources):
+        if s.get("chunk_index") is None:
+            spans.append((rank, dict(s)))
+            continue
+        groups.setdefault(s.get("source", "unknown"), []).append((rank, s))
+    for items in groups.values():
+        items.sort(key=lambda x: int(x[1]["chunk_index"]))
+        run: List[Tuple[int, Dict]] = []
+        for rank, s in items:
+            if run and int(s["chunk_index"]) == int(run[-1][1]["chunk_index"]) + 1:
+                run.append((rank, s))
+                continue
+            if run:
+                spans.append(_join_run(run))
+            run = [(rank, s)]
+        if run:
+            spans.append(_join_run(run))
+    spans.sort(key=lambda x: x[0])
+    return [s for _, s in spans]
+
+
+def _join_run(run: List[Tuple[int, Dict]]) -> Tuple[int, Dict]:
+    best_rank, best = min(run, key=lambda x: x[0])
+    text = run[0][1].get("text", "") or ""
+    for _, s in run[1:]:
+        nxt = s.get("text", "") or ""
+        text += nxt[_overlap_len(text, nxt):]
+    span = dict(best)
+    span["text"] = text
+    span["chunk_indices"] = [int(s["chunk_index"]) for _, s in run]
+    return best_rank, span
+
+
+def pack_context(
+    sources: List[Dict],
+    token_budget: Optional[int] = None,
+    dedup_threshold: Optional[float] = None,
+) -> Tuple[str, List[Dict]]:
+    """
+    sources 按相关性排好序（build_context 的输出）。返回 (context_text, packed)：
+    packed 为实际放入上下文的片段（按相关性顺序，带 "ref" 编号），调用方据此展示来源，保证与 [i] 一致。
+    token_budget 默认 CONTEXT_TOKEN_BUDGET（3000），dedup_threshold 默认 CONTEXT_DEDUP_JACCARD（0.8）。
+    """
+    if token_budget is None:
+        token_budget = get_int("CONTEXT_TOKEN_BUDGET", 3000) or 0
+    if dedup_threshold is None:
+        dedup_threshold = get_float("CONTEXT_DEDUP_JACCARD", 0.8)
+    min_tail = get_int("CONTEXT_MIN_SPAN_TOKENS", 80) or 0
+
+    packed: List[Dict] = []
+    kept_shingles: List[set] = []
+    refs: Dict[str, int] = {}
+    used = 0
+    for span in _merge_spans(sources):
+        text = (span.get("text") or "").strip()
+        if not text:
+            continue
+        sh = _shingles(text)
+        if sh and any(len(sh & other) / len(sh | other) >= dedup_threshold for other in kept_shingles):
+            continue
+        src = span.get("source", "unknown")
+        display = span.get("title") or src
+        header = 0 if src in refs else estimate_tokens(f"[{len(refs) + 1}] {display}\n") + 1
+        cost = estimate_tokens(text) + 1
+        if token_budget:
+            remaining = token_budget - used - header
+            if cost > remaining:
+                if remaining < min_tail:
+                    continue
+                text = _truncate(text, remaining - 1)
+                cost = estimate_tokens(text) + 1
+        if src not in refs:
+            refs[src] = len(refs) + 1
+        span["text"] = text
+        span["ref"] = refs[src]
+        packed.append(span)
+        kept_shingles.append(sh)
+        used += header + cost
+
+    # 按编号分组输出：同一来源的多个片段放在同一个 [i] 下
+    blocks: Dict[int, List[str]] = {}
+    titles: Dict[int, str] = {}
+    for span in packed:
+        blocks.setdefault(span["ref"], []).append(span["text"])
+        titles.setdefault(span["ref"], span.get("title") or span.get("source", "unknown"))
+    context_text = "\n\n".join(
+        f"[{ref}] {titles[ref]}\n" + "\n…\n".join(blocks[ref]) for ref in sorted(blocks)
+    )
+    return context_text, packed
+
+
+def packed_sources(packed: List[Dict]) -> List[Dict]:
+    """每个引用编号取第一个片段，顺序与 [1][2]... 一致，供结果中的来源列表使用。"""
+    out: List[Dict] = []
+    seen = set()
+    for span in packed:
+        if span["ref"] not in seen:
+            seen.add(span["ref"])
+            out.append(span)
+    return out
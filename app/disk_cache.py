@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+# 待更新访问时间的条目攒到这么多时才在读取路径上写一次库
+_TOUCH_BATCH = 256
+
+
+class DiskCache:
+    """
+    基于 SQLite 的简单键值缓存（value 为 bytes）。
+
+    - 按总字节数做容量上限，超出时按最近访问时间（LRU）淘汰；
+    - 读取不写库：命中条目的访问时间只有比 touch_seconds 更旧时才记一笔，
+      攒到 _TOUCH_BATCH 条或下一次写入 / 淘汰时在同一事务里批量更新；LRU 因此精确到 touch_seconds；
+    - 可选 TTL（秒），过期条目在读取时视为未命中；
+    - 线程安全：同一进程内共用一个连接并加锁，多进程依赖 SQLite 自身的文件锁。
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_seconds: Optional[float] = None, touch_seconds: float = 300.0):
+        self.path = path
+        self.max_bytes = max(0, int(max_bytes))
+        self.ttl_seconds = ttl_seconds
+        self.touch_seconds = max(0.0, float(touch_seconds))
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes_since_evict = 0
+        self._pending_touch: Dict[str, float] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            parent = os.path.dirname(self.path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries(accessed)")
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        now = time.time()
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            conn = self._connect()
+            # SQLite 对参数个数有限制，分批查询
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                marks = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT key, value, created, accessed FROM entries WHERE key IN ({marks})", part
+                ).fetchall()
+                for key, value, created, accessed in rows:
+                    if self.ttl_seconds is not None and now - created > self.ttl_seconds:
+                        continue
+                    found[key] = value
+                    if now - accessed >= self.touch_seconds:
+                        self._pending_touch[key] = now
+            if len(self._pending_touch) >= _TOUCH_BATCH:
+                self._flush_touch_locked(conn)
+                conn.commit()
+        return found
+
+    def _flush_touch_locked(self, conn: sqlite3.Connection) -> None:
+        # 不单独提交：与调用方的写入 / 淘汰同一个事务
+        if self._pending_touch:
+            conn.executemany(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                [(t, k) for k, t in self._pending_touch.items()],
+            )
+            self._pending_touch.clear()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items: Iterable[Tuple[str, bytes]]) -> None:
+        rows: List[Tuple[str, bytes, int, float, float]] = []
+        now = time.time()
+        for key, value in items:
+            rows.append((key, value, len(value), now, now))
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries(key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._flush_touch_locked(conn)
+            conn.commit()
+            self._writes_since_evict += len(rows)
+            if self._writes_since_evict >= 256:
+                self._evict_locked(conn)
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many([(key, value)])
+
+    def evict(self) -> None:
+        with self._lock:
+            self._evict_locked(self._connect())
+
+    def _evict_locked(self, conn: sqlite3.Connection) -> None:
+        self._writes_since_evict = 0
+        self._flush_touch_locked(conn)
+        if self.ttl_seconds is not None:
+            conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            # 淘汰到上限的 90%，避免每次写入都触发淘汰
+            target = int(self.max_bytes * 0.9)
+            to_free = total - target
+            freed = 0
+            victims: List[str] = []
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed ASC"):
+                victims.append(key)
+                freed += size
+                if freed >= to_free:
+                    break
+            conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in victims])
+        conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.commit()
+            self._pending_touch.clear()
+
+    def size_bytes(self) -> int:
+        with self._lock:
+            return int(self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0])
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._flush_touch_locked(self._conn)
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
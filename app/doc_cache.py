@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+from typing import Callable, Optional, Tuple
+
+from app.disk_cache import DiskCache
+from app.settings import get_bool, get_int, get_setting
+
+
+# 解析结果的版本号：提取逻辑（分页拼接、清洗、标题规则）变化时递增，旧条目自然失效
+EXTRACTOR_VERSION = 1
+
+_doc_cache_lock = threading.Lock()
+_doc_cache_state = {
+    "cache": None,  # type: ignore
+    "hits": 0,
+    "misses": 0,
+}
+# (绝对路径, 大小, mtime_ns) -> sha256：同一进程内未变化的文件不重复计算哈希
+_sha_memo = {}
+
+
+def _get_doc_cache() -> Optional[DiskCache]:
+    """按需打开解析文本缓存；DOC_CACHE=0 时关闭。"""
+    if not get_bool("DOC_CACHE", True):
+        return None
+    with _doc_cache_lock:
+        if _doc_cache_state["cache"] is None:
+            path = get_setting("DOC_CACHE_PATH", "./data/.doc_cache.sqlite")
+            max_mb = get_int("DOC_CACHE_MAX_MB", 512) or 512
+            _doc_cache_state["cache"] = DiskCache(path, max_bytes=max_mb * 1024 * 1024)
+        return _doc_cache_state["cache"]
+
+
+def file_sha256(path: str) -> str:
+    """文件内容的 sha256；按 (路径, 大小, mtime) 在进程内记忆。"""
+    try:
+        st = os.stat(path)
+        memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    except OSError:
+        memo_key = None
+    if memo_key is not None:
+        cached = _sha_memo.get(memo_key)
+        if cached:
+            return cached
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    if memo_key is not None:
+        _sha_memo[memo_key] = digest
+    return digest
+
+
+def bytes_sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _key(sha: str, extractor: str) -> str:
+    return f"{extractor}|v{EXTRACTOR_VERSION}|{sha}"
+
+
+def get_parsed(sha: str, extractor: str) -> Optional[Tuple[str, Optional[str]]]:
+    """按 (内容哈希, 提取器) 取缓存的 (text, title)；未命中返回 None。"""
+    cache = _get_doc_cache()
+    if cache is None:
+        return None
+    try:
+        blob = cache.get(_key(sha, extractor))
+    except Exception:
+        blob = None
+    with _doc_cache_lock:
+        if blob is None:
+            _doc_cache_state["misses"] += 1
+        else:
+            _doc_cache_state["hits"] += 1
+    if blob is None:
+        return None
+    try:
+        data = json.loads(zlib.decompress(blob).decode("utf-8"))
+        return data.get("text") or "", data.get("title")
+    except Exception:
+        return None
+
+
+def put_parsed(sha: str, extractor: str, text: str, title: Optional[str] = None) -> None:
+    cache = _get_doc_cache()
+    if cache is None:
+        return
+    blob = zlib.compress(json.dumps({"text": text, "title": title}, ensure_ascii=False).encode("utf-8"), 6)
+    try:
+        cache.set(_key(sha, extractor), blob)
+    except Exception:
+        pass
+
+
+def parse_cached(sha: str, extractor: str, parse: Callable[[], Tuple[str, Optional[str]]]) -> Tuple[str, Optional[str]]:
+    """命中缓存直接返回，否则调用 parse() 并回填；空文本也会缓存，避免反复解析坏文件。"""
+    hit = get_parsed(sha, extractor)
+    if hit is not None:
+        return hit
+    text, title = parse()
+    put_parsed(sha, extractor, text or "", title)
+    return text or "", title
+
+
+def doc_cache_stats() -> dict:
+    with _doc_cache_lock:
+        return {"hits": _doc_cache_state["hits"], "misses": _doc_cache_state["misses"]}
@@ -0,0 +1,657 @@
+import hashlib
+import os
+import math
+import random
+import struct
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from chromadb.utils import embedding_functions
+try:
+    from openai import OpenAI as _OpenAIClient
+except Exception:
+    _OpenAIClient = None
+
+from app.disk_cache import DiskCache
+from app.settings import get_bool, get_float, get_int, get_setting
+
+
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+
+def _embedder_config() -> Tuple:
+    """
+    读取当前 embedding 配置，返回可比较的配置签名：(基础 embedder 配置, 截断维度)。
+
+    EMBED_TRUNCATE_DIM>0 时对任意 embedder 的输出做 Matryoshka 式截断并重新 L2 归一化。
+    """
+    truncate_dim = max(0, get_int("EMBED_TRUNCATE_DIM", 0) or 0)
+    return (_base_embedder_config(), truncate_dim)
+
+
+def _base_embedder_config() -> Tuple:
+    """
+    读取基础 embedder 配置。
+
+    USE_REMOTE_EMBEDDINGS=1 时使用 DashScope 的 OpenAI 兼容 Embedding 接口：
+      - QWEN_EMBED_MODEL (默认 qwen-v4)
+      - QWEN_EMBED_DIM（可选）
+      - DASHSCOPE_API_KEY
+    否则回退为本地 all-MiniLM-L6-v2，LOCAL_EMBED_BACKEND 选择运行方式：
+      - torch（默认）：SentenceTransformers
+      - onnx：ONNX Runtime（同一模型，fp32）
+      - onnx-int8：ONNX Runtime + 动态 int8 量化
+    """
+    use_remote = get_bool("USE_REMOTE_EMBEDDINGS", False)
+    if use_remote and _OpenAIClient is not None:
+        api_key = get_setting("DASHSCOPE_API_KEY", "")
+        model = get_setting("QWEN_EMBED_MODEL", "qwen-v4")
+        dim_env = get_setting("QWEN_EMBED_DIM", "")
+        base_url = get_setting("QWEN_EMBED_BASE_URL", DASHSCOPE_BASE_URL)
+        # 并发批请求数、每秒请求上限（<=0 表示不限速）、429/5xx 的最大重试次数
+        concurrency = max(1, get_int("EMBED_CONCURRENCY", 4) or 1)
+        rps = get_float("EMBED_RPS", 10.0) or 0.0
+        max_retries = max(0, get_int("EMBED_MAX_RETRIES", 5) or 0)
+        if api_key and model:
+            dim = int(dim_env) if dim_env.isdigit() else None
+            return ("dashscope", model, dim, api_key, base_url, concurrency, rps, max_retries)
+    backend = get_setting("LOCAL_EMBED_BACKEND", "torch").lower()
+    if backend in {"onnx", "onnx-int8"}:
+        return ("onnx", "all-MiniLM-L6-v2", backend == "onnx-int8")
+    return ("sentence_transformer", "all-MiniLM-L6-v2")
+
+
+def _build_embedder(config: Tuple):
+    base_config, truncate_dim = config
+    embedder = _build_base_embedder(base_config)
+    if truncate_dim:
+        embedder = _TruncatedEmbeddingFunction(embedder, truncate_dim)
+    return embedder
+
+
+def _build_base_embedder(config: Tuple):
+    kind = config[0]
+    if kind == "dashscope":
+        _, model, dim, api_key, base_url, concurrency, rps, max_retries = config
+        return _DashscopeEmbeddingFunction(
+            api_key=api_key,
+            model=model,
+            base_url=base_url,
+            dimensions=dim,
+            concurrency=concurrency,
+            requests_per_second=rps,
+            max_retries=max_retries,
+        )
+    if kind == "onnx":
+        return _OnnxMiniLMEmbeddingFunction(quantize=config[2])
+    # 本地 ST 嵌入
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=config[1])
+
+
+def embedding_space(embedder) -> str:
+    """
+    向量空间标识：同一标识下的向量可以混用（例如 torch 与 ONNX 运行的同一模型）。
+    集合元数据记录该值，与当前 embedder 不一致时拒绝读写。
+    """
+    space = getattr(embedder, "embedding_space", None)
+    if space:
+        return str(space)
+    model = getattr(embedder, "model_name", None)
+    return f"sentence-transformers/{model}" if model else embedder_name(embedder)
+
+
+class _TruncatedEmbeddingFunction:
+    """
+    Matryoshka 式降维：保留前 dim 维并重新 L2 归一化，适用于远程与本地 embedder。
+    name() / embedding_space 带上维度后缀，与全维向量的缓存和集合互不混用。
+    """
+
+    def __init__(self, inner, dim: int):
+        self._inner = inner
+        self._dim = int(dim)
+        self.embedding_space = f"{embedding_space(inner)}@{self._dim}"
+
+    def name(self) -> str:
+        return f"{embedder_name(self._inner)}@{self._dim}"
+
+    def __call__(self, input):
+        out = []
+        for vec in self._inner(input):
+            head = [float(x) for x in vec[: self._dim]]
+            if len(head) < self._dim:
+                raise ValueError(f"embedder returned {len(head)} dims, cannot truncate to {self._dim}")
+            norm = math.sqrt(sum(x * x for x in head)) or 1.0
+            out.append([x / norm for x in head])
+        return out
+
+
+class _OnnxMiniLMEmbeddingFunction:
+    """
+    通过 ONNX Runtime 运行 all-MiniLM-L6-v2（mean pooling + L2 归一化，与 SentenceTransformers 输出一致）。
+
+    模型文件复用 Chroma 内置 ONNX 模型的下载目录；quantize=True 时首次使用会生成动态 int8 量化模型
+    （需要 onnx 包），量化后的向量与 fp32 近似但不完全相同，因此 name() 不同（缓存分开），
+    embedding_space 相同（可查询已有集合）。
+    """
+
+    embedding_space = "sentence-transformers/all-MiniLM-L6-v2"
+    model_name = "all-MiniLM-L6-v2"
+
+    def __init__(self, quantize: bool = False, max_length: int = 256, batch_size: int = 32):
+        try:
+            import onnxruntime as ort
+            from tokenizers import Tokenizer
+            from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+        except Exception as e:
+            raise RuntimeError("LOCAL_EMBED_BACKEND=onnx requires onnxruntime and tokenizers") from e
+        self._quantize = quantize
+        self._batch_size = batch_size
+        base = ONNXMiniLM_L6_V2()
+        base._download_model_if_not_exists()
+        model_dir = os.path.join(str(base.DOWNLOAD_PATH), base.EXTRACTED_FOLDER_NAME)
+        model_path = os.path.join(model_dir, "model.onnx")
+        if quantize:
+            model_path = self._quantized_model(model_path)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        # 按批内最长序列补齐，而不是固定补齐到 max_length
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        so = ort.SessionOptions()
+        so.log_severity_level = 3
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self._session = ort.InferenceSession(model_path, sess_options=so, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self._session.get_inputs()}
+
+    @staticmethod
+    def _quantized_model(model_path: str) -> str:
+        out_path = model_path.replace(".onnx", ".int8.onnx")
+        if os.path.isfile(out_path):
+            return out_path
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+        except Exception as e:
+            raise RuntimeError("LOCAL_EMBED_BACKEND=onnx-int8 requires the onnx package for quantization") from e
+        tmp_path = out_path + ".tmp"
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, out_path)
+        return out_path
+
+    def name(self) -> str:
+        return "onnx-minilm-int8" if self._quantize else "onnx-minilm"
+
+    def __call__(self, input):
+        import numpy as np
+
+        texts = input if isinstance(input, list) else [input]
+        out: list = []
+        for i in range(0, len(texts), self._batch_size):
+            encoded = self.tokenizer.encode_batch(texts[i:i + self._batch_size])
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            hidden = self._session.run(None, feeds)[0]
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            pooled = pooled / np.clip(norms, 1e-12, None)
+            out.extend(pooled.astype(np.float32).tolist())
+        return out
+
+
+class _TokenBucket:
+    """令牌桶限速：平均每秒 rate 个请求，允许 burst 个突发。rate<=0 表示不限速。"""
+
+    def __init__(self, rate: float, burst: Optional[int] = None):
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(1, int(rate)))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _is_retryable(exc: Exception) -> bool:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # 无状态码：连接错误 / 超时
+    name = type(exc).__name__
+    return name in {"APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout", "TimeoutException"}
+
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class _DashscopeEmbeddingFunction:
+    """OpenAI 兼容模式的 DashScope Embedding 封装，适配 Chroma 的 embedding_function 接口。
+
+    批次（每批 <= 10 条）通过线程池并发发送，受令牌桶限速；429/5xx 与连接错误按带抖动的
+    指数退避重试。返回顺序与输入顺序一致。
+    """
+
+    # DashScope 限制 batch <= 10
+    batch_size = 10
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        base_url: str,
+        dimensions: Optional[int] = None,
+        concurrency: int = 4,
+        requests_per_second: float = 10.0,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+    ):
+        # 重试由本类统一处理（含限速），关闭客户端自带的重试
+        self._client = _OpenAIClient(api_key=api_key, base_url=base_url, max_retries=0) if _OpenAIClient else None
+        self._model = model
+        self._dim = dimensions
+        self.embedding_space = f"dashscope::{model}::{dimensions or 'default'}"
+        self._concurrency = max(1, int(concurrency))
+        self._bucket = _TokenBucket(requests_per_second)
+        self._max_retries = max(0, int(max_retries))
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    # Chroma 会调用 .name() 来判断冲突
+    def name(self) -> str:
+        return f"dashscope-embedding::{self._model}"
+
+    def _executor(self) -> ThreadPoolExecutor:
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="dashscope-embed")
+            return self._pool
+
+    def _embed_batch(self, chunk: List[str]) -> List[List[float]]:
+        kwargs = {"model": self._model, "input": chunk, "encoding_format": "float"}
+        if self._dim is not None:
+            kwargs["dimensions"] = self._dim
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            try:
+                resp = self._client.embeddings.create(**kwargs)
+                # 按 index 排序，防止服务端乱序返回
+                data = sorted(resp.data, key=lambda item: getattr(item, "index", 0))
+                return [item.embedding for item in data]
+            except Exception as e:
+                if attempt >= self._max_retries or not _is_retryable(e):
+                    raise
+                # full jitter 指数退避；服务端给出 Retry-After 时取两者较大值
+                delay = random.uniform(0, min(self._backoff_max, self._backoff_base * (2 ** attempt)))
+                retry_after = _retry_after_seconds(e)
+                if retry_after is not None:
+                    delay = max(delay, min(retry_after, self._backoff_max))
+                time.sleep(delay)
+                attempt += 1
+
+    def __call__(self, input):  # Chroma expects signature (self, input)
+        if not self._client:
+            raise RuntimeError("OpenAI client not available for DashScope embedding")
+        # 兼容传入单条或批量
+        texts = input if isinstance(input, list) else [input]
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1 or self._concurrency == 1:
+            results = [self._embed_batch(b) for b in batches]
+        else:
+            # Executor.map 保持输入顺序
+            results = list(self._executor().map(self._embed_batch, batches))
+        all_embeddings: list[list[float]] = []
+        for part in results:
+            all_embeddings.extend(part)
+        return all_embeddings
+
+    # 兼容可能的接口期望
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.__call__(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.__call__([text])[0]
+
+
+# ---------------- Embedder registry (one instance per process) ---------------- #
+_registry_lock = threading.Lock()
+_registry = {
+    "config": None,  # type: ignore
+    "embedder": None,
+}
+
+
+def get_embedder():
+    """
+    返回当前配置对应的 embedder；同一配置在进程内只构建一次，并在线程间共享。
+
+    每次调用只比较配置签名（环境变量 / config_local），配置变化时在锁内构建新实例后整体替换，
+    已持有旧实例的请求不受影响。
+    """
+    config = _embedder_config()
+    embedder = _registry["embedder"]
+    if embedder is not None and _registry["config"] == config:
+        return embedder
+    with _registry_lock:
+        if _registry["embedder"] is None or _registry["config"] != config:
+            _registry["embedder"] = _build_embedder(config)
+            _registry["config"] = config
+        return _registry["embedder"]
+
+
+def warmup_embedder() -> str:
+    """构建 embedder 并执行一次编码，使首个查询不再承担模型加载时间。返回 embedder 名称。"""
+    embedder = get_embedder()
+    embedder(["warmup"])
+    return embedder_name(embedder)
+
+
+def reset_embedders() -> None:
+    """丢弃已构建的 embedder，下次 get_embedder() 时重新构建。"""
+    with _registry_lock:
+        _registry["embedder"] = None
+        _registry["config"] = None
+
+
+def _get_embedding_function():
+    """兼容旧调用：等价于 get_embedder()。"""
+    return get_embedder()
+
+
+# ---------------- Embedding cache (content-addressed, on disk) ---------------- #
+_embed_cache_lock = threading.Lock()
+_embed_cache_state = {
+    "cache": None,  # type: ignore
+    "hits": 0,
+    "misses": 0,
+}
+
+
+def _get_embed_cache() -> Optional[DiskCache]:
+    """按需打开磁盘 embedding 缓存；EMBED_CACHE=0 时关闭。"""
+    if not get_bool("EMBED_CACHE", True):
+        return None
+    with _embed_cache_lock:
+        if _embed_cache_state["cache"] is None:
+            path = get_setting("EMBED_CACHE_PATH", "./data/.embed_cache.sqlite")
+            max_mb = get_int("EMBED_CACHE_MAX_MB", 1024) or 1024
+            _embed_cache_state["cache"] = DiskCache(path, max_bytes=max_mb * 1024 * 1024)
+        return _embed_cache_state["cache"]
+
+
+def embedder_name(embedding_fn) -> str:
+    """缓存键中使用的 embedder 标识：name() + 模型名（若有）。"""
+    try:
+        base = embedding_fn.name() if hasattr(embedding_fn, "name") else type(embedding_fn).__name__
+    except Exception:
+        base = type(embedding_fn).__name__
+    model = getattr(embedding_fn, "model_name", None)
+    return f"{base}::{model}" if model else str(base)
+
+
+def _embed_texts_cached(embedding_fn, texts: List[str]) -> List[List[float]]:
+    """
+    先查磁盘缓存，只对未命中的文本调用 embedding_fn，并回填缓存。
+    缓存键：(embedder name, dimensions, sha256(text))。
+    """
+    cache = _get_embed_cache()
+    if cache is None:
+        return [list(map(float, v)) for v in embedding_fn(texts)]
+
+    fp16 = get_bool("EMBED_STORE_FP16", False)
+    prefix = f"{embedder_name(embedding_fn)}|{getattr(embedding_fn, '_dim', None) or 0}|{'f16' if fp16 else 'f32'}|"
+    keys = [prefix + hashlib.sha256(t.encode("utf-8")).hexdigest() for t in texts]
+    try:
+        cached = cache.get_many(keys)
+    except Exception:
+        cached = {}
+
+    vectors: dict = {k: _unpack_vector(b, fp16) for k, b in cached.items()}
+    # 同一批次中的重复文本只嵌入一次
+    missing: dict = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = text
+    if missing:
+        new_vecs = embedding_fn(list(missing.values()))
+        fresh = []
+        for key, vec in zip(missing.keys(), new_vecs):
+            vectors[key] = [float(x) for x in vec]
+            fresh.append((key, _pack_vector(vectors[key], fp16)))
+        try:
+            cache.set_many(fresh)
+        except Exception:
+            pass
+
+    with _embed_cache_lock:
+        _embed_cache_state["hits"] += len(texts) - len(missing)
+        _embed_cache_state["misses"] += len(missing)
+    return [vectors[k] for k in keys]
+
+
+def _pack_vector(vec: List[float], fp16: bool = False) -> bytes:
+    if fp16:
+        return struct.pack(f"<{len(vec)}e", *vec)
+    return array("f", vec).tobytes()
+
+
+def _unpack_vector(blob: bytes, fp16: bool = False) -> List[float]:
+    if fp16:
+        return list(struct.unpack(f"<{len(blob) // 2}e", blob))
+    arr = array("f")
+    arr.frombytes(blob)
+    return arr.tolist()
+
+
+def embed_cache_stats() -> dict:
+    """返回进程内 embedding 缓存的累计命中/未命中次数。"""
+    with _embed_cache_lock:
+        return {"hits": _embed_cache_state["hits"], "misses": _embed_cache_state["misses"]}
+
+
+# ---------------- Query embedding LRU (in memory) ---------------- #
+class _LRUCache:
+    """线程安全的有界 LRU，带命中/未命中计数；ttl_seconds>0 时条目过期后视为未命中。"""
+
+    def __init__(self, max_size: int, ttl_seconds: float = 0.0):
+        self.max_size = max(0, int(max_size))
+        self.ttl_seconds = max(0.0, float(ttl_seconds or 0.0))
+        self._data: "OrderedDict" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if not expires or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value) -> None:
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl_seconds if self.ttl_seconds else 0.0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+_query_cache = _LRUCache(get_int("QUERY_EMBED_CACHE_SIZE", 2048) or 0)
+
+
+class _MicroBatcher:
+    """
+    动态微批：把并发到达的查询编码请求在 max_wait_ms 内（或凑满 max_batch 条）合并成一次前向，
+    再把各自的向量交还给调用方。单个后台线程串行执行批次，天然限制了模型的并发度。
+    上一批只有 1 条且队列为空时视为低负载，不再等待，单客户端不承担额外延迟。
+    """
+
+    def __init__(self, max_batch: int = 32, max_wait_ms: float = 3.0):
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    def _ensure_worker(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="query-embed-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, embedder, text: str) -> Future:
+        fut: Future = Future()
+        self._ensure_worker()
+        self._queue.put((embedder, text, fut))
+        return fut
+
+    def embed(self, embedder, text: str) -> List[float]:
+        return self.submit(embedder, text).result()
+
+    def _run(self) -> None:
+        last_size = 0
+        while True:
+            batch = [self._queue.get()]
+            wait = 0.0 if (last_size <= 1 and self._queue.empty()) else self.max_wait
+            deadline = time.monotonic() + wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            last_size = len(batch)
+            # 配置切换时同一批可能混有不同 embedder，按实例分组
+            groups: dict = {}
+            for embedder, text, fut in batch:
+                groups.setdefault(id(embedder), (embedder, []))[1].append((text, fut))
+            for embedder, items in groups.values():
+                try:
+                    self._encode_group(embedder, items)
+                except BaseException as e:
+                    # 兜底：任何异常都不能让后台线程退出，也不能留下永远等不到结果的调用方
+                    for _, fut in items:
+                        if not fut.done():
+                            fut.set_exception(e if isinstance(e, Exception) else RuntimeError(repr(e)))
+
+    def _encode_group(self, embedder, items) -> None:
+        unique = list(dict.fromkeys(text for text, _ in items))
+        try:
+            vectors = list(embedder(unique))
+            if len(vectors) != len(unique):
+                raise RuntimeError(f"embedder returned {len(vectors)} vectors for {len(unique)} texts")
+            by_text = {t: [float(x) for x in v] for t, v in zip(unique, vectors)}
+        except Exception as e:
+            for _, fut in items:
+                fut.set_exception(e)
+            return
+        with self._lock:
+            self.batches += 1
+            self.items += len(items)
+        for text, fut in items:
+            fut.set_result(by_text[text])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "avg_batch": (self.items / self.batches) if self.batches else 0.0,
+            }
+
+
+_batcher = _MicroBatcher(
+    max_batch=get_int("QUERY_MICROBATCH_MAX", 32) or 32,
+    max_wait_ms=get_float("QUERY_MICROBATCH_WAIT_MS", 3.0) or 0.0,
+)
+
+
+def _normalize_query(text: str) -> str:
+    # NFKC + 折叠空白；不改变大小写，避免影响区分大小写的远程模型
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def embed_query(text: str) -> List[float]:
+    """
+    计算查询向量，经过进程内 LRU（键：embedder 名称 + 规范化后的查询文本）。
+    评估脚本与重复提问不会重复计算同一查询的 embedding。
+    """
+    embedder = get_embedder()
+    query = _normalize_query(text)
+    key = (embedder_name(embedder), getattr(embedder, "_dim", None) or 0, query)
+    vec = _query_cache.get(key)
+    if vec is None:
+        if get_bool("QUERY_MICROBATCH", True):
+            vec = _batcher.embed(embedder, query)
+        else:
+            vec = [float(x) for x in embedder([query])[0]]
+        _query_cache.put(key, vec)
+    return vec
+
+
+def query_embedding_cache_stats() -> dict:
+    stats = _query_cache.stats()
+    stats["microbatch"] = _batcher.stats()
+    return stats
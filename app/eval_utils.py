@@ -73,7 +73,8 @@ def run_generation_eval(items: List[Dict], use_rerank: bool = True, use_bm25: bo
         ctx_text = "\n\n".join(s.get("text", "") for s in src[:k_ctx])
         system_prompt = "你是一个严谨的AI助手。基于提供的资料回答用户问题；若资料不足请明确说明并拒绝臆测。"
         user_prompt = f"问题：{q}\n\n资料：\n{ctx_text}\n\n请给出简洁要点式回答，并在末尾用 [1][2]... 形式列出参考来源编号。"
-        ans = qwen_chat(system_prompt, user_prompt)
+        # temperature=0：结果可复现，且重复评估命中 LLM 回复缓存
+        ans = qwen_chat(system_prompt, user_prompt, temperature=0.0)
         nli_scores = _nli_entailment_ratio(ctx_text, ans)
         rec = {
             "question": q,
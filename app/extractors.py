@@ -0,0 +1,120 @@
+import os
+import tempfile
+from typing import List, Optional, Tuple
+
+
+# PDF 文本提取链：pypdf → pdfminer → PyMuPDF → OCR（ocrmypdf），前一个得到空文本时才尝试下一个。
+# /ingest、建库脚本与 BM25 构建共用这一条链，解析缓存中的标识为 PDF_CHAIN_EXTRACTOR。
+PDF_CHAIN_EXTRACTOR = "pdf-chain"
+
+
+def _normalize_ws(s: str) -> str:
+    return " ".join((s or "").split())
+
+
+def available_backends() -> dict:
+    out = {}
+    for key, mod in (("has_pypdf", "pypdf"), ("has_pdfminer", "pdfminer.high_level"), ("has_pymupdf", "fitz")):
+        try:
+            __import__(mod)
+            out[key] = True
+        except Exception:
+            out[key] = False
+    return out
+
+
+def _pypdf_text(path: str) -> Tuple[str, Optional[str]]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    title = None
+    try:
+        meta = getattr(reader, "metadata", None)
+        if meta and getattr(meta, "title", None):
+            title = _normalize_ws(str(meta.title)) or None
+    except Exception:
+        title = None
+    pages = []
+    for p in reader.pages:
+        t = p.extract_text() or ""
+        if t.strip():
+            pages.append(t)
+    return "\n".join(pages).strip(), title
+
+
+def _pdfminer_text(path: str) -> str:
+    from pdfminer.high_level import extract_text
+
+    return (extract_text(path) or "").strip()
+
+
+def _pymupdf_text(path: str) -> str:
+    import fitz  # PyMuPDF
+
+    with fitz.open(path) as doc:
+        parts = []
+        for page in doc:
+            t = page.get_text("text") or ""
+            if t.strip():
+                parts.append(t)
+        return "\n".join(parts).strip()
+
+
+def _text_chain(path: str, tried: List[str], tag: str = "") -> Tuple[str, Optional[str]]:
+    """依次尝试三个文本层提取器；tried 记录尝试过的提取器（失败的带 _err 后缀）。"""
+    text, title = "", None
+    try:
+        text, title = _pypdf_text(path)
+        tried.append("pypdf" + tag)
+    except ImportError:
+        pass
+    except Exception:
+        tried.append("pypdf_err" + tag)
+    for name, fn in (("pdfminer", _pdfminer_text), ("pymupdf", _pymupdf_text)):
+        if text:
+            break
+        try:
+            text = fn(path)
+            tried.append(name + tag)
+        except ImportError:
+            continue
+        except Exception:
+            tried.append(name + "_err" + tag)
+            text = ""
+    return text, title
+
+
+def extract_pdf(path: str, ocr: bool = True) -> Tuple[str, Optional[str], List[str]]:
+    """
+    提取 PDF 正文与元数据标题，返回 (text, title, tried)。
+    文本层全部为空且 ocr=True 时尝试 ocrmypdf（已安装时），对 OCR 结果再走一遍文本链。
+    """
+    tried: List[str] = []
+    text, title = _text_chain(path, tried)
+    if not text and ocr:
+        try:
+            import ocrmypdf  # type: ignore
+
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=True) as tmp_ocr:
+                ocrmypdf.ocr(path, tmp_ocr.name, force_ocr=True, skip_text=True, output_type="pdf")
+                ocr_tried: List[str] = []
+                text, _ = _text_chain(tmp_ocr.name, ocr_tried)
+                if text:
+                    tried.append("ocrmypdf")
+        except Exception:
+            tried.append("ocr_failed")
+    return text, title, tried
+
+
+def extract_pdf_bytes(data: bytes, suffix: str = ".pdf", ocr: bool = True) -> Tuple[str, Optional[str], List[str]]:
+    """内存中的 PDF（上传 / 下载内容）：写入临时文件后走同一条提取链。"""
+    fd, path = tempfile.mkstemp(suffix=suffix or ".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return extract_pdf(path, ocr=ocr)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
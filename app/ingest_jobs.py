@@ -0,0 +1,387 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.chroma_utils import add_documents, bm25_add_documents, init_chroma
+from app.doc_cache import bytes_sha256, get_parsed, put_parsed
+from app.extractors import PDF_CHAIN_EXTRACTOR, available_backends, extract_pdf_bytes
+from app.rag_pipeline import DEFAULT_COLLECTION
+from app.settings import get_float, get_int, get_setting
+
+
+# 后台入库任务：POST /ingest 只把上传内容落盘并登记任务，立即返回 job id；
+# 提取（pypdf / pdfminer / PyMuPDF / OCR）、URL 下载、切分、向量化与写库在有界线程池上执行，
+# 不再阻塞事件循环。任务表在 SQLite 中（INGEST_JOBS_PATH），上传内容在 INGEST_JOBS_DIR，
+# 进程重启后未完成的任务（queued / running）重新排队；写库为按 chunk id 的 upsert，重跑是幂等的。
+#
+# 状态 status：queued → running → done | failed；running 期间 stage 依次为
+# fetching（仅 URL）→ extracting → indexing（切分 + 向量化 + upsert）→ bm25。
+
+# /ingest 的 PDF 提取链在解析缓存中的标识，与建库脚本共用
+INGEST_PDF_EXTRACTOR = PDF_CHAIN_EXTRACTOR
+
+_ACTIVE_STATUSES = ("queued", "running")
+
+_jobs_lock = threading.Lock()
+_jobs_state = {
+    "conn": None,  # type: ignore
+    "pool": None,  # type: ignore
+    "recovered": False,
+    "submitted": 0,
+    "done": 0,
+    "failed": 0,
+    "recovered_jobs": 0,
+}
+
+
+def _jobs_dir() -> str:
+    return get_setting("INGEST_JOBS_DIR", "./data/ingest_jobs")
+
+
+def _connect() -> sqlite3.Connection:
+    # 调用方持有 _jobs_lock
+    if _jobs_state["conn"] is None:
+        path = get_setting("INGEST_JOBS_PATH", "./data/.ingest_jobs.sqlite")
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " status TEXT NOT NULL,"
+            " stage TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " updated REAL NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " timings TEXT,"
+            " result TEXT,"
+            " error TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created)")
+        _jobs_state["conn"] = conn
+    return _jobs_state["conn"]
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    with _jobs_lock:
+        if _jobs_state["pool"] is None:
+            workers = get_int("INGEST_WORKERS", 2) or 2
+            _jobs_state["pool"] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        return _jobs_state["pool"]
+
+
+def _update(job_id: str, **fields: Any) -> None:
+    fields["updated"] = time.time()
+    for key in ("timings", "result", "payload"):
+        if key in fields and not isinstance(fields[key], str):
+            fields[key] = json.dumps(fields[key], ensure_ascii=False)
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    with _jobs_lock:
+        conn = _connect()
+        conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", [*fields.values(), job_id])
+        conn.commit()
+
+
+def _row_to_job(row) -> Dict[str, Any]:
+    job_id, status, stage, created, updated, payload, timings, result, error = row
+    payload = json.loads(payload or "{}")
+    return {
+        "job_id": job_id,
+        "status": status,
+        "stage": stage,
+        "created": created,
+        "updated": updated,
+        "file_name": payload.get("file_name"),
+        "url": payload.get("url"),
+        "timings": json.loads(timings) if timings else {},
+        "result": json.loads(result) if result else None,
+        "error": error,
+    }
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with _jobs_lock:
+        row = _connect().execute(
+            "SELECT id, status, stage, created, updated, payload, timings, result, error FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+    return _row_to_job(row) if row else None
+
+
+def pending_count() -> int:
+    with _jobs_lock:
+        return int(_connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", _ACTIVE_STATUSES
+        ).fetchone()[0])
+
+
+def submit_ingest(content: Optional[bytes], file_name: Optional[str], url: Optional[str], ocr: bool = False) -> Dict[str, Any]:
+    """登记一个入库任务并排队；上传内容写到 INGEST_JOBS_DIR/<job_id>。返回任务当前状态。"""
+    job_id = uuid.uuid4().hex
+    payload: Dict[str, Any] = {"file_name": file_name, "url": url, "ocr": bool(ocr), "path": None}
+    if content is not None:
+        os.makedirs(_jobs_dir(), exist_ok=True)
+        path = os.path.join(_jobs_dir(), job_id)
+        with open(path, "wb") as f:
+            f.write(content)
+        payload["path"] = path
+    now = time.time()
+    with _jobs_lock:
+        conn = _connect()
+        conn.execute(
+            "INSERT INTO jobs(id, status, stage, created, updated, payload, timings) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, "queued", "queued", now, now, json.dumps(payload, ensure_ascii=False), "{}"),
+        )
+        conn.commit()
+        _jobs_state["submitted"] += 1
+    _get_pool().submit(_run_job, job_id)
+    return get_job(job_id) or {"job_id": job_id, "status": "queued"}
+
+
+def recover_jobs() -> int:
+    """
+    进程启动时调用一次：上次未完成的任务（queued / running）重新排队，
+    并清理超过 INGEST_JOBS_TTL_SECONDS（默认 7 天）的已结束任务。返回重新排队的数量。
+    """
+    with _jobs_lock:
+        if _jobs_state["recovered"]:
+            return 0
+        _jobs_state["recovered"] = True
+        conn = _connect()
+        ttl = get_float("INGEST_JOBS_TTL_SECONDS", 7 * 24 * 3600.0)
+        if ttl > 0:
+            cutoff = time.time() - ttl
+            expired = conn.execute(
+                "SELECT payload FROM jobs WHERE status NOT IN (?, ?) AND updated < ?", (*_ACTIVE_STATUSES, cutoff)
+            ).fetchall()
+            for (payload,) in expired:
+                path = json.loads(payload or "{}").get("path")
+                if path:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            conn.execute("DELETE FROM jobs WHERE status NOT IN (?, ?) AND updated < ?", (*_ACTIVE_STATUSES, cutoff))
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?) ORDER BY created", _ACTIVE_STATUSES
+        ).fetchall()
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', stage = 'queued', updated = ? WHERE status = 'running'",
+            (time.time(),),
+        )
+        conn.commit()
+        _jobs_state["recovered_jobs"] += len(rows)
+    pool = _get_pool()
+    for (job_id,) in rows:
+        pool.submit(_run_job, job_id)
+    return len(rows)
+
+
+def ingest_job_stats() -> dict:
+    try:
+        pending = pending_count()
+    except Exception:
+        pending = None
+    with _jobs_lock:
+        out = {k: v for k, v in _jobs_state.items() if k not in ("conn", "pool", "recovered")}
+    out["pending"] = pending
+    return out
+
+
+def _run_job(job_id: str) -> None:
+    # 认领：只有仍处于 queued 的任务会被执行，避免同一任务被重复提交时跑两遍
+    with _jobs_lock:
+        conn = _connect()
+        claimed = conn.execute(
+            "UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id),
+        ).rowcount
+        conn.commit()
+        row = conn.execute("SELECT payload FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not claimed or row is None:
+        return
+    payload = json.loads(row[0] or "{}")
+    timings: Dict[str, float] = {}
+    t_start = time.perf_counter()
+
+    def stage(name: str) -> None:
+        _update(job_id, status="running", stage=name, timings=timings)
+
+    try:
+        content = None
+        if payload.get("path"):
+            with open(payload["path"], "rb") as f:
+                content = f.read()
+        result = _ingest(content, payload.get("file_name"), payload.get("url"), stage, timings)
+        timings["total_ms"] = round((time.perf_counter() - t_start) * 1000, 1)
+        _update(job_id, status="done", stage="done", timings=timings, result=result)
+        with _jobs_lock:
+            _jobs_state["done"] += 1
+    except Exception as e:
+        timings["total_ms"] = round((time.perf_counter() - t_start) * 1000, 1)
+        _update(job_id, status="failed", stage="failed", timings=timings, error=f"{type(e).__name__}: {e}")
+        with _jobs_lock:
+            _jobs_state["failed"] += 1
+        return
+    # 成功后删除上传内容；失败的保留，便于排查或手动重试
+    if payload.get("path"):
+        try:
+            os.remove(payload["path"])
+        except OSError:
+            pass
+
+
+def _timed(timings: Dict[str, float], key: str, t0: float) -> None:
+    timings[key] = round(timings.get(key, 0.0) + (time.perf_counter() - t0) * 1000, 1)
+
+
+def _extract_upload(fname: str, content_bytes: bytes, debug: Dict[str, Any]) -> List[Tuple[str, str]]:
+    docs: List[Tuple[str, str]] = []
+    ext = os.path.splitext(fname)[1].lower()
+    debug.update({
+        "file_name": fname,
+        "ext": ext,
+        "bytes_len": len(content_bytes),
+        **available_backends(),
+    })
+    is_pdf_guess = ext == ".pdf" or (len(content_bytes) >= 4 and content_bytes[:4] == b"%PDF")
+    # 同一份 PDF 再次上传时直接复用按内容哈希缓存的解析结果
+    pdf_sha = bytes_sha256(content_bytes) if is_pdf_guess else None
+    cached_pdf = get_parsed(pdf_sha, INGEST_PDF_EXTRACTOR) if pdf_sha else None
+    if ext in {".md", ".txt"}:
+        try:
+            text = content_bytes.decode("utf-8", errors="ignore").strip()
+        except Exception:
+            text = ""
+        if text:
+            docs.append((f"upload://{fname}", text))
+    elif cached_pdf is not None and cached_pdf[0]:
+        debug["pdf_extractors_tried"] = ["cache"]
+        docs.append((f"upload://{fname}", cached_pdf[0]))
+    elif is_pdf_guess:
+        # pypdf → pdfminer → PyMuPDF → OCR（文本层为空时默认尝试，提升兼容性），见 app/extractors.py
+        text, title, tried = extract_pdf_bytes(content_bytes, suffix=ext or ".pdf")
+        debug["pdf_extractors_tried"] = tried
+        if text:
+            put_parsed(pdf_sha, INGEST_PDF_EXTRACTOR, text, title)
+            docs.append((f"upload://{fname}", text))
+    else:
+        # Fallback treat as text
+        try:
+            text = content_bytes.decode("utf-8", errors="ignore").strip()
+            if text:
+                docs.append((f"upload://{fname}", text))
+        except Exception:
+            pass
+    return docs
+
+
+def _arxiv_abstract(html: str) -> str:
+    # 兼容 arXiv 经典页面摘要块
+    m = re.search(r"<blockquote[^>]*class=\"abstract\"[^>]*>([\s\S]*?)</blockquote>", html or "", re.I)
+    if not m:
+        return ""
+    # 去掉标签与前缀“Abstract:”等
+    block = re.sub(r"<[^>]+>", " ", m.group(1))
+    block = re.sub(r"\b(Abstract|ABSTRACT)\s*:\s*", "", block)
+    return " ".join(block.split()).strip()
+
+
+def _extract_url(u: str, stage, timings: Dict[str, float]) -> str:
+    import httpx
+
+    text = ""
+    try:
+        stage("fetching")
+        t0 = time.perf_counter()
+        with httpx.Client(timeout=20.0, follow_redirects=True) as client:
+            resp = client.get(u)
+        _timed(timings, "fetch_ms", t0)
+        ctype = resp.headers.get("content-type", "").lower()
+        # arXiv abs 页面仅抽取摘要块
+        if "arxiv.org/abs/" in u:
+            try:
+                text = _arxiv_abstract(resp.text or "")
+            except Exception:
+                text = ""
+            if text:
+                return text
+        stage("extracting")
+        t0 = time.perf_counter()
+        is_pdf_guess = ("pdf" in ctype) or (resp.content[:4] == b"%PDF")
+        pdf_sha = bytes_sha256(resp.content) if is_pdf_guess else None
+        cached_pdf = get_parsed(pdf_sha, INGEST_PDF_EXTRACTOR) if pdf_sha else None
+        if cached_pdf is not None and cached_pdf[0]:
+            text = cached_pdf[0]
+        elif is_pdf_guess:
+            text, title, _ = extract_pdf_bytes(resp.content)
+            if text:
+                put_parsed(pdf_sha, INGEST_PDF_EXTRACTOR, text, title)
+        if not text:
+            try:
+                resp.encoding = resp.encoding or "utf-8"
+            except Exception:
+                pass
+            text = (resp.text or "").strip()
+        _timed(timings, "extract_ms", t0)
+    except Exception:
+        text = ""
+    return text
+
+
+def _ingest(content_bytes: Optional[bytes], fname: Optional[str], url: Optional[str], stage, timings: Dict[str, float]) -> Dict[str, Any]:
+    """一个任务的完整流程；返回值与原同步 /ingest 的响应相同（added / sources / reason / debug）。"""
+    docs: List[Tuple[str, str]] = []
+    debug: Dict[str, Any] = {}
+
+    # Handle file upload
+    if content_bytes is not None:
+        stage("extracting")
+        t0 = time.perf_counter()
+        docs = _extract_upload(fname or "upload", content_bytes, debug)
+        _timed(timings, "extract_ms", t0)
+
+    # Handle URL ingestion
+    if (not docs) and url:
+        u = url.strip()
+        text = _extract_url(u, stage, timings)
+        if text:
+            docs.append((u, text))
+
+    if not docs:
+        reason = ""
+        if content_bytes is not None:
+            if (debug.get("ext") == ".pdf"):
+                if debug.get("pdf_extractors_tried") == []:
+                    reason = "无法从PDF提取文本（可能为图片型PDF，建议启用OCR）"
+                else:
+                    reason = "PDF提取失败（内容可能为扫描图），可尝试启用OCR"
+            else:
+                reason = "无法读取文件内容或不支持的格式"
+        elif url:
+            reason = "无法从URL获取文本/PDF内容"
+        return {"added": 0, "sources": [], "reason": reason, "debug": debug}
+
+    stage("indexing")
+    t0 = time.perf_counter()
+    client = init_chroma()
+    add_documents(client, DEFAULT_COLLECTION, docs)
+    _timed(timings, "index_ms", t0)
+    # 关键词检索立即可见：写入内存增量段，后台合并落盘
+    stage("bm25")
+    t0 = time.perf_counter()
+    try:
+        bm25_add_documents(docs)
+    except Exception as e:
+        debug["bm25_error"] = str(e)
+    _timed(timings, "bm25_ms", t0)
+    return {"added": len(docs), "sources": [src for src, _ in docs], "debug": debug}
@@ -1,8 +1,99 @@
+import hashlib
+import json
 import os
+import threading
 from typing import Optional
 
+from app.disk_cache import DiskCache
+from app.settings import get_bool, get_float, get_int, get_setting
 
-def qwen_chat(system_prompt: str, user_prompt: str, model: Optional[str] = None, temperature: Optional[float] = None) -> str:
+
+_PLACEHOLDER_PREFIX = "[本地占位回答]"
+_FAILED_REPLY = "抱歉，未能从 Qwen 获得有效回复。"
+
+# LLM 回复的磁盘缓存：只缓存确定性设置（temperature ≤ LLM_CACHE_MAX_TEMPERATURE）下的成功回复
+_llm_cache_lock = threading.Lock()
+_llm_cache_state = {
+    "cache": None,  # type: ignore
+    "hits": 0,
+    "misses": 0,
+    "bypassed": 0,
+}
+
+
+def _get_llm_cache() -> Optional[DiskCache]:
+    """按需打开 LLM 回复缓存；LLM_CACHE=0 时关闭。"""
+    if not get_bool("LLM_CACHE", True):
+        return None
+    with _llm_cache_lock:
+        if _llm_cache_state["cache"] is None:
+            path = get_setting("LLM_CACHE_PATH", "./data/.llm_cache.sqlite")
+            max_mb = get_int("LLM_CACHE_MAX_MB", 256) or 256
+            ttl = get_float("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600.0)
+            _llm_cache_state["cache"] = DiskCache(path, max_bytes=max_mb * 1024 * 1024, ttl_seconds=ttl or None)
+        return _llm_cache_state["cache"]
+
+
+def llm_cache_stats() -> dict:
+    with _llm_cache_lock:
+        return {k: v for k, v in _llm_cache_state.items() if k != "cache"}
+
+
+def _resolve_model_name(model: Optional[str] = None) -> str:
+    # 读取模型名：参数优先，其次环境变量 / 本地配置，最后使用兼容性更好的默认模型名
+    return model or get_setting("QWEN_MODEL", "") or "qwen-turbo"
+
+
+def chat_temperature() -> float:
+    """问答与闲聊未显式指定时的采样温度（LLM_CHAT_TEMPERATURE，默认 0.2）；不高于 LLM_CACHE_MAX_TEMPERATURE 时重复提问命中缓存。"""
+    return get_float("LLM_CHAT_TEMPERATURE", 0.2)
+
+
+def _cache_key(system_prompt: str, user_prompt: str, model_name: str, temperature: float) -> str:
+    payload = json.dumps([system_prompt, user_prompt, model_name, round(float(temperature), 4)], ensure_ascii=False)
+    return "qwen|" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def qwen_chat(
+    system_prompt: str,
+    user_prompt: str,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+    use_cache: bool = True,
+) -> str:
+    """
+    带磁盘缓存的 Qwen 调用：键为 (system_prompt, user_prompt, 模型名, temperature) 的哈希。
+    temperature 未指定（服务端默认采样）或高于 LLM_CACHE_MAX_TEMPERATURE 时不走缓存；use_cache=False 强制直连。
+    占位回答与失败回复不写入缓存。
+    """
+    model_name = _resolve_model_name(model)
+    cache = _get_llm_cache() if use_cache else None
+    max_temp = get_float("LLM_CACHE_MAX_TEMPERATURE", 0.2)
+    if cache is None or temperature is None or float(temperature) > max_temp:
+        with _llm_cache_lock:
+            _llm_cache_state["bypassed"] += 1
+        return _qwen_chat_uncached(system_prompt, user_prompt, model_name, temperature)
+
+    key = _cache_key(system_prompt, user_prompt, model_name, temperature)
+    try:
+        blob = cache.get(key)
+    except Exception:
+        blob = None
+    with _llm_cache_lock:
+        _llm_cache_state["hits" if blob is not None else "misses"] += 1
+    if blob is not None:
+        return blob.decode("utf-8")
+
+    reply = _qwen_chat_uncached(system_prompt, user_prompt, model_name, temperature)
+    if reply and reply != _FAILED_REPLY and not reply.startswith(_PLACEHOLDER_PREFIX):
+        try:
+            cache.set(key, reply.encode("utf-8"))
+        except Exception:
+            pass
+    return reply
+
+
+def _qwen_chat_uncached(system_prompt: str, user_prompt: str, model_name: str, temperature: Optional[float] = None) -> str:
     """
     简化的 Qwen Chat API 封装。
 
@@ -35,25 +126,12 @@ def qwen_chat(system_prompt: str, user_prompt: str, model: Optional[str] = None,
     if dashscope is None or not api_key:
         # 兜底：无 Key 或未安装 dashscope，则返回模板回答
         return (
-            "[本地占位回答] 未检测到 DashScope 配置，将基于检索到的资料给出简要回答.\n"
+            f"{_PLACEHOLDER_PREFIX} 未检测到 DashScope 配置，将基于检索到的资料给出简要回答.\n"
             f"System: {system_prompt[:60]}...\nUser: {user_prompt[:200]}...\n"
             "请在本机设置环境变量 DASHSCOPE_API_KEY，并安装 dashscope 以启用真实调用。"
         )
 
     dashscope.api_key = api_key
-    # 使用兼容性更好的默认模型名
-    # 读取模型名：环境变量优先，其次本地配置
-    model_name = model or os.getenv("QWEN_MODEL", "").strip()
-    if not model_name:
-        try:
-            from . import config_local as _cfg1
-            model_name = getattr(_cfg1, "QWEN_MODEL", "").strip()
-        except Exception:
-            try:
-                import config_local as _cfg2
-                model_name = getattr(_cfg2, "QWEN_MODEL", "").strip()
-            except Exception:
-                model_name = "qwen-turbo"
 
     # 构造对话
     messages = [
@@ -121,5 +199,5 @@ def qwen_chat(system_prompt: str, user_prompt: str, model: Optional[str] = None,
     except Exception:
         pass
 
-    return "抱歉，未能从 Qwen 获得有效回复。"
+    return _FAILED_REPLY
 
@@ -1,133 +1,282 @@
+import hashlib
+import threading
+import time
 from typing import Dict, List, Optional
 
 from app.chroma_utils import (
+    DEFAULT_COLLECTION,
     init_chroma,
     add_documents,
+    collection_is_empty,
     query_documents,
-    load_text_documents_from_dir,
+    hybrid_query,
+    iter_text_documents_from_dir,
     bm25_select_sources,
-    bm25_rank_map,
-    bm25_chunk_rank_map,
+    index_version,
+    distance_space,
+    distance_to_similarity,
 )
-from app.qwen_api import qwen_chat
+from app.embeddings import _LRUCache, _normalize_query, embedder_name, get_embedder
+from app.context_packer import pack_context
+from app.qwen_api import chat_temperature, qwen_chat
+from app.settings import get_bool, get_float, get_int
 
 
-DEFAULT_COLLECTION = "resume_mvp"
+_cross_encoder_model = None  # lazy load
+
+# build_context 结果缓存：键含索引版本，/ingest 与重建索引后旧条目自然失效；CONTEXT_CACHE_SIZE=0 关闭
+_context_cache = _LRUCache(
+    get_int("CONTEXT_CACHE_SIZE", 512) or 0,
+    ttl_seconds=get_float("CONTEXT_CACHE_TTL_SECONDS", 600.0),
+)
 
 
-_cross_encoder_model = None  # lazy load
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
 
+# (模型, 查询哈希, chunk id) -> CrossEncoder 分数；评估扫参与重复提问不再重复打分同一对
+_rerank_score_cache = _LRUCache(get_int("RERANK_CACHE_SIZE", 20000) or 0)
 
-def _maybe_load_reranker(model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"):
+
+def _maybe_load_reranker(model_name: str = RERANK_MODEL):
     global _cross_encoder_model
     if _cross_encoder_model is None:
         try:
             from sentence_transformers import CrossEncoder
-            _cross_encoder_model = CrossEncoder(model_name)
+            # 超过 RERANK_MAX_LENGTH 个 token 的 (query, chunk) 对在分词时截断
+            _cross_encoder_model = CrossEncoder(model_name, max_length=get_int("RERANK_MAX_LENGTH", 256) or None)
         except Exception:
             _cross_encoder_model = False  # mark unavailable
     return _cross_encoder_model
 
 
-def _apply_rerank(query: str, sources: List[Dict]) -> List[Dict]:
+def _rerank_key(query_hash: str, s: Dict):
+    cid = s.get("id") or hashlib.sha1((s.get("text") or "").encode("utf-8")).hexdigest()
+    return (RERANK_MODEL, query_hash, cid)
+
+
+def _confident_top(sources: List[Dict], top_n: int, gap: float) -> bool:
+    """
+    第一阶段 top1 是否明显领先：比较的是向量的余弦相似度（score，由各后端的距离换算，见
+    chroma_utils.distance_to_similarity，不截断），而不是 RRF 分——
+    k=60 时 RRF 只反映名次，“两路都命中”对“只有一路命中”就会拉开约一倍，并不代表相关性更高。
+    top1 的相似度须比前 top_n 个候选中其余所有候选高出 gap（绝对差）；只由 BM25 召回、没有相似度的候选
+    未进入向量 top-N，按候选中最低的相似度估计。top1 自身没有相似度时不跳过。
+    """
+    sims = [s.get("score") for s in sources[:top_n]]
+    known = [float(x) for x in sims if x is not None]
+    if sims[0] is None or len(known) < 2:
+        return False
+    floor = min(known)
+    runner_up = max(float(x) if x is not None else floor for x in sims[1:])
+    return float(sims[0]) - runner_up >= gap
+
+
+def _apply_rerank(query: str, sources: List[Dict], timings: Optional[Dict] = None, k: Optional[int] = None) -> List[Dict]:
+    """
+    CrossEncoder 重排（级联，RERANK_CASCADE=0 时关闭早停）：
+    1. 第一阶段 top1 的向量相似度领先其余候选至少 RERANK_SKIP_GAP（绝对差，见 _confident_top）时，
+       排序已足够明确，直接跳过重排；
+    2. 否则只看前 RERANK_TOP_N 个候选，按 RERANK_CASCADE_BATCH 小批打分；已有 k 个分数后，
+       若新一批的最高分仍低于当前第 k 名减 RERANK_CASCADE_MARGIN，认为更靠后的候选追不上 top-k，提前停止。
+    未打分的候选保持原顺序接在后面。已缓存的 (query, chunk) 分数直接复用。
+    timings 不为 None 时写入 rerank_ms / rerank_pairs / rerank_cached / rerank_exit。
+    """
     model = _maybe_load_reranker()
     if not model or not sources:
         return sources
-    pairs = [[query, s["text"]] for s in sources]
+    t0 = time.perf_counter()
+    cascade = get_bool("RERANK_CASCADE", True)
+    k = max(1, k or len(sources))
+    _bump_rerank_stat("calls")
+
+    top_n = get_int("RERANK_TOP_N", 30) or len(sources)
+    if cascade and len(sources) > 1:
+        gap = get_float("RERANK_SKIP_GAP", 0.15)
+        if gap > 0 and _confident_top(sources, top_n, gap):
+            _record_rerank(timings, t0, "skipped_gap", scored=0, cached=0, saved=min(len(sources), top_n))
+            return sources
+
+    head, tail = sources[:top_n], sources[top_n:]
+    query_hash = hashlib.sha1(_normalize_query(query).encode("utf-8")).hexdigest()
+    keys = [_rerank_key(query_hash, s) for s in head]
+    scores: List[Optional[float]] = [None] * len(head)
+    batch = (get_int("RERANK_CASCADE_BATCH", 8) or 8) if cascade else (get_int("RERANK_BATCH_SIZE", 32) or 32)
+    margin = get_float("RERANK_CASCADE_MARGIN", 1.0)
+    n_scored = n_cached = 0
+    done = 0
+    exit_path = "full"
     try:
-        scores = model.predict(pairs)
-        with_scores = []
-        for s, sc in zip(sources, scores):
-            s2 = dict(s)
-            s2["rerank_score"] = float(sc)
-            with_scores.append(s2)
-        with_scores.sort(key=lambda x: x.get("rerank_score", 0.0), reverse=True)
-        return with_scores
+        while done < len(head):
+            idx = list(range(done, min(done + batch, len(head))))
+            todo = []
+            for i in idx:
+                scores[i] = _rerank_score_cache.get(keys[i])
+                if scores[i] is None:
+                    todo.append(i)
+            n_cached += len(idx) - len(todo)
+            if todo:
+                c0 = time.process_time()
+                predicted = model.predict([[query, head[i]["text"]] for i in todo], batch_size=len(todo), show_progress_bar=False)
+                _bump_rerank_stat("cpu_ms", (time.process_time() - c0) * 1000)
+                for i, sc in zip(todo, predicted):
+                    scores[i] = float(sc)
+                    _rerank_score_cache.put(keys[i], scores[i])
+                n_scored += len(todo)
+            done = idx[-1] + 1
+            if cascade and done >= k and done < len(head):
+                kth = sorted(scores[:done], reverse=True)[k - 1]
+                if max(scores[i] for i in idx) < kth - margin:
+                    exit_path = "early_exit"
+                    break
     except Exception:
         return sources
 
+    with_scores = []
+    for s, sc in zip(head[:done], scores[:done]):
+        s2 = dict(s)
+        s2["rerank_score"] = sc
+        with_scores.append(s2)
+    with_scores.sort(key=lambda x: x.get("rerank_score", 0.0), reverse=True)
+    _record_rerank(timings, t0, exit_path, scored=n_scored, cached=n_cached, saved=len(head) - done)
+    return with_scores + head[done:] + tail
 
-def build_context(query: str, n_results: int = 6, use_rerank: bool = False, use_bm25: bool = True) -> List[Dict]:
-    client = init_chroma()
 
-    # 若集合为空或需要更新，则索引 data/ 下文档
-    try:
-        collection = client.get_or_create_collection(name=DEFAULT_COLLECTION)
-        need_index = collection.count() == 0
-    except Exception:
-        need_index = True
+# 级联各出口的触发次数；cpu_ms 为实际打分的 CPU 时间，cpu_ms_saved 按每对平均 CPU 时间估算跳过部分
+_rerank_stats = {
+    "calls": 0,
+    "skipped_gap": 0,
+    "early_exit": 0,
+    "full": 0,
+    "pairs_scored": 0,
+    "pairs_skipped": 0,
+    "cpu_ms": 0.0,
+}
+_rerank_stats_lock = threading.Lock()
+
 
-    if need_index:
-        docs = load_text_documents_from_dir("data")
-        if docs:
-            add_documents(client, DEFAULT_COLLECTION, docs)
+def _bump_rerank_stat(name: str, n=1) -> None:
+    with _rerank_stats_lock:
+        _rerank_stats[name] += n
 
-    # 可选：BM25 预过滤，限制检索集合来源（通过简单标题/路径过滤）
-    allowed_sources = None
-    bm25_ranks = {}
+
+def _record_rerank(timings: Optional[Dict], t0: float, exit_path: str, scored: int, cached: int, saved: int) -> None:
+    with _rerank_stats_lock:
+        _rerank_stats[exit_path] += 1
+        _rerank_stats["pairs_scored"] += scored
+        _rerank_stats["pairs_skipped"] += saved
+    if timings is not None:
+        timings["rerank_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        timings["rerank_pairs"] = scored
+        timings["rerank_cached"] = cached
+        timings["rerank_exit"] = exit_path
+
+
+def rerank_cache_stats() -> dict:
+    stats = _rerank_score_cache.stats()
+    with _rerank_stats_lock:
+        cascade = dict(_rerank_stats)
+    per_pair = cascade["cpu_ms"] / cascade["pairs_scored"] if cascade["pairs_scored"] else 0.0
+    cascade["cpu_ms"] = round(cascade["cpu_ms"], 2)
+    cascade["cpu_ms_saved"] = round(per_pair * cascade["pairs_skipped"], 2)
+    stats["cascade"] = cascade
+    return stats
+
+
+def context_cache_stats() -> dict:
+    return _context_cache.stats()
+
+
+def build_context(
+    query: str,
+    n_results: int = 6,
+    use_rerank: bool = False,
+    use_bm25: bool = True,
+    timings: Optional[Dict] = None,
+) -> List[Dict]:
+    """
+    检索上下文。timings 传入 dict 时写入本次请求的耗时（毫秒）：
+    retrieve_ms / rerank_ms / total_ms，以及 context_cache_hit、rerank_pairs、rerank_cached。
+    """
+    t0 = time.perf_counter()
+    key = None
+    if _context_cache.max_size:
+        key = (
+            _normalize_query(query),
+            n_results,
+            bool(use_rerank),
+            bool(use_bm25),
+            embedder_name(get_embedder()),
+            index_version(),
+        )
+        cached = _context_cache.get(key)
+        if cached is not None:
+            if timings is not None:
+                timings["context_cache_hit"] = True
+                timings["total_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            return [dict(s) for s in cached]
+    sources = _build_context_uncached(query, n_results, use_rerank, use_bm25, timings)
+    if key is not None:
+        _context_cache.put(key, [dict(s) for s in sources])
+    if timings is not None:
+        timings["context_cache_hit"] = False
+        timings["total_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    return sources
+
+
+def _build_context_uncached(query: str, n_results: int, use_rerank: bool, use_bm25: bool, timings: Optional[Dict] = None) -> List[Dict]:
+    t0 = time.perf_counter()
+    client = init_chroma()
+
+    # 若集合为空，则索引 data/ 下文档（空集合标记由写入事件维护，非空后不再每次 count）
+    if collection_is_empty(client, DEFAULT_COLLECTION):
+        add_documents(client, DEFAULT_COLLECTION, iter_text_documents_from_dir("data"))
+
+    # 返回条数：重排时至少 8 条（与纯向量路径一致）；重排需要更深的候选（RERANK_TOP_N），重排后再截断
+    k = max(n_results, 8) if (use_rerank or not use_bm25) else n_results
+    fetch = max(k, get_int("RERANK_TOP_N", 30) or k) if use_rerank else k
     if use_bm25:
+        # chunk 级混合检索：向量与 chunk BM25 各取 top-N，按真实名次做 RRF；文件级 BM25 仍作为来源预过滤
         allowed_sources = set(bm25_select_sources(query) or [])
-        bm25_ranks = bm25_rank_map(query)
-
-    results = query_documents(client, DEFAULT_COLLECTION, query, n_results=max(n_results, 8))
-    sources = []
-    docs = results.get("documents", [[]])[0]
-    metas = results.get("metadatas", [[]])[0]
-    dists = (results.get("distances", [[]]) or [[None]])[0]
-    for i in range(len(docs)):
-        doc_text = docs[i]
-        meta = metas[i] if i < len(metas) else {}
-        dist = dists[i] if i < len(dists) else None
-        score = None if dist is None else max(0.0, 1.0 - float(dist))
-        item = {
-            "text": doc_text,
-            "source": meta.get("source", "unknown"),
-            "title": meta.get("title", None),
-            "score": score,
-        }
-        if allowed_sources:
-            src = item["source"]
-            if any(src.endswith(p) or src == p for p in allowed_sources):
-                sources.append(item)
-        else:
-            sources.append(item)
-
-    # RRF 融合（BM25 chunk rank + 向量距离近似Rank）
-    if use_bm25 and sources:
-        chunk_ranks = bm25_chunk_rank_map(query)
-        def approx_vec_rank(s):
-            # convert similarity score to a pseudo-rank; higher score -> better rank
-            sc = s.get("score") or 0.0
-            return max(1, int(100 * (1.0 - sc)))
-        fused = []
-        for s in sources:
-            src = s.get("source", "")
-            # 粗略估计chunk_id（文件级无法唯一定位chunk，忽略，退化为文件级RRF）
-            # 这里使用文件级rank作为替代
-            file_rank = bm25_ranks.get(src)
-            vec_rank = approx_vec_rank(s)
-            rrf = 0.0
-            if file_rank:
-                rrf += 1.0 / (60 + file_rank)
-            rrf += 1.0 / (60 + vec_rank)
-            s2 = dict(s)
-            s2["rrf"] = rrf
-            fused.append(s2)
-        fused.sort(key=lambda x: x.get("rrf", 0.0), reverse=True)
-        sources = fused
+        depth = get_int("HYBRID_CANDIDATE_DEPTH", max(30, 3 * fetch))
+        sources = hybrid_query(
+            client,
+            DEFAULT_COLLECTION,
+            query,
+            n_results=fetch,
+            vector_depth=depth,
+            bm25_depth=depth,
+            rrf_k=get_int("RRF_K", 60),
+            allowed_sources=allowed_sources,
+        )
+    else:
+        results = query_documents(client, DEFAULT_COLLECTION, query, n_results=fetch)
+        sources = []
+        docs = results.get("documents", [[]])[0]
+        metas = results.get("metadatas", [[]])[0]
+        dists = (results.get("distances", [[]]) or [[None]])[0]
+        space = distance_space(client, DEFAULT_COLLECTION)
+        for i in range(len(docs)):
+            meta = metas[i] if i < len(metas) else {}
+            dist = dists[i] if i < len(dists) else None
+            sources.append({
+                "text": docs[i],
+                "source": meta.get("source", "unknown"),
+                "title": meta.get("title", None),
+                "score": distance_to_similarity(dist, space),
+                "chunk_index": meta.get("chunk_index"),
+            })
+    if timings is not None:
+        timings["retrieve_ms"] = round((time.perf_counter() - t0) * 1000, 2)
     if use_rerank:
-        sources = _apply_rerank(query, sources)
+        sources = _apply_rerank(query, sources, timings, k=n_results)[:k]
     return sources
 
 
-def rag_pipeline(query: str, use_rerank: bool = False, use_bm25: bool = True) -> Dict:
-    sources = build_context(query, use_rerank=use_rerank, use_bm25=use_bm25)
-    # 组装带编号的上下文
-    context_lines = []
-    for idx, s in enumerate(sources, start=1):
-        display_name = s.get("title") or s.get("source")
-        context_lines.append(f"[{idx}] {display_name}\n{s['text']}")
-    context_text = "\n\n".join(context_lines)
+def rag_pipeline(query: str, use_rerank: bool = False, use_bm25: bool = True, temperature: Optional[float] = None) -> Dict:
+    timings: Dict = {}
+    sources = build_context(query, use_rerank=use_rerank, use_bm25=use_bm25, timings=timings)
+    # 组装带编号的上下文：相邻 chunk 合并、近重复去除、按 token 预算填充；编号按来源分配
+    context_text, sources = pack_context(sources)
 
     system_prompt = (
         "你是一个严谨的AI助手。基于提供的资料回答用户问题。"
@@ -139,7 +288,12 @@ def rag_pipeline(query: str, use_rerank: bool = False, use_bm25: bool = True) ->
         "请基于上述资料进行回答，并在末尾以 [1][2]... 的编号形式给出参考来源。"
     )
 
-    answer = qwen_chat(system_prompt=system_prompt, user_prompt=user_prompt)
+    # 显式温度（默认 LLM_CHAT_TEMPERATURE）：重复的问题命中 LLM 回复缓存
+    answer = qwen_chat(
+        system_prompt=system_prompt,
+        user_prompt=user_prompt,
+        temperature=chat_temperature() if temperature is None else temperature,
+    )
     # 去重来源（按出现顺序），同时保留最高相似度分数
     unique: Dict[str, float] = {}
     ordered = []
@@ -216,7 +370,7 @@ def rag_pipeline(query: str, use_rerank: bool = False, use_bm25: bool = True) ->
             "url": url_by_src.get(src),
         })
     # 正确返回 RAG 问答结果
-    return {"answer": answer, "sources": enriched}
+    return {"answer": answer, "sources": enriched, "timings": timings}
 
 
 def _trim_leading_short_word(s: str) -> str:
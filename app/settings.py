@@ -0,0 +1,59 @@
+import os
+from typing import Optional
+
+
+_local_config = {"loaded": False, "module": None}
+
+
+def _load_local_config():
+    # 与 qwen_api 相同：先尝试包内导入，再尝试直接运行方式；结果在进程内缓存，避免热路径反复搜索导入
+    if not _local_config["loaded"]:
+        module = None
+        try:
+            from . import config_local as _cfg1  # python -m 运行
+            module = _cfg1
+        except Exception:
+            try:
+                import config_local as _cfg2  # 直接运行
+                module = _cfg2
+            except Exception:
+                module = None
+        _local_config["module"] = module
+        _local_config["loaded"] = True
+    return _local_config["module"]
+
+
+def get_setting(name: str, default: str = "") -> str:
+    """读取配置：环境变量优先，其次 app/config_local.py，最后使用默认值。"""
+    value = os.getenv(name, "").strip()
+    if value:
+        return value
+    cfg = _load_local_config()
+    if cfg is not None:
+        value = str(getattr(cfg, name, "") or "").strip()
+        if value:
+            return value
+    return default
+
+
+def get_bool(name: str, default: bool = False) -> bool:
+    value = get_setting(name, "")
+    if not value:
+        return default
+    return value in {"1", "true", "True", "yes", "on"}
+
+
+def get_int(name: str, default: Optional[int] = None) -> Optional[int]:
+    value = get_setting(name, "")
+    try:
+        return int(value) if value else default
+    except ValueError:
+        return default
+
+
+def get_float(name: str, default: Optional[float] = None) -> Optional[float]:
+    value = get_setting(name, "")
+    try:
+        return float(value) if value else default
+    except ValueError:
+        return default
@@ -0,0 +1,311 @@
+import heapq
+import os
+import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.settings import get_float, get_int, get_setting
+
+try:
+    from chromadb.errors import NotFoundError as _ShardMissing
+except Exception:  # 仅使用 numpy 后端、未安装 chromadb 时
+    class _ShardMissing(Exception):  # type: ignore
+        pass
+
+
+# 分片集合：把一个逻辑集合拆成多个物理集合（Chroma 或 numpy 后端均可），
+# 写入按 source 路由到分片，查询在线程池上并发扇出，各分片 top-k 用堆归并。
+
+_ARXIV_MONTH_RE = re.compile(r"(?<!\d)(\d{2})(0[1-9]|1[0-2])\.\d{4,5}(?:v\d+)?")
+
+_shard_state = {
+    "pool": None,  # type: ignore
+    "queries": 0,
+    "timeouts": 0,
+    "errors": 0,
+    # 上一次超时的查询仍在该分片上运行，本次不再提交（每个分片最多积压一个卡住的查询）
+    "skipped_busy": 0,
+}
+_shard_lock = threading.Lock()
+
+
+def shard_config() -> Optional[dict]:
+    """SHARD_STRATEGY=hash|month；hash 需要 SHARD_COUNT>1。未配置时返回 None（不分片）。"""
+    strategy = get_setting("SHARD_STRATEGY", "").lower()
+    if strategy == "month":
+        return {"strategy": "month", "count": 0}
+    count = get_int("SHARD_COUNT", 0)
+    if strategy in ("", "hash") and count > 1:
+        return {"strategy": "hash", "count": count}
+    return None
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    with _shard_lock:
+        if _shard_state["pool"] is None:
+            workers = get_int("SHARD_WORKERS", 8) or 8
+            _shard_state["pool"] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard")
+        return _shard_state["pool"]
+
+
+def shard_stats() -> dict:
+    with _shard_lock:
+        return {k: v for k, v in _shard_state.items() if k != "pool"}
+
+
+def _bump(key: str, n: int = 1) -> None:
+    with _shard_lock:
+        _shard_state[key] += n
+
+
+def arxiv_month(source: str) -> Optional[str]:
+    """从 arXiv 风格的文件名 / URL 中取 yymm，例如 arxiv_2508.14817v1.md -> 2508。"""
+    m = _ARXIV_MONTH_RE.search(os.path.basename(source or ""))
+    return (m.group(1) + m.group(2)) if m else None
+
+
+class ShardedCollection:
+    """
+    与单个集合相同的接口（upsert / query / get / count / metadata / modify）。
+    - hash：按 crc32(source) % N 路由到 {name}__h00 .. {name}__h{N-1}；
+    - month：按 arXiv 年月路由到 {name}__m2508 等，无法识别的进入 {name}__misc，分片随数据动态出现。
+    查询时每个分片各取 top-k，超过 SHARD_TIMEOUT_SECONDS 的分片本次跳过（计入 timeouts），
+    结果按 distance 用堆归并。
+    """
+
+    def __init__(self, client, name: str, strategy: str, count: int = 0):
+        self.client = client
+        self.name = name
+        self.strategy = strategy
+        self.count_hint = count
+        self._shards: Dict[str, Any] = {}
+        # 超时后仍在运行的分片查询：分片名 -> Future，完成时自动移除
+        self._overdue: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+        self._discovered_at = 0.0
+        self._refuse_unsharded()
+        self._discover()
+
+    # ---------------- 分片管理 ---------------- #
+    def _prefix(self) -> str:
+        return f"{self.name}__"
+
+    def _refuse_unsharded(self) -> None:
+        """
+        同名的未分片集合里已有数据时拒绝启用分片：分片包装只读写 {name}__* 集合，
+        直接切换会让已有数据（含 /ingest 上传的文档）从检索中静默消失。
+        """
+        try:
+            existing = self.client.list_collections()
+        except Exception:
+            return
+        names = {c if isinstance(c, str) else getattr(c, "name", "") for c in existing}
+        if self.name not in names:
+            return
+        try:
+            count = self.client.get_collection(name=self.name).count()
+        except Exception:
+            return
+        if count:
+            raise RuntimeError(
+                f"collection '{self.name}' already holds {count} unsharded chunks, but SHARD_STRATEGY/SHARD_COUNT "
+                "enable sharding. Unset them, or delete the collection and rerun "
+                "scripts/index_incremental.py --force to rebuild into shards (re-ingest uploaded documents)."
+            )
+
+    def _discover(self) -> None:
+        self._discovered_at = time.monotonic()
+        if self.strategy == "hash":
+            for i in range(self.count_hint):
+                self._shard(f"{self._prefix()}h{i:02d}")
+            return
+        try:
+            existing = self.client.list_collections()
+        except Exception:
+            existing = []
+        for c in existing:
+            cname = c if isinstance(c, str) else getattr(c, "name", "")
+            if cname.startswith(self._prefix()):
+                self._shard(cname)
+
+    def _shard(self, shard_name: str):
+        with self._lock:
+            coll = self._shards.get(shard_name)
+            if coll is None:
+                coll = self.client.get_or_create_collection(name=shard_name)
+                # 新分片继承逻辑集合的元数据（embed_space / embed_dim 等）
+                base = self._base_metadata()
+                if base and not (coll.metadata or {}):
+                    coll.modify(metadata=dict(base))
+                self._shards[shard_name] = coll
+            return coll
+
+    def _base_metadata(self) -> dict:
+        with self._lock:
+            shards = list(self._shards.values())
+        for coll in shards:
+            if coll.metadata:
+                return dict(coll.metadata)
+        return {}
+
+    def _forget(self, shard_name: str) -> None:
+        # 分片被外部删除：丢弃句柄，下次写入时重新创建
+        with self._lock:
+            self._shards.pop(shard_name, None)
+
+    def shard_for(self, source: str) -> str:
+        if self.strategy == "hash":
+            return f"{self._prefix()}h{zlib.crc32((source or '').encode('utf-8')) % self.count_hint:02d}"
+        month = arxiv_month(source)
+        return f"{self._prefix()}m{month}" if month else f"{self._prefix()}misc"
+
+    def shards(self) -> List[Any]:
+        # month 分片会随其它进程（索引脚本）的写入出现，定期重新扫描一次集合列表
+        if self.strategy == "month" and time.monotonic() - self._discovered_at > get_float("SHARD_DISCOVER_SECONDS", 30.0):
+            self._discover()
+        with self._lock:
+            return list(self._shards.values())
+
+    def _targets(self, where: Optional[dict]) -> Optional[set]:
+        """where 为 {"source": {"$in"/"$eq": ...}} 时只需查询这些 source 所在的分片；其它情况返回 None（全部分片）。"""
+        cond = (where or {}).get("source") if isinstance(where, dict) and len(where) == 1 else None
+        if isinstance(cond, dict) and "$in" in cond:
+            values = cond["$in"]
+        elif isinstance(cond, dict) and "$eq" in cond:
+            values = [cond["$eq"]]
+        elif isinstance(cond, str):
+            values = [cond]
+        else:
+            return None
+        return {self.shard_for(v) for v in values}
+
+    def _fanout(self, fn, timeout: Optional[float] = None, targets: Optional[set] = None) -> List[Any]:
+        """
+        在线程池上对各分片执行 fn(shard_name, coll)。线程无法中途取消：超时的分片查询继续运行直到结束，
+        期间该分片被标记为 overdue，后续请求跳过它，卡住的工作不会随请求数累积；尚未开始的任务直接取消。
+        个别分片出错时计数并跳过；全部分片都出错时抛出第一个异常。
+        """
+        self.shards()  # 触发 month 分片的定期重新扫描
+        with self._lock:
+            items = [(n, c) for n, c in self._shards.items() if targets is None or n in targets]
+            busy = [n for n, _ in items if n in self._overdue]
+            items = [(n, c) for n, c in items if n not in self._overdue]
+        if busy:
+            _bump("skipped_busy", len(busy))
+        if not items:
+            return []
+        if len(items) == 1 and not timeout:
+            return [fn(*items[0])]
+        futures = {_get_pool().submit(fn, n, c): n for n, c in items}
+        done, not_done = wait(futures, timeout=timeout)
+        if not_done:
+            _bump("timeouts", len(not_done))
+            for f in not_done:
+                if f.cancel():
+                    continue
+                name = futures[f]
+                with self._lock:
+                    self._overdue[name] = f
+                f.add_done_callback(lambda _f, name=name: self._clear_overdue(name, _f))
+        out, errors = [], []
+        for f, name in futures.items():
+            if f not in done:
+                continue
+            try:
+                out.append(f.result())
+            except Exception as e:
+                _bump("errors")
+                errors.append(e)
+        if errors and not out and not not_done:
+            raise errors[0]
+        return out
+
+    def _clear_overdue(self, name: str, fut) -> None:
+        with self._lock:
+            if self._overdue.get(name) is fut:
+                del self._overdue[name]
+
+    # ---------------- 集合接口 ---------------- #
+    @property
+    def metadata(self) -> dict:
+        return self._base_metadata()
+
+    def modify(self, metadata: Optional[dict] = None, **kwargs: Any) -> None:
+        for coll in self.shards():
+            coll.modify(metadata=metadata, **kwargs)
+        if metadata is not None and not self._shards and self.strategy == "month":
+            # 还没有任何分片时先把元数据记到 misc 分片上
+            self._shard(f"{self._prefix()}misc").modify(metadata=metadata)
+
+    def count(self) -> int:
+        return sum(self._fanout(lambda n, c: c.count()))
+
+    def upsert(self, ids: Sequence[str], embeddings=None, documents: Optional[Sequence[str]] = None,
+               metadatas: Optional[Sequence[dict]] = None, **kwargs: Any) -> None:
+        groups: Dict[str, List[int]] = {}
+        for i, meta in enumerate(metadatas or [{}] * len(ids)):
+            groups.setdefault(self.shard_for((meta or {}).get("source", "")), []).append(i)
+        for shard_name, idx in groups.items():
+            self._shard(shard_name).upsert(
+                ids=[ids[i] for i in idx],
+                embeddings=[embeddings[i] for i in idx] if embeddings is not None else None,
+                documents=[documents[i] for i in idx] if documents is not None else None,
+                metadatas=[metadatas[i] for i in idx] if metadatas is not None else None,
+                **kwargs,
+            )
+
+    add = upsert
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Sequence[str] = ("documents", "metadatas", "distances"), **kwargs: Any) -> Dict[str, list]:
+        include = list(include)
+        if "distances" not in include:
+            include.append("distances")  # 归并需要距离
+        _bump("queries")
+        timeout = get_float("SHARD_TIMEOUT_SECONDS", 2.0) or None
+
+        def one(shard_name, coll):
+            try:
+                return coll.query(query_embeddings=query_embeddings, n_results=n_results, where=where, include=include, **kwargs)
+            except _ShardMissing:
+                # 分片已被外部删除：按空结果处理
+                self._forget(shard_name)
+                return None
+
+        partials = [r for r in self._fanout(one, timeout=timeout, targets=self._targets(where)) if r]
+        n_q = len(query_embeddings)
+        merged: Dict[str, list] = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for qi in range(n_q):
+            streams = []
+            for r in partials:
+                ids = (r.get("ids") or [[]] * n_q)[qi] or []
+                dists = (r.get("distances") or [[]] * n_q)[qi] or []
+                docs = ((r.get("documents") or [None] * n_q)[qi]) or [None] * len(ids)
+                metas = ((r.get("metadatas") or [None] * n_q)[qi]) or [None] * len(ids)
+                streams.append(zip(dists, ids, docs, metas))
+            top = list(islice(heapq.merge(*streams, key=lambda t: t[0]), n_results))
+            merged["distances"].append([t[0] for t in top])
+            merged["ids"].append([t[1] for t in top])
+            merged["documents"].append([t[2] for t in top])
+            merged["metadatas"].append([t[3] for t in top])
+        return merged
+
+    def get(self, ids: Optional[Sequence[str]] = None, where: Optional[dict] = None,
+            include: Sequence[str] = ("documents", "metadatas"), **kwargs: Any) -> Dict[str, list]:
+        parts = self._fanout(lambda n, c: c.get(ids=ids, where=where, include=list(include), **kwargs),
+                             targets=self._targets(where))
+        out: Dict[str, list] = {"ids": [], "documents": [], "metadatas": []}
+        for r in parts:
+            out["ids"].extend(r.get("ids") or [])
+            out["documents"].extend(r.get("documents") or [None] * len(r.get("ids") or []))
+            out["metadatas"].extend(r.get("metadatas") or [None] * len(r.get("ids") or []))
+        if ids is not None:
+            # 保持与请求 ids 相同的顺序
+            pos = {cid: i for i, cid in enumerate(out["ids"])}
+            order = [pos[c] for c in ids if c in pos]
+            out = {k: [v[i] for i in order] for k, v in out.items()}
+        return out
@@ -0,0 +1,67 @@
+import re
+from array import array
+from typing import Dict, List
+
+
+# 词法索引使用的分词器版本：分词规则变化时递增，持久化的 BM25 索引据此判断是否需要重建
+TOKENIZER_VERSION = 2
+
+# 一个预编译正则同时切出 ASCII 词与连续的 CJK 字符串（先 lower）
+_TOKEN_RE = re.compile(r"[a-z0-9_]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]+")
+
+
+def _expand_cjk(tokens: List[str]) -> List[str]:
+    out: List[str] = []
+    for tok in tokens:
+        if tok[0] <= "\u2fff" or len(tok) == 1:
+            out.append(tok)
+        else:
+            out.extend(tok[i:i + 2] for i in range(len(tok) - 1))
+    return out
+
+
+def tokenize(text: str) -> List[str]:
+    """ASCII 部分按 [a-z0-9_]+ 切词；CJK 连续串没有空格分词，退化为字符二元组（单字串保留单字）。"""
+    text = text.lower()
+    tokens = _TOKEN_RE.findall(text)
+    # 纯 ASCII 文本（绝大多数英文论文 chunk）不需要逐个检查 CJK
+    return tokens if text.isascii() else _expand_cjk(tokens)
+
+
+class Vocabulary:
+    """词项 -> 整数 id 的共享词表；同一批构建的文件级与 chunk 级索引共用一份。"""
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def id_of(self, term: str) -> int:
+        tid = self.ids.get(term)
+        if tid is None:
+            tid = len(self.ids)
+            self.ids[term] = tid
+        return tid
+
+
+class TokenIdBuffer:
+    """
+    把一批文档编码为扁平的 int32 词项 id 数组 + 每篇文档长度，
+    不为每篇文档保留字符串列表；可直接交给 BM25Segment.build_from_ids。
+    """
+
+    def __init__(self, vocab: Vocabulary):
+        self.vocab = vocab
+        self.ids = array("i")
+        self.lengths = array("q")
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def add(self, text: str) -> None:
+        tokens = tokenize(text)
+        ids = self.vocab.ids
+        setdefault = ids.setdefault
+        self.ids.extend([setdefault(t, len(ids)) for t in tokens])
+        self.lengths.append(len(tokens))
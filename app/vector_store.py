@@ -0,0 +1,505 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    import numpy as np
+except Exception:
+    np = None  # type: ignore
+
+try:
+    import fcntl
+except Exception:  # Windows：没有 fcntl 时只有进程内的锁
+    fcntl = None  # type: ignore
+
+
+# 与 Chroma 集合对齐的最小接口：upsert / query / get / count / metadata / modify。
+# chroma_utils 只依赖这些方法，因此 VECTOR_BACKEND=numpy 时上层代码无需改动。
+
+_INCLUDE_ALL = ("documents", "metadatas", "distances")
+# 矩阵乘按行分块，float16 存储时每块转换为 float32 计算，控制临时内存
+_SCAN_BLOCK_ROWS = 8192
+# where 过滤后剩余行占比低于该值时只对子集做 gather + 乘法，否则全量乘后屏蔽
+_SUBSET_SCAN_RATIO = 0.25
+# documents.bin 中失效正文（被 upsert 覆盖的旧版本）超过存活正文且文件大于该值时，写入后自动压缩
+_COMPACT_MIN_BYTES = 64 * 1024 * 1024
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _scores(mat, dtype: str, q, rows=None):
+    """余弦相似度；rows 非空时只计算这些行。float16 存储时按块转换为 float32 计算。"""
+    n = mat.shape[0] if rows is None else rows.shape[0]
+    if dtype == "float32":
+        return np.asarray((mat if rows is None else mat[rows]) @ q)
+    out = np.empty(n, dtype=np.float32)
+    for s in range(0, n, _SCAN_BLOCK_ROWS):
+        e = min(n, s + _SCAN_BLOCK_ROWS)
+        block = mat[s:e] if rows is None else mat[rows[s:e]]
+        out[s:e] = block.astype(np.float32) @ q
+    return out
+
+
+class NumpyVectorClient:
+    """进程内向量库：每个集合一个目录，按名字缓存集合对象。"""
+
+    def __init__(self, path: str, fp16: bool = False):
+        self.path = path
+        self.fp16 = fp16
+        self._collections: Dict[str, "NumpyCollection"] = {}
+        self._lock = threading.Lock()
+
+    def get_or_create_collection(self, name: str, metadata: Optional[dict] = None, **_: Any) -> "NumpyCollection":
+        with self._lock:
+            coll = self._collections.get(name)
+            if coll is None:
+                coll = NumpyCollection(os.path.join(self.path, name), name, fp16=self.fp16, metadata=metadata)
+                self._collections[name] = coll
+            return coll
+
+    def get_collection(self, name: str, **_: Any) -> "NumpyCollection":
+        if not os.path.isdir(os.path.join(self.path, name)) and name not in self._collections:
+            raise ValueError(f"collection {name} does not exist")
+        return self.get_or_create_collection(name)
+
+    def list_collections(self) -> List[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(d for d in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, d, "state.json")))
+
+
+class NumpyCollection:
+    """
+    单个集合的磁盘布局（目录内）：
+    - vectors.bin：按行存放的 L2 归一化向量（float32 或 float16），np.memmap 映射，容量按倍数增长；
+    - documents.bin：chunk 正文的追加写文件，行号 -> (offset, length)；
+    - rows.jsonl：追加写的行日志 {"id", "row", "meta", "off", "len"}，打开时回放，同一 id 以最后一条为准；
+    - state.json：维度、dtype、行数与集合级 metadata，原子替换。
+    查询为精确检索：一次矩阵-向量乘得到余弦相似度，再用 argpartition 取 top-k。
+    返回的 distance 与 Chroma 默认的 l2 空间一致，为单位向量间的平方 L2 距离 2 - 2cos。
+    upsert 覆盖已有 id 时旧正文留在 documents.bin 中，compact() 重写正文文件与行日志回收这部分空间。
+    """
+
+    def __init__(self, directory: str, name: str, fp16: bool = False, metadata: Optional[dict] = None):
+        self.directory = directory
+        self.name = name
+        self._lock = threading.RLock()
+        self._fp16_default = fp16
+        self._mm = None
+        self._log_sig = None
+        self.metadata: Dict[str, Any] = dict(metadata or {})
+        self._load()
+
+    # ---------------- 持久化 ---------------- #
+    def _p(self, fname: str) -> str:
+        return os.path.join(self.directory, fname)
+
+    def _reset_memory(self) -> None:
+        self.dim = 0
+        self.dtype = "float16" if self._fp16_default else "float32"
+        self.count_rows = 0
+        self.capacity = 0
+        self.ids: List[str] = []
+        self.metas: List[dict] = []
+        self.doc_off = np.zeros(0, dtype=np.int64)
+        self.doc_len = np.zeros(0, dtype=np.int64)
+        self.row_of: Dict[str, int] = {}
+        self._columns: Dict[str, Any] = {}
+        self._log_sig = None
+
+    def _load(self) -> None:
+        with self._lock:
+            self._reset_memory()
+            state_path = self._p("state.json")
+            if not os.path.isfile(state_path):
+                return
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.dim = int(state.get("dim", 0))
+            self.dtype = state.get("dtype", self.dtype)
+            self.capacity = int(state.get("capacity", 0))
+            self.metadata = dict(state.get("metadata") or {})
+            n = int(state.get("count", 0))
+            offs: List[int] = [0] * n
+            lens: List[int] = [0] * n
+            self.ids = [""] * n
+            self.metas = [{}] * n
+            log_path = self._p("rows.jsonl")
+            if os.path.isfile(log_path):
+                with open(log_path, "r", encoding="utf-8") as f:
+                    # 签名取自实际读取的文件、且在读取之前：读取期间被追加或替换时，下次检查必然触发重新加载
+                    self._log_sig = self._log_signature(f.fileno())
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue  # 写入中断留下的半行
+                        row = int(rec["row"])
+                        if row >= n:
+                            continue
+                        self.ids[row] = rec["id"]
+                        self.metas[row] = rec.get("meta") or {}
+                        offs[row] = int(rec["off"])
+                        lens[row] = int(rec["len"])
+            self.count_rows = n
+            self.row_of = {cid: i for i, cid in enumerate(self.ids) if cid}
+            self.doc_off = np.asarray(offs, dtype=np.int64)
+            self.doc_len = np.asarray(lens, dtype=np.int64)
+            self._open_vectors()
+
+    def _open_vectors(self) -> None:
+        self._mm = None
+        if self.dim and self.capacity:
+            self._mm = np.memmap(self._p("vectors.bin"), dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+
+    def _log_signature(self, fd: Optional[int] = None):
+        # 追加改变大小与修改时间；compact() 的原子替换改变 inode（inode 可能被复用，因此同时比较修改时间）
+        try:
+            st = os.fstat(fd) if fd is not None else os.stat(self._p("rows.jsonl"))
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _maybe_reload(self) -> None:
+        """其它进程追加或压缩了行日志时重新加载。"""
+        sig = self._log_signature()
+        if sig is not None and sig != self._log_sig:
+            self._load()
+
+    @contextmanager
+    def _write_lock(self):
+        """
+        跨进程写锁（目录下 .lock 文件上的 flock）：建库脚本与 API 的 /ingest 可能同时写同一集合，
+        持锁期间先按磁盘状态刷新，再分配行号、追加日志并写 state.json，避免互相覆盖。
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if fcntl is None:
+                self._refresh_locked()
+                yield
+                return
+            with open(self._p(".lock"), "a+") as fh:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+                try:
+                    self._refresh_locked()
+                    yield
+                finally:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def _read_lock(self):
+        """读正文时的跨进程共享锁：与写锁（含 compact() 的文件替换）互斥，保证偏移与 documents.bin 属于同一版本。"""
+        with self._lock:
+            if fcntl is None or not os.path.isfile(self._p(".lock")):
+                self._maybe_reload()
+                yield
+                return
+            with open(self._p(".lock"), "r") as fh:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_SH)
+                try:
+                    self._maybe_reload()
+                    yield
+                finally:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+    def _refresh_locked(self) -> None:
+        """持写锁时重读 state.json：行数、容量或行日志有变化则整体重新加载，否则只同步集合 metadata。"""
+        try:
+            with open(self._p("state.json"), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if (
+            int(state.get("count", 0)) != self.count_rows
+            or int(state.get("capacity", 0)) != self.capacity
+            or self._log_signature() != self._log_sig
+        ):
+            self._load()
+        else:
+            self.metadata = dict(state.get("metadata") or {})
+
+    def _save_state(self) -> None:
+        state = {
+            "dim": self.dim,
+            "dtype": self.dtype,
+            "count": self.count_rows,
+            "capacity": self.capacity,
+            "metadata": self.metadata,
+        }
+        tmp = self._p(f"state.json.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp, self._p("state.json"))
+
+    def _ensure_capacity(self, rows: int) -> None:
+        if rows <= self.capacity:
+            return
+        new_cap = max(1024, self.capacity * 2)
+        while new_cap < rows:
+            new_cap *= 2
+        itemsize = np.dtype(self.dtype).itemsize
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+        with open(self._p("vectors.bin"), "ab") as f:
+            f.truncate(new_cap * self.dim * itemsize)
+        self.capacity = new_cap
+        self._open_vectors()
+
+    # ---------------- Chroma 兼容接口 ---------------- #
+    def count(self) -> int:
+        with self._lock:
+            self._maybe_reload()
+            return self.count_rows
+
+    def modify(self, metadata: Optional[dict] = None, **_: Any) -> None:
+        if metadata is None:
+            return
+        with self._write_lock():
+            self.metadata = dict(metadata)
+            self._save_state()
+
+    def upsert(self, ids: Sequence[str], embeddings, documents: Optional[Sequence[str]] = None,
+               metadatas: Optional[Sequence[dict]] = None) -> None:
+        if not ids:
+            return
+        vecs = np.asarray(embeddings, dtype=np.float32)
+        if vecs.ndim != 2 or vecs.shape[0] != len(ids):
+            raise ValueError("embeddings must be a 2-D array with one row per id")
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs = vecs / np.maximum(norms, 1e-12)
+        documents = list(documents) if documents is not None else [""] * len(ids)
+        metadatas = list(metadatas) if metadatas is not None else [{}] * len(ids)
+        with self._write_lock():
+            if not self.dim:
+                self.dim = int(vecs.shape[1])
+            elif vecs.shape[1] != self.dim:
+                raise ValueError(f"collection '{self.name}' stores {self.dim}-dim vectors, got {vecs.shape[1]}")
+            rows = []
+            next_row = self.count_rows
+            for cid in ids:
+                row = self.row_of.get(cid)
+                if row is None:
+                    row = next_row
+                    next_row += 1
+                    self.row_of[cid] = row
+                rows.append(row)
+            self._ensure_capacity(next_row)
+            rows_arr = np.asarray(rows, dtype=np.int64)
+            self._mm[rows_arr] = vecs.astype(self.dtype)
+            self._mm.flush()
+
+            grow = next_row - self.count_rows
+            if grow:
+                self.ids.extend([""] * grow)
+                self.metas.extend([{}] * grow)
+                self.doc_off = np.concatenate([self.doc_off, np.zeros(grow, dtype=np.int64)])
+                self.doc_len = np.concatenate([self.doc_len, np.zeros(grow, dtype=np.int64)])
+            lines = []
+            with open(self._p("documents.bin"), "ab") as fh:
+                off = fh.tell()
+                for cid, row, doc, meta in zip(ids, rows, documents, metadatas):
+                    data = (doc or "").encode("utf-8")
+                    fh.write(data)
+                    self.ids[row] = cid
+                    self.metas[row] = dict(meta or {})
+                    self.doc_off[row] = off
+                    self.doc_len[row] = len(data)
+                    lines.append(json.dumps({"id": cid, "row": row, "meta": meta or {}, "off": off, "len": len(data)}, ensure_ascii=False))
+                    off += len(data)
+            # 先写向量与正文，再追加行日志，最后更新行数：崩溃时最多丢失最后一批
+            with open(self._p("rows.jsonl"), "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            self.count_rows = next_row
+            self._save_state()
+            self._log_sig = self._log_signature()
+            self._columns.clear()
+            if off > _COMPACT_MIN_BYTES and off > 2 * int(self.doc_len.sum()):
+                self._compact_locked()
+
+    add = upsert
+
+    def compact(self) -> None:
+        """重写 documents.bin 与 rows.jsonl，只保留每行当前的正文与日志记录；行号与向量不变。"""
+        with self._write_lock():
+            self._compact_locked()
+
+    def _compact_locked(self) -> None:
+        if not self.count_rows:
+            return
+        lines = []
+        doc_tmp = self._p(f"documents.bin.{os.getpid()}.tmp")
+        log_tmp = self._p(f"rows.jsonl.{os.getpid()}.tmp")
+        new_off = np.zeros(self.count_rows, dtype=np.int64)
+        with open(self._p("documents.bin"), "rb") as src, open(doc_tmp, "wb") as dst:
+            off = 0
+            for row in range(self.count_rows):
+                src.seek(int(self.doc_off[row]))
+                data = src.read(int(self.doc_len[row]))
+                dst.write(data)
+                new_off[row] = off
+                lines.append(json.dumps({"id": self.ids[row], "row": row, "meta": self.metas[row], "off": off, "len": len(data)}, ensure_ascii=False))
+                off += len(data)
+        with open(log_tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        # 读正文的进程持共享锁并在锁内检查日志 inode，因此不会拿旧偏移读新文件
+        os.replace(doc_tmp, self._p("documents.bin"))
+        os.replace(log_tmp, self._p("rows.jsonl"))
+        self.doc_off = new_off
+        self._log_sig = self._log_signature()
+
+    def _read_documents(self, rows: Sequence[int]) -> List[str]:
+        if not rows:
+            return []
+        out = []
+        with open(self._p("documents.bin"), "rb") as fh:
+            for r in rows:
+                fh.seek(int(self.doc_off[r]))
+                out.append(fh.read(int(self.doc_len[r])).decode("utf-8", errors="ignore"))
+        return out
+
+    def _column(self, field: str):
+        col = self._columns.get(field)
+        if col is None:
+            col = np.empty(self.count_rows, dtype=object)
+            col[:] = [m.get(field) for m in self.metas]
+            self._columns[field] = col
+        return col
+
+    def _value_rows(self, field: str) -> Dict[Any, Any]:
+        """字段值 -> 行号数组的倒排表；$eq / $in 过滤只需拼接命中的行号。"""
+        key = ("__rows__", field)
+        table = self._columns.get(key)
+        if table is None:
+            buckets: Dict[Any, List[int]] = {}
+            for row, m in enumerate(self.metas):
+                v = m.get(field)
+                try:
+                    buckets.setdefault(v, []).append(row)
+                except TypeError:
+                    continue
+            table = {v: np.asarray(rows, dtype=np.int64) for v, rows in buckets.items()}
+            self._columns[key] = table
+        return table
+
+    def _in_mask(self, field: str, values) -> Any:
+        table = self._value_rows(field)
+        mask = np.zeros(self.count_rows, dtype=bool)
+        for v in values:
+            rows = table.get(v)
+            if rows is not None:
+                mask[rows] = True
+        return mask
+
+    def _where_mask(self, where: Optional[dict]):
+        """Chroma where 语法的子集：字段等值、$eq/$ne/$in/$nin/$gt/$gte/$lt/$lte，以及 $and/$or。"""
+        if not where:
+            return None
+        masks = []
+        for key, cond in where.items():
+            if key == "$and":
+                m = np.ones(self.count_rows, dtype=bool)
+                for sub in cond:
+                    m &= self._where_mask(sub)
+                masks.append(m)
+                continue
+            if key == "$or":
+                m = np.zeros(self.count_rows, dtype=bool)
+                for sub in cond:
+                    m |= self._where_mask(sub)
+                masks.append(m)
+                continue
+            if not isinstance(cond, dict):
+                cond = {"$eq": cond}
+            for op, val in cond.items():
+                if op == "$eq":
+                    masks.append(self._in_mask(key, [val]))
+                elif op == "$ne":
+                    masks.append(~self._in_mask(key, [val]))
+                elif op == "$in":
+                    masks.append(self._in_mask(key, val))
+                elif op == "$nin":
+                    masks.append(~self._in_mask(key, val))
+                elif op in ("$gt", "$gte", "$lt", "$lte"):
+                    col = self._column(key)
+                    cmp = {"$gt": lambda a: a > val, "$gte": lambda a: a >= val,
+                           "$lt": lambda a: a < val, "$lte": lambda a: a <= val}[op]
+                    masks.append(np.array([v is not None and cmp(v) for v in col], dtype=bool))
+                else:
+                    raise ValueError(f"unsupported where operator: {op}")
+        out = masks[0]
+        for m in masks[1:]:
+            out = out & m
+        return np.asarray(out, dtype=bool)
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Sequence[str] = _INCLUDE_ALL, **_: Any) -> Dict[str, List[list]]:
+        """
+        持锁只做重新加载、where 过滤与取 memmap 快照；矩阵乘与 top-k 在锁外进行，并发查询互不阻塞。
+        行号只增不减（compact() 也不移动向量），快照之后的写入只会追加新行或覆盖已有行的向量。
+        """
+        include = set(include)
+        qs = np.asarray(query_embeddings, dtype=np.float32)
+        if qs.ndim == 1:
+            qs = qs[None, :]
+        with self._lock:
+            self._maybe_reload()
+            mask = self._where_mask(where)
+            n = self.count_rows
+            mat = self._mm[:n] if n else None
+            dtype = self.dtype
+        tops = []
+        for q in qs:
+            if not n:
+                tops.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)))
+                continue
+            q = q / max(float(np.linalg.norm(q)), 1e-12)
+            if mask is not None and mask.sum() < _SUBSET_SCAN_RATIO * n:
+                subset = np.flatnonzero(mask)
+                sims = np.full(n, -np.inf, dtype=np.float32)
+                sims[subset] = _scores(mat, dtype, q, subset)
+            else:
+                sims = _scores(mat, dtype, q)
+                if mask is not None:
+                    sims = np.where(mask, sims, -np.inf)
+            k = min(n_results, n if mask is None else int(mask.sum()))
+            if k <= 0:
+                top = np.zeros(0, dtype=np.int64)
+            elif k < sims.shape[0]:
+                part = np.argpartition(-sims, k - 1)[:k]
+                top = part[np.argsort(-sims[part], kind="stable")]
+            else:
+                top = np.argsort(-sims, kind="stable")[:k]
+            tops.append((top, sims[top]))
+        result: Dict[str, List[list]] = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        with self._read_lock():
+            for top, top_sims in tops:
+                rows = [int(r) for r in top]
+                result["ids"].append([self.ids[r] for r in rows])
+                result["distances"].append([float(2.0 - 2.0 * s) for s in top_sims] if "distances" in include else None)
+                result["metadatas"].append([self.metas[r] for r in rows] if "metadatas" in include else None)
+                result["documents"].append(self._read_documents(rows) if "documents" in include else None)
+        return result
+
+    def get(self, ids: Optional[Sequence[str]] = None, where: Optional[dict] = None,
+            include: Sequence[str] = ("documents", "metadatas"), limit: Optional[int] = None, **_: Any) -> Dict[str, list]:
+        include = set(include)
+        with self._read_lock():
+            if ids is not None:
+                rows = [self.row_of[i] for i in ids if i in self.row_of]
+            else:
+                rows = list(range(self.count_rows))
+            mask = self._where_mask(where)
+            if mask is not None:
+                rows = [r for r in rows if mask[r]]
+            if limit is not None:
+                rows = rows[:limit]
+            return {
+                "ids": [self.ids[r] for r in rows],
+                "documents": self._read_documents(rows) if "documents" in include else None,
+                "metadatas": [self.metas[r] for r in rows] if "metadatas" in include else None,
+            }
@@ -276,7 +276,17 @@ export default function Home() {
                     const fd = new FormData(formEl);
                     try {
                       const res = await fetch(`${API_BASE}/ingest`, { method: "POST", body: fd });
-                      const j = await res.json().catch(() => ({}));
+                      let job = await res.json().catch(() => ({}));
+                      // 入库在后台执行：轮询任务状态直到完成
+                      if (job?.job_id) {
+                        setMessages((m) => [...m, { role: "assistant", content: "已提交入库任务，正在处理…" }]);
+                        while (job?.status === "queued" || job?.status === "running") {
+                          await new Promise((r) => setTimeout(r, 1000));
+                          const st = await fetch(`${API_BASE}/ingest/${job.job_id}`);
+                          job = await st.json().catch(() => ({}));
+                        }
+                      }
+                      const j = job?.result || (job?.error ? { reason: job.error } : job);
                       const added = j?.added || 0;
                       const reason = j?.reason;
                       const dbg = j?.debug ? `\n(debug: ${JSON.stringify(j.debug)})` : "";
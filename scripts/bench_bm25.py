@@ -0,0 +1,123 @@
+import argparse
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# 项目根目录优先
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.bm25_index import BM25Index, BM25Segment, save_indexes, load_indexes
+
+try:
+    from rank_bm25 import BM25Okapi
+except Exception:
+    BM25Okapi = None
+
+
+def synthetic_corpus(n_docs: int, vocab_size: int, doc_len: int, seed: int = 0):
+    """Zipf 分布的合成语料：返回 (扁平词项 id, 每篇长度, 词表)。"""
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, vocab_size + 1, dtype=np.float64)
+    probs = 1.0 / ranks ** 1.1
+    probs /= probs.sum()
+    lens = rng.integers(doc_len // 2, doc_len * 3 // 2, size=n_docs)
+    flat = rng.choice(vocab_size, size=int(lens.sum()), p=probs).astype(np.int32)
+    vocab = {f"t{i}": i for i in range(vocab_size)}
+    return flat, lens, vocab
+
+
+def synthetic_queries(n: int, vocab_size: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    # 查询词偏向中频词，更接近真实检索
+    return [[f"t{int(t)}" for t in rng.integers(20, min(vocab_size, 5000), size=rng.integers(3, 8))] for _ in range(n)]
+
+
+def percentile(values, q):
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+
+def bench(n_docs: int, args) -> None:
+    flat, lens, vocab = synthetic_corpus(n_docs, args.vocab, args.doc_len)
+    keys = [f"doc{i}" for i in range(n_docs)]
+    t0 = time.perf_counter()
+    index = BM25Index([BM25Segment.build_from_ids(keys, flat, lens, vocab)])
+    build_s = time.perf_counter() - t0
+    queries = synthetic_queries(args.queries, args.vocab)
+
+    lat = []
+    for q in queries:
+        t0 = time.perf_counter()
+        index.search(q, top_k=args.top_k)
+        lat.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    for i in range(0, len(queries), args.batch):
+        index.search_batch(queries[i:i + args.batch], top_k=args.top_k)
+    batch_per_q = (time.perf_counter() - t0) / len(queries)
+    print(
+        f"{n_docs:>9} sparse  build {build_s:7.2f}s  single p50 {statistics.median(lat) * 1000:8.2f}ms "
+        f"p99 {percentile(lat, 0.99) * 1000:8.2f}ms  batch{args.batch} {batch_per_q * 1000:8.2f}ms/q"
+    )
+
+    if args.persist:
+        # 落盘后以内存映射方式重新打开：打开耗时应与语料规模无关
+        with tempfile.TemporaryDirectory() as root:
+            t0 = time.perf_counter()
+            save_indexes(root, {"chunks": index})
+            save_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            mapped = load_indexes(root, ("chunks",))["chunks"]
+            open_s = time.perf_counter() - t0
+            mlat = []
+            for q in queries:
+                t0 = time.perf_counter()
+                mapped.search(q, top_k=args.top_k)
+                mlat.append(time.perf_counter() - t0)
+            print(
+                f"{n_docs:>9} mmap    save  {save_s:7.2f}s  open {open_s * 1000:8.2f}ms  "
+                f"single p50 {statistics.median(mlat) * 1000:8.2f}ms"
+            )
+            del mapped
+
+    if BM25Okapi is not None and n_docs <= args.ref_max:
+        # rank_bm25 需要字符串 token 列表
+        offsets = np.concatenate(([0], np.cumsum(lens)))
+        docs = [[f"t{t}" for t in flat[offsets[i]:offsets[i + 1]]] for i in range(n_docs)]
+        t0 = time.perf_counter()
+        ref = BM25Okapi(docs)
+        ref_build = time.perf_counter() - t0
+        ref_lat = []
+        for q in queries[: min(len(queries), 20)]:
+            t0 = time.perf_counter()
+            scores = ref.get_scores(q)
+            sorted(enumerate(scores), key=lambda x: x[1], reverse=True)
+            ref_lat.append(time.perf_counter() - t0)
+        print(
+            f"{n_docs:>9} rank_bm25 build {ref_build:7.2f}s  single p50 {statistics.median(ref_lat) * 1000:8.2f}ms "
+            f"p99 {percentile(ref_lat, 0.99) * 1000:8.2f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the sparse-matrix BM25 engine on a synthetic corpus")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--doc_len", type=int, default=60, help="mean tokens per chunk")
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--top_k", type=int, default=100)
+    parser.add_argument("--ref_max", type=int, default=100_000, help="largest size to also run rank_bm25 on")
+    parser.add_argument("--persist", action="store_true", help="also time save + memory-mapped open")
+    args = parser.parse_args()
+    for n in args.sizes:
+        bench(n, args)
+
+
+if __name__ == "__main__":
+    main()
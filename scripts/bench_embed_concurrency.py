@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import json
+import pathlib
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 项目根目录优先
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.embeddings import _DashscopeEmbeddingFunction
+
+
+def fake_vector(text: str, dim: int) -> list:
+    h = hashlib.sha256(text.encode("utf-8")).digest()
+    return [h[i % len(h)] / 255.0 for i in range(dim)]
+
+
+def make_handler(latency: float, error_rate: float, dim: int, counters: dict, lock: threading.Lock):
+    class Handler(BaseHTTPRequestHandler):
+        """OpenAI 兼容的 /embeddings 替身：固定延迟 + 按比例返回 429/503。"""
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers.get("content-length", "0"))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            time.sleep(latency)
+            with lock:
+                counters["requests"] += 1
+                fail = random.random() < error_rate
+                if fail:
+                    counters["errors"] += 1
+            if fail:
+                status = random.choice([429, 503])
+                payload = json.dumps({"error": {"message": "stand-in failure", "code": status}}).encode()
+                self.send_response(status)
+                self.send_header("content-type", "application/json")
+                self.send_header("retry-after", "0")
+                self.send_header("content-length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+            inputs = body.get("input") or []
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            data = [
+                {"object": "embedding", "index": i, "embedding": fake_vector(t, dim)}
+                for i, t in enumerate(inputs)
+            ]
+            # 故意倒序返回，验证客户端按 index 还原顺序
+            data.reverse()
+            payload = json.dumps({
+                "object": "list",
+                "data": data,
+                "model": body.get("model"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }).encode()
+            self.send_response(200)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def run_once(base_url: str, texts: list, dim: int, concurrency: int, rps: float) -> float:
+    fn = _DashscopeEmbeddingFunction(
+        api_key="stand-in",
+        model="stand-in-embed",
+        base_url=base_url,
+        concurrency=concurrency,
+        requests_per_second=rps,
+        max_retries=8,
+        backoff_base=0.05,
+    )
+    t0 = time.perf_counter()
+    out = fn(texts)
+    elapsed = time.perf_counter() - t0
+    assert len(out) == len(texts), "length mismatch"
+    for text, vec in zip(texts, out):
+        assert vec == fake_vector(text, dim), "output order does not match input order"
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exercise concurrent DashScope embedding against a local OpenAI-compatible stand-in")
+    parser.add_argument("--texts", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in latency per request (s)")
+    parser.add_argument("--error_rate", type=float, default=0.1, help="fraction of requests answered with 429/503")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--rps", type=float, default=0.0, help="client-side rate limit, <=0 disables")
+    parser.add_argument("--dim", type=int, default=8)
+    args = parser.parse_args()
+
+    counters = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.latency, args.error_rate, args.dim, counters, lock))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+    texts = [f"chunk {i} " + "x" * (i % 50) for i in range(args.texts)]
+    try:
+        for c in args.concurrency:
+            with lock:
+                counters["requests"] = counters["errors"] = 0
+            elapsed = run_once(base_url, texts, args.dim, c, args.rps)
+            print(
+                f"concurrency={c:<3} rps_limit={args.rps or 'off'}  {elapsed:6.2f}s  "
+                f"{len(texts) / elapsed:8.1f} texts/s  requests={counters['requests']} injected_errors={counters['errors']}  order=ok"
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
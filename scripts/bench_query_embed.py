@@ -0,0 +1,95 @@
+import argparse
+import pathlib
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 项目根目录优先
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app import embeddings
+
+
+class SimulatedEncoder:
+    """模拟 CPU 上的 SentenceTransformer：每次前向固定开销 + 每条样本的边际开销，前向串行执行。"""
+
+    def __init__(self, overhead_ms: float, per_item_ms: float):
+        self.overhead = overhead_ms / 1000.0
+        self.per_item = per_item_ms / 1000.0
+        self._lock = threading.Lock()
+
+    def name(self) -> str:
+        return "simulated-encoder"
+
+    def __call__(self, input):
+        with self._lock:
+            time.sleep(self.overhead + self.per_item * len(input))
+        return [[float(len(t)), 1.0] for t in input]
+
+
+def percentile(values, q: float) -> float:
+    vals = sorted(values)
+    if not vals:
+        return 0.0
+    idx = min(len(vals) - 1, max(0, int(round(q * (len(vals) - 1)))))
+    return vals[idx]
+
+
+def run(clients: int, per_client: int, batching: bool) -> dict:
+    embedder = embeddings.get_embedder()
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(cid: int):
+        for i in range(per_client):
+            text = f"client {cid} query {i} about retrieval augmented generation"
+            t0 = time.perf_counter()
+            if batching:
+                embeddings._batcher.embed(embedder, text)
+            else:
+                embedder([text])
+            dt = time.perf_counter() - t0
+            with lock:
+                latencies.append(dt)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(worker, range(clients)))
+    wall = time.perf_counter() - t0
+    return {
+        "qps": len(latencies) / wall if wall else 0.0,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput / p99 of query embedding with and without micro-batching")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--per_client", type=int, default=20)
+    parser.add_argument("--simulate", action="store_true", help="use a simulated encoder instead of the configured embedder")
+    parser.add_argument("--overhead_ms", type=float, default=8.0)
+    parser.add_argument("--per_item_ms", type=float, default=1.5)
+    args = parser.parse_args()
+
+    if args.simulate:
+        sim = SimulatedEncoder(args.overhead_ms, args.per_item_ms)
+        embeddings.get_embedder = lambda: sim  # type: ignore
+    else:
+        print(f"warming up {embeddings.warmup_embedder()}")
+
+    print(f"{'clients':>7} {'mode':>10} {'qps':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for c in args.clients:
+        for batching in (False, True):
+            r = run(c, args.per_client, batching)
+            mode = "microbatch" if batching else "direct"
+            print(f"{c:>7} {mode:>10} {r['qps']:>9.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f}")
+    print("batcher:", embeddings._batcher.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import gc
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# 项目根目录优先
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.bm25_index import BM25Index, BM25Segment
+from app.tokenizer import TokenIdBuffer, Vocabulary, tokenize
+
+
+def rss_mb() -> float:
+    """当前常驻内存（MB）：优先 /proc，其次 psutil，最后退回 ru_maxrss（峰值）。"""
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss / (1024.0 * 1024.0)
+    except Exception:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def synthetic_chunks(n: int, vocab_size: int, words_per_chunk: int, cjk_ratio: float, seed: int = 0):
+    """Zipf 分布的英文词 + 一定比例的中文句子，近似混合语料的 chunk。"""
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, vocab_size + 1, dtype=np.float64)
+    probs = 1.0 / ranks ** 1.1
+    probs /= probs.sum()
+    words = [f"term{i}" for i in range(vocab_size)]
+    hanzi = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+    hz_probs = 1.0 / np.arange(1, len(hanzi) + 1, dtype=np.float64)
+    hz_probs /= hz_probs.sum()
+    ids = rng.choice(vocab_size, size=(n, words_per_chunk), p=probs)
+    chunks = []
+    for i in range(n):
+        text = " ".join(words[j] for j in ids[i])
+        if rng.random() < cjk_ratio:
+            text += " " + "".join(hanzi[j] for j in rng.choice(len(hanzi), size=80, p=hz_probs))
+        chunks.append(text)
+    return chunks
+
+
+def _legacy_tokenize(text: str):
+    # 旧实现：每次调用 re.split，返回字符串列表
+    return [t for t in re.split(r"[^a-z0-9_]+", text.lower()) if t]
+
+
+def run_mode(mode: str, args) -> None:
+    chunks = synthetic_chunks(args.chunks, args.vocab, args.words, args.cjk_ratio)
+    gc.collect()
+    base = rss_mb()
+    t0 = time.perf_counter()
+    if mode == "strings":
+        # 旧路径：每个 chunk 保留一个 token 字符串列表，并随进程常驻
+        kept = [_legacy_tokenize(c) for c in chunks]
+        n_tokens = sum(len(t) for t in kept)
+        index = BM25Index([BM25Segment.build([str(i) for i in range(len(kept))], kept)])
+    else:
+        vocab = Vocabulary()
+        buf = TokenIdBuffer(vocab)
+        for c in chunks:
+            buf.add(c)
+        n_tokens = len(buf.ids)
+        index = BM25Index([BM25Segment.build_from_ids(
+            [str(i) for i in range(len(buf))], np.frombuffer(buf.ids, dtype=np.int32), buf.lengths, vocab.ids
+        )])
+        del buf
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    after = rss_mb()
+    cjk_hits = len(index.search(tokenize(chr(0x4E00) + chr(0x4E01) + chr(0x4E02)), top_k=10))
+    print(
+        f"{mode:>8}  chunks {len(chunks):>7}  tokens {n_tokens:>10}  build {elapsed:6.2f}s  "
+        f"rss +{after - base:8.1f} MB  (corpus baseline {base:7.1f} MB)  cjk query hits {cjk_hits}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident memory of the lexical index: string token lists vs integer id arrays")
+    parser.add_argument("--chunks", type=int, default=100_000)
+    parser.add_argument("--vocab", type=int, default=50_000)
+    parser.add_argument("--words", type=int, default=150, help="ascii words per chunk")
+    parser.add_argument("--cjk_ratio", type=float, default=0.2, help="fraction of chunks with a Chinese passage")
+    parser.add_argument("--mode", choices=["strings", "ids"], help="run a single mode in this process")
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args)
+        return
+    # 每种模式在独立子进程中运行，RSS 互不干扰
+    for mode in ("strings", "ids"):
+        cmd = [sys.executable, os.path.abspath(__file__), "--mode", mode,
+               "--chunks", str(args.chunks), "--vocab", str(args.vocab),
+               "--words", str(args.words), "--cjk_ratio", str(args.cjk_ratio)]
+        subprocess.run(cmd, check=True)
+
+
+if __name__ == "__main__":
+    main()
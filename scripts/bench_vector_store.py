@@ -0,0 +1,118 @@
+import argparse
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# 项目根目录优先
+PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+from app.vector_store import NumpyVectorClient
+
+try:
+    import chromadb
+except Exception:
+    chromadb = None
+
+
+def synthetic_vectors(n: int, dim: int, n_sources: int, seed: int = 0):
+    """带簇结构的单位向量：每个 source 一个簇中心，chunk 在中心附近抖动，更接近真实语料。"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_sources, dim)).astype(np.float32)
+    src = rng.integers(0, n_sources, size=n)
+    vecs = centers[src] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    ids = [f"c{i}" for i in range(n)]
+    metas = [{"source": f"data/arxiv/doc{int(s)}.md", "chunk_index": i} for i, s in enumerate(src)]
+    return ids, vecs, metas
+
+
+def percentile(values, q: float) -> float:
+    vals = sorted(values)
+    return vals[min(len(vals) - 1, int(round(q * (len(vals) - 1))))]
+
+
+def exact_topk(vecs, mask, q, k):
+    sims = vecs @ q
+    if mask is not None:
+        sims = np.where(mask, sims, -np.inf)
+    k = min(k, int(np.isfinite(sims).sum()))
+    return set(np.argsort(-sims)[:k].tolist())
+
+
+def run_backend(name, collection, queries, truth, k, where):
+    lat, recalls = [], []
+    for q, gt in zip(queries, truth):
+        t0 = time.perf_counter()
+        res = collection.query(query_embeddings=[q.tolist()], n_results=k, where=where,
+                               include=["documents", "metadatas", "distances"])
+        lat.append(time.perf_counter() - t0)
+        got = {int(i[1:]) for i in res["ids"][0]}
+        recalls.append(len(got & gt) / max(1, len(gt)))
+    label = f"{name}{' +where' if where else ''}"
+    print(f"  {label:<16} p50 {statistics.median(lat) * 1000:8.2f}ms  p99 {percentile(lat, 0.99) * 1000:8.2f}ms  "
+          f"recall@{k} {statistics.mean(recalls):.3f}")
+
+
+def bench(n: int, args) -> None:
+    ids, vecs, metas = synthetic_vectors(n, args.dim, max(10, n // 50))
+    rng = np.random.default_rng(1)
+    queries = vecs[rng.integers(0, n, size=args.queries)] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    allowed = sorted({m["source"] for m in metas[: max(1, n // 10)]})[:50]
+    allowed_set = set(allowed)
+    where = {"source": {"$in": allowed}}
+    mask = np.array([m["source"] in allowed_set for m in metas])
+    docs = [f"chunk text {i}" for i in range(n)]
+    print(f"N={n} dim={args.dim}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = []
+        client = NumpyVectorClient(tmp + "/np", fp16=False)
+        coll = client.get_or_create_collection("bench")
+        t0 = time.perf_counter()
+        for s in range(0, n, 5000):
+            coll.upsert(ids=ids[s:s + 5000], embeddings=vecs[s:s + 5000], documents=docs[s:s + 5000], metadatas=metas[s:s + 5000])
+        print(f"  numpy insert {time.perf_counter() - t0:6.2f}s")
+        backends.append(("numpy-f32", coll))
+
+        client16 = NumpyVectorClient(tmp + "/np16", fp16=True)
+        coll16 = client16.get_or_create_collection("bench")
+        for s in range(0, n, 5000):
+            coll16.upsert(ids=ids[s:s + 5000], embeddings=vecs[s:s + 5000], documents=docs[s:s + 5000], metadatas=metas[s:s + 5000])
+        backends.append(("numpy-f16", coll16))
+
+        if chromadb is not None and n <= args.chroma_max:
+            cclient = chromadb.PersistentClient(path=tmp + "/chroma")
+            ccoll = cclient.get_or_create_collection("bench")
+            t0 = time.perf_counter()
+            for s in range(0, n, 5000):
+                ccoll.upsert(ids=ids[s:s + 5000], embeddings=vecs[s:s + 5000].tolist(), documents=docs[s:s + 5000], metadatas=metas[s:s + 5000])
+            print(f"  chroma insert {time.perf_counter() - t0:6.2f}s")
+            backends.append(("chroma", ccoll))
+
+        for w, m in ((None, None), (where, mask)):
+            truth = [exact_topk(vecs, m, q, args.k) for q in queries]
+            for name, c in backends:
+                run_backend(name, c, queries, truth, args.k, w)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency / recall: Chroma vs the NumPy memmap vector store")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--chroma_max", type=int, default=100_000, help="largest size to also load into Chroma")
+    args = parser.parse_args()
+    for n in args.sizes:
+        bench(n, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,33 @@
 import argparse
-import hashlib
 import json
+import multiprocessing
+import os
 import pathlib
+import shutil
+import signal
 import sys
-from typing import Dict
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait as mp_wait
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 # 确保本项目根目录优先于 site-packages，避免被 PyPI 的 `app` 包遮蔽
 PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[1]
 if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
-from app.chroma_utils import init_chroma, add_documents
+from app.chroma_utils import DEFAULT_COLLECTION, init_chroma, add_documents, embed_cache_stats, rebuild_bm25_indexes, _bm25_index_root
+from app.doc_cache import file_sha256, doc_cache_stats, get_parsed, put_parsed
+from app.extractors import PDF_CHAIN_EXTRACTOR, extract_pdf
+from app.settings import get_int
+from app import bm25_index
 
 
 STATE_FILE = pathlib.Path("data/.index_state.json")
 
 
-def file_sha256(path: pathlib.Path) -> str:
-    h = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
-
 def load_state() -> Dict[str, str]:
     if STATE_FILE.exists():
         return json.loads(STATE_FILE.read_text(encoding="utf-8"))
@@ -44,36 +48,255 @@ def scan_data_dir(root: pathlib.Path):
         yield p
 
 
+class _FileTimeout(Exception):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise _FileTimeout()
+
+
+def _extract_worker(args: Tuple[str, float]) -> Tuple[str, str, Optional[str], List[str], float]:
+    """子进程中解析单个 PDF；支持 SIGALRM 的平台上超时会在子进程内中断，worker 可继续处理下一个文件。"""
+    path, timeout = args
+    t0 = time.perf_counter()
+    use_alarm = timeout > 0 and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        text, title, tried = extract_pdf(path)
+    except _FileTimeout:
+        text, title, tried = "", None, ["timeout"]
+    except Exception as e:
+        text, title, tried = "", None, [f"error: {e}"]
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return path, text, title, tried, time.perf_counter() - t0
+
+
+def _worker_main(conn, timeout: float) -> None:
+    """常驻 worker：从自己的管道逐个接收路径，解析后回传结果；收到 None 或管道关闭时退出。"""
+    while True:
+        try:
+            path = conn.recv()
+        except (EOFError, OSError):
+            break
+        if path is None:
+            break
+        conn.send(_extract_worker((path, timeout)))
+
+
+def _spawn_worker(timeout: float) -> Dict:
+    parent_conn, child_conn = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_worker_main, args=(child_conn, timeout), daemon=True)
+    proc.start()
+    child_conn.close()
+    return {"proc": proc, "conn": parent_conn, "path": None, "started": 0.0}
+
+
+def _stop_worker(slot: Dict, kill: bool = False) -> None:
+    if not kill:
+        try:
+            slot["conn"].send(None)
+        except (OSError, ValueError):
+            pass
+        slot["proc"].join(1.0)
+    if slot["proc"].is_alive():
+        slot["proc"].kill()
+        slot["proc"].join()
+    slot["conn"].close()
+
+
+def extract_pdfs(paths: List[str], shas: Dict[str, str], workers: int, timeout: float, spool: str) -> Tuple[Dict[str, str], Set[str]]:
+    """
+    并行解析 PDF，返回 (texts, failed)：texts 为 路径 -> 正文，正文写在 spool 目录下的临时文件里（空文本为 ""），
+    failed 为超时或出错的文件。解析缓存只用来跳过重复解析（命中的正文同样落到 spool），
+    DOC_CACHE=0 或条目被淘汰时照常解析，结果不依赖缓存；空文本也写入缓存，扫描件不会每次重新 OCR。
+    每个 worker 有独立管道，父进程在把文件派给空闲 worker 时开始计时：
+    子进程内 SIGALRM 按 timeout 中断；卡在 C 扩展里收不到信号时，父进程在 timeout 的两倍后
+    杀掉该 worker 并换一个新的，排在后面的文件不受影响。
+    失败的文件不写缓存，调用方也不记入索引状态，下次运行会重试。
+    """
+    texts: Dict[str, str] = {}
+    failed: Set[str] = set()
+
+    def keep(path: str, text: str) -> None:
+        if not text:
+            texts[path] = ""
+            return
+        spool_path = os.path.join(spool, f"{len(texts)}.txt")
+        with open(spool_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        texts[path] = spool_path
+
+    todo = []
+    for path in paths:
+        hit = get_parsed(shas[path], PDF_CHAIN_EXTRACTOR)
+        if hit is None:
+            todo.append(path)
+        else:
+            keep(path, hit[0])
+    if not todo:
+        return texts, failed
+    hard_limit = timeout * 2 + 5 if timeout > 0 else None
+    queue = deque(todo)
+    slots = [_spawn_worker(timeout) for _ in range(max(1, min(workers, len(todo))))]
+    timeouts = 0
+
+    def record(path: str, text: str, title: Optional[str], tried: List[str]) -> None:
+        nonlocal timeouts
+        if tried and tried[0] == "timeout":
+            timeouts += 1
+            failed.add(path)
+            print(f"  timeout: {path}")
+        elif tried and tried[0].startswith("error"):
+            failed.add(path)
+            print(f"  failed: {path} ({tried[0]})")
+        else:
+            put_parsed(shas[path], PDF_CHAIN_EXTRACTOR, text, title)
+            keep(path, text)
+
+    try:
+        while True:
+            for slot in slots:
+                if slot["path"] is None and queue:
+                    slot["path"] = queue.popleft()
+                    slot["started"] = time.monotonic()
+                    slot["conn"].send(slot["path"])
+            busy = [slot for slot in slots if slot["path"] is not None]
+            if not busy:
+                break
+            ready = mp_wait([slot["conn"] for slot in busy], timeout=1.0)
+            for i, slot in enumerate(slots):
+                path = slot["path"]
+                if path is None:
+                    continue
+                if slot["conn"] in ready:
+                    try:
+                        _, text, title, tried, _ = slot["conn"].recv()
+                    except (EOFError, OSError):
+                        # worker 异常退出（如被 OOM killer 杀掉）：记为失败并换一个新 worker
+                        record(path, "", None, ["error: worker exited"])
+                        _stop_worker(slot, kill=True)
+                        slots[i] = _spawn_worker(timeout)
+                        continue
+                    slot["path"] = None
+                    record(path, text or "", title, tried)
+                elif hard_limit is not None and time.monotonic() - slot["started"] > hard_limit:
+                    record(path, "", None, ["timeout"])
+                    _stop_worker(slot, kill=True)
+                    slots[i] = _spawn_worker(timeout)
+    finally:
+        for slot in slots:
+            _stop_worker(slot, kill=slot["path"] is not None)
+    if failed:
+        print(f"pdf extraction: {timeouts} timed out, {len(failed) - timeouts} failed (not cached; retried on the next run)")
+    return texts, failed
+
+
+def _spool_reader(texts: Dict[str, str]) -> Callable[[str], Optional[str]]:
+    """路径 -> 本次解析得到的正文；不在本次解析范围内的文件返回 None，由调用方按原路径读取。"""
+    def read(path: str) -> Optional[str]:
+        spool_path = texts.get(path)
+        if spool_path is None:
+            return None
+        if not spool_path:
+            return ""
+        with open(spool_path, "r", encoding="utf-8") as f:
+            return f.read()
+    return read
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--force", action="store_true", help="re-index all .md/.txt regardless of hash state")
+    parser.add_argument("--force", action="store_true", help="re-index all .md/.txt/.pdf regardless of hash state")
+    parser.add_argument("--workers", type=int, default=get_int("INDEX_WORKERS", 0) or (os.cpu_count() or 1),
+                        help="processes for PDF extraction (default: INDEX_WORKERS or CPU count)")
+    parser.add_argument("--timeout", type=float, default=float(get_int("INDEX_FILE_TIMEOUT", 120) or 0),
+                        help="per-PDF extraction timeout in seconds (0 = none)")
     args = parser.parse_args()
 
     data_root = pathlib.Path("data")
     prev = {} if args.force else load_state()
-    curr = {}
-    docs = []
-
-    for f in scan_data_dir(data_root):
-        sha = file_sha256(f)
-        curr[str(f)] = sha
-        if args.force or prev.get(str(f)) != sha:
-            # changed/new or force
-            try:
-                text = f.read_text(encoding="utf-8") if f.suffix.lower() != ".pdf" else None
-            except Exception:
-                text = None
-            if text:
-                docs.append((str(f), text))
-
-    if docs:
-        client = init_chroma()
-        add_documents(client, "resume_mvp", docs)
-        print(f"indexed {len(docs)} files ({'force' if args.force else 'delta'})")
-    else:
-        print("no changes detected")
-
-    save_state(curr)
+    t_start = time.perf_counter()
+
+    # 哈希在线程池上并行（hashlib 处理大块数据时释放 GIL）
+    files = [str(f) for f in scan_data_dir(data_root)]
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
+        curr = dict(zip(files, ex.map(file_sha256, files)))
+    changed = [f for f in files if args.force or prev.get(f) != curr[f]]
+    n_bytes = sum(os.path.getsize(f) for f in changed)
+
+    pdfs = [f for f in changed if f.lower().endswith(".pdf")]
+    spool = tempfile.mkdtemp(prefix="index-spool-")
+    try:
+        pdf_texts, failed = extract_pdfs(pdfs, curr, args.workers, args.timeout, spool) if pdfs else ({}, set())
+        read_pdf = _spool_reader(pdf_texts)
+        t_extract = time.perf_counter() - t_start
+        # 本次真正处理完的文件：写入了向量库，或者成功解析但没有可索引的文本（如无文字层的扫描件）
+        done: Set[str] = set()
+        indexed = 0
+
+        def iter_docs():
+            # 逐篇读取（PDF 取自本次解析写出的 spool 文件），add_documents 边读边切分写入，不把全部正文留在内存
+            nonlocal indexed
+            for f in changed:
+                if f in failed:
+                    continue
+                try:
+                    if f.lower().endswith(".pdf"):
+                        text = read_pdf(f)
+                    else:
+                        text = pathlib.Path(f).read_text(encoding="utf-8")
+                except Exception:
+                    continue
+                if text is None:
+                    continue
+                if not text:
+                    done.add(f)
+                    continue
+                indexed += 1
+                yield f, text
+                # add_documents 分批写入：正常返回时产出过的文档都已写入；中途出错则脚本退出，不保存状态
+                done.add(f)
+
+        if changed:
+            client = init_chroma()
+            before = embed_cache_stats()
+            add_documents(client, DEFAULT_COLLECTION, iter_docs())
+            after = embed_cache_stats()
+            hits = after["hits"] - before["hits"]
+            misses = after["misses"] - before["misses"]
+            print(f"indexed {indexed} files ({'force' if args.force else 'delta'})")
+            print(f"embedding cache: {hits} hits, {misses} misses")
+        else:
+            print("no changes detected")
+
+        # 文件集合有变化（含删除）或磁盘上还没有 BM25 索引时，重建并持久化，服务进程启动后直接内存映射
+        if curr != prev or bm25_index.current_generation(_bm25_index_root(str(data_root))) is None:
+            t0 = time.perf_counter()
+            # 超时 / 出错的 PDF 不在主进程里重新解析，下次运行重试；本次解析过的 PDF 直接读 spool
+            if rebuild_bm25_indexes(str(data_root), exclude=failed, read_pdf=read_pdf):
+                print(f"bm25 index persisted in {time.perf_counter() - t0:.2f}s")
+    finally:
+        shutil.rmtree(spool, ignore_errors=True)
+    parsed = doc_cache_stats()
+    print(f"document cache: {parsed['hits']} hits, {parsed['misses']} misses")
+
+    elapsed = time.perf_counter() - t_start
+    mb = n_bytes / (1024 * 1024)
+    if changed:
+        print(
+            f"read+extract {len(changed)} files ({mb:.1f} MB, {len(pdfs)} pdf) in {t_extract:.2f}s "
+            f"with {args.workers} workers: {len(changed) / max(t_extract, 1e-9):.1f} docs/s, {mb / max(t_extract, 1e-9):.2f} MB/s"
+        )
+        print(f"total {elapsed:.2f}s: {len(changed) / elapsed:.1f} docs/s, {mb / elapsed:.2f} MB/s")
+
+    # 只记录未变化的文件与本次处理完的文件；失败或未读到的文件下次运行重试
+    unchanged = set(files) - set(changed)
+    save_state({f: sha for f, sha in curr.items() if f in unchanged or f in done})
 
 
 if __name__ == "__main__":
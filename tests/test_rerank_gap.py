@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+chromadb = pytest.importorskip("chromadb")
+
+from app.chroma_utils import _distance_space, distance_to_similarity
+from app.rag_pipeline import _confident_top
+
+
+def _unit(cos: float, dim: int = 8) -> list:
+    # 与 e0 夹角余弦为 cos 的单位向量
+    v = np.zeros(dim, dtype=np.float32)
+    v[0], v[1] = cos, np.sqrt(1.0 - cos * cos)
+    return v.tolist()
+
+
+def _chroma_sources(cosines, space=None):
+    client = chromadb.EphemeralClient()
+    name = f"gap_{space or 'default'}_{len(cosines)}_{int(cosines[0] * 1000)}"
+    coll = client.get_or_create_collection(name, metadata={"hnsw:space": space} if space else None)
+    coll.add(ids=[f"c{i}" for i in range(len(cosines))], embeddings=[_unit(c) for c in cosines])
+    e0 = [1.0] + [0.0] * 7
+    res = coll.query(query_embeddings=[e0], n_results=len(cosines), include=["distances"])
+    assert _distance_space(coll) == (space or "l2")
+    return [{"score": distance_to_similarity(d, _distance_space(coll))} for d in res["distances"][0]]
+
+
+def test_chroma_l2_distances_become_cosine():
+    sources = _chroma_sources([0.45, 0.28, 0.20])
+    assert [round(s["score"], 3) for s in sources] == [0.45, 0.28, 0.2]
+
+
+def test_gap_skip_on_chroma_l2_distances():
+    # 平方 L2 下 1 - d 会把这些相似度全部截成 0；换算为余弦后 0.45 领先 0.28 达 0.17
+    assert _confident_top(_chroma_sources([0.45, 0.28, 0.20]), top_n=30, gap=0.15)
+    assert not _confident_top(_chroma_sources([0.50, 0.42, 0.20]), top_n=30, gap=0.15)
+
+
+def test_gap_skip_matches_across_spaces():
+    for cosines in ([0.45, 0.28, 0.20], [0.50, 0.42, 0.20], [0.9, 0.7, 0.6]):
+        l2 = _chroma_sources(cosines)
+        cos = _chroma_sources(cosines, space="cosine")
+        assert _confident_top(l2, 30, 0.15) == _confident_top(cos, 30, 0.15)
+
+
+def test_bm25_only_candidate_takes_lowest_similarity():
+    sources = [{"score": 0.45}, {"score": None}, {"score": 0.25}]
+    assert _confident_top(sources, top_n=30, gap=0.15)
+    assert not _confident_top([{"score": None}, {"score": 0.2}, {"score": 0.1}], top_n=30, gap=0.15)